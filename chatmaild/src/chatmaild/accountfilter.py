@@ -0,0 +1,115 @@
+"""
+Membership filter of existing addresses for doveauth.
+
+Lookups of nonexistent addresses, e.g. from spam deliveries,
+are answered without touching the file system
+if the address is not in a Bloom filter of all mailbox directories.
+The filter has no false negatives for addresses added to it
+and a false positive rate of about 1% up to its capacity,
+false positives just fall through to reading the password file.
+
+The filter lives in anonymous shared memory which is created
+before the pre-fork supervisor forks its workers, so an account created
+by one worker is visible to all of them. Each cell is a whole byte
+so that concurrent additions from different processes never lose bits.
+Accounts created by other means are picked up by rescanning
+the mailboxes directory after its or a shard's modification time changed.
+Expired accounts stay in the filter until doveauth restarts.
+"""
+
+import hashlib
+import logging
+import mmap
+import threading
+import time
+
+from .mailboxes import get_mailboxes_mtime_ns, iter_mailbox_dirs
+from .metrics import REGISTRY
+
+# cells per address of capacity and hash functions for a 1% false positive rate
+CELLS_PER_ADDRESS = 10
+NUM_HASHES = 7
+
+# minimum seconds between two rescans of the mailboxes directory
+RESCAN_INTERVAL = 60
+
+FILTER_LOOKUPS = REGISTRY.counter(
+    "chatmail_userdb_filter_lookups_total",
+    "Account filter lookups by result (absent, present).",
+    ["result"],
+)
+
+
+class AccountFilter:
+    """Bloom filter of the addresses with a mailbox in `mailboxes_dir`.
+
+    It is sized for twice the number of existing addresses
+    but at least `min_capacity` addresses.
+    """
+
+    def __init__(self, mailboxes_dir, min_capacity, rescan_interval=RESCAN_INTERVAL):
+        self.mailboxes_dir = mailboxes_dir
+        self.rescan_interval = rescan_interval
+        self.mtime_ns = self.get_mtime_ns()
+        addrs = [addr for addr, path in iter_mailbox_dirs(mailboxes_dir)]
+        self.capacity = max(min_capacity, 2 * len(addrs))
+        self.size = self.capacity * CELLS_PER_ADDRESS
+        self.cells = mmap.mmap(-1, self.size)
+        for addr in addrs:
+            self.add(addr)
+        self.checked = time.monotonic()
+        self._rescan_lock = threading.Lock()
+
+    def get_mtime_ns(self):
+        return get_mailboxes_mtime_ns(self.mailboxes_dir)
+
+    def get_positions(self, addr):
+        digest = hashlib.blake2b(addr.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.size for i in range(NUM_HASHES)]
+
+    def add(self, addr):
+        cells = self.cells
+        for pos in self.get_positions(addr):
+            cells[pos] = 1
+
+    def might_exist(self, addr):
+        """Return False if `addr` certainly has no mailbox."""
+        cells = self.cells
+        if all(cells[pos] for pos in self.get_positions(addr)):
+            FILTER_LOOKUPS.inc(result="present")
+            return True
+        FILTER_LOOKUPS.inc(result="absent")
+        self.rescan_if_due()
+        return False
+
+    def rescan_if_due(self):
+        """Rescan the mailboxes directory in a background thread
+        if `rescan_interval` passed and no rescan is running."""
+        if time.monotonic() - self.checked < self.rescan_interval:
+            return
+        if not self._rescan_lock.acquire(blocking=False):
+            return
+        self.checked = time.monotonic()
+        threading.Thread(target=self.rescan, daemon=True, name="account-filter").start()
+
+    def rescan(self):
+        try:
+            mtime_ns = self.get_mtime_ns()
+            if mtime_ns != self.mtime_ns:
+                self.mtime_ns = mtime_ns
+                count = 0
+                for addr, path in iter_mailbox_dirs(self.mailboxes_dir):
+                    self.add(addr)
+                    count += 1
+                if count > self.capacity:
+                    logging.warning(
+                        f"{count} accounts exceed the account filter capacity "
+                        f"{self.capacity}, restart doveauth to resize it"
+                    )
+        except Exception:
+            logging.exception("rescanning the mailboxes directory failed")
+        finally:
+            self.checked = time.monotonic()
+            self._rescan_lock.release()
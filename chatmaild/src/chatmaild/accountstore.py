@@ -0,0 +1,266 @@
+"""
+Storage of account passwords and last-login times.
+
+The "maildir" store keeps the password in a "password" file
+in each mailbox and the last login as the file's modification time.
+Enumerating accounts thus needs a stat per account.
+
+The "sqlite" store keeps both in an SQLite database in WAL mode
+with an index on the last-login day, so lookups are a single indexed query
+and inactive accounts are found without walking the mailboxes directory.
+Accounts which are not in the database yet are looked up
+in their password file and imported on first use,
+so an existing relay can switch to it without a migration step;
+the next full chatmail-expire walk imports all remaining accounts
+and marks the import complete, until then enumerating accounts
+also lists the mailboxes directory.
+Mailbox directories are created with both stores.
+"""
+
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from .filedict import create_bytes_exclusive, write_bytes_atomic
+from .mailboxes import iter_mailbox_dirs
+from .metrics import REGISTRY
+from .tracing import stage
+from .user import FS_OPS
+
+DB_OPS = REGISTRY.counter(
+    "chatmail_account_db_ops_total",
+    "Queries of the sqlite account store.",
+    ["op"],
+)
+
+MAILDIR = "maildir"
+SQLITE = "sqlite"
+STORES = (MAILDIR, SQLITE)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS accounts (
+    addr TEXT PRIMARY KEY,
+    password TEXT NOT NULL,
+    last_login INTEGER NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS accounts_last_login ON accounts (last_login);
+"""
+
+# stored as the database's user_version after all accounts were imported
+IMPORTED_VERSION = 1
+
+
+class MaildirStore:
+    """Account state in the password file of each mailbox."""
+
+    # expire and fsreport read last logins while scanning mailboxes
+    indexed = False
+
+    def __init__(self, mailboxes_dir):
+        self.mailboxes_dir = mailboxes_dir
+
+    def get_password(self, user):
+        FS_OPS.inc(op="read_password")
+        try:
+            with stage("read"):
+                return user.password_path.read_text()
+        except FileNotFoundError:
+            return None
+
+    def set_password(self, user, enc_password):
+        FS_OPS.inc(op="write_password")
+        try:
+            write_bytes_atomic(user.password_path, enc_password.encode("ascii"))
+        except PermissionError:
+            logging.error(f"could not write password for: {user.addr}")
+            raise
+
+    def create(self, user, enc_password):
+        """Set the password unless the account exists, return True if created."""
+        FS_OPS.inc(op="write_password")
+        return create_bytes_exclusive(user.password_path, enc_password.encode("ascii"))
+
+    def get_stamp(self, user):
+        """Return a value which changes when the account changes,
+        None if it does not exist."""
+        try:
+            st = os.stat(user.password_path)
+        except FileNotFoundError:
+            return None
+        return (st.st_ino, st.st_mtime_ns)
+
+    def get_last_login(self, user):
+        FS_OPS.inc(op="stat")
+        try:
+            return int(user.password_path.stat().st_mtime)
+        except FileNotFoundError:
+            return None
+
+    def set_last_login(self, user, timestamp):
+        FS_OPS.inc(op="stat")
+        try:
+            with stage("read"):
+                mtime = int(os.stat(user.password_path).st_mtime)
+        except FileNotFoundError:
+            logging.error(f"Can not get last login timestamp for {user.addr}")
+            return
+        if mtime != timestamp:
+            FS_OPS.inc(op="utime")
+            with stage("write"):
+                os.utime(user.password_path, (timestamp, timestamp))
+
+    def remove(self, addr):
+        """Forget `addr`, its password file is removed with its mailbox."""
+
+    def iter_addrs(self):
+        for addr, path in iter_mailbox_dirs(self.mailboxes_dir):
+            yield addr
+
+    def iter_inactive_addrs(self, cutoff):
+        """Yield the addresses whose last login is before `cutoff`."""
+        for addr, path in iter_mailbox_dirs(self.mailboxes_dir):
+            try:
+                mtime = os.stat(os.path.join(path, "password")).st_mtime
+            except FileNotFoundError:
+                continue
+            if mtime < cutoff:
+                yield addr
+
+
+class SQLiteStore:
+    """Account state in an SQLite database at `path`,
+    importing accounts from the `fallback` store on first use."""
+
+    indexed = True
+
+    def __init__(self, path, fallback=None):
+        self.path = path
+        self.fallback = fallback
+        self._local = threading.local()
+        self._pid = None
+        with self.get_connection() as conn:
+            conn.executescript(SCHEMA)
+
+    def get_connection(self):
+        # connections must neither be shared between threads nor forked processes
+        if self._pid != os.getpid():
+            self._local = threading.local()
+            self._pid = os.getpid()
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def execute(self, op, sql, params=()):
+        DB_OPS.inc(op=op)
+        with stage(op):
+            return self.get_connection().execute(sql, params)
+
+    def get_row(self, user):
+        row = self.execute(
+            "read",
+            "SELECT password, last_login FROM accounts WHERE addr = ?",
+            (user.addr,),
+        ).fetchone()
+        if row is None and self.fallback is not None:
+            row = self.import_account(user)
+        return row
+
+    def import_account(self, user):
+        password = self.fallback.get_password(user)
+        if password is None:
+            return None
+        last_login = self.fallback.get_last_login(user) or int(time.time())
+        self.execute(
+            "write",
+            "INSERT OR IGNORE INTO accounts (addr, password, last_login)"
+            " VALUES (?, ?, ?)",
+            (user.addr, password, last_login),
+        )
+        return (password, last_login)
+
+    def get_password(self, user):
+        row = self.get_row(user)
+        return None if row is None else row[0]
+
+    def set_password(self, user, enc_password):
+        self.execute(
+            "write",
+            "INSERT INTO accounts (addr, password, last_login) VALUES (?, ?, ?)"
+            " ON CONFLICT (addr) DO UPDATE SET password = excluded.password",
+            (user.addr, enc_password, int(time.time())),
+        )
+
+    def create(self, user, enc_password):
+        if self.get_row(user) is not None:
+            return False
+        cursor = self.execute(
+            "write",
+            "INSERT OR IGNORE INTO accounts (addr, password, last_login)"
+            " VALUES (?, ?, ?)",
+            (user.addr, enc_password, int(time.time())),
+        )
+        return cursor.rowcount == 1
+
+    def get_stamp(self, user):
+        return self.get_password(user)
+
+    def get_last_login(self, user):
+        row = self.get_row(user)
+        return None if row is None else row[1]
+
+    def set_last_login(self, user, timestamp):
+        if self.get_row(user) is None:
+            logging.error(f"Can not get last login timestamp for {user.addr}")
+            return
+        self.execute(
+            "write",
+            "UPDATE accounts SET last_login = ? WHERE addr = ? AND last_login != ?",
+            (timestamp, user.addr, timestamp),
+        )
+
+    def remove(self, addr):
+        self.execute("write", "DELETE FROM accounts WHERE addr = ?", (addr,))
+
+    def iter_rows(self, sql, params=()):
+        # a separate connection, the caller may query the store while iterating
+        DB_OPS.inc(op="scan")
+        conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+        try:
+            yield from conn.execute(sql, params)
+        finally:
+            conn.close()
+
+    def is_imported(self):
+        conn = self.get_connection()
+        return conn.execute("PRAGMA user_version").fetchone()[0] >= IMPORTED_VERSION
+
+    def mark_imported(self):
+        """Record that all accounts of the fallback store were imported."""
+        self.get_connection().execute(f"PRAGMA user_version = {IMPORTED_VERSION}")
+
+    def iter_addrs(self):
+        """Yield the addresses in the database and, until the import
+        is complete, those of the fallback store which are not in it yet."""
+        if self.fallback is None or self.is_imported():
+            for (addr,) in self.iter_rows("SELECT addr FROM accounts"):
+                yield addr
+            return
+        seen = set()
+        for (addr,) in self.iter_rows("SELECT addr FROM accounts"):
+            seen.add(addr)
+            yield addr
+        for addr in self.fallback.iter_addrs():
+            if addr not in seen:
+                yield addr
+
+    def iter_inactive_addrs(self, cutoff):
+        """Yield the addresses whose last login is before `cutoff`."""
+        sql = "SELECT addr FROM accounts WHERE last_login < ?"
+        for (addr,) in self.iter_rows(sql, (cutoff,)):
+            yield addr
@@ -0,0 +1,91 @@
+"""
+Bounded LRU cache of the userdb/passdb replies of doveauth.
+
+Dovecot looks up the userdb for every recipient of every delivered message.
+A cached reply is returned without any syscall for `ttl` seconds,
+afterwards the reply is reloaded if the account changed or is gone,
+e.g. with the maildir account store if the password file's inode
+or mtime changed, see `User.get_stamp()`.
+`chatmail-expire` additionally invalidates deleted mailboxes
+through the control socket of doveauth.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+from .metrics import REGISTRY
+
+CACHE_LOOKUPS = REGISTRY.counter(
+    "chatmail_userdb_cache_lookups_total",
+    "Userdb cache lookups by result (hit, miss, stale).",
+    ["result"],
+)
+CACHE_SIZE = REGISTRY.gauge(
+    "chatmail_userdb_cache_entries",
+    "Number of addresses in the userdb cache.",
+)
+
+
+class _Entry:
+    __slots__ = ("reply", "stamp", "checked")
+
+    def __init__(self, reply, stamp, checked):
+        self.reply = reply
+        self.stamp = stamp
+        self.checked = checked
+
+
+class UserdbCache:
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        CACHE_SIZE.set_function(lambda: len(self._entries))
+
+    def get(self, user):
+        """Return the cached reply for `user` or None."""
+        if not self.maxsize:
+            return None
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user.addr)
+            if entry is None:
+                CACHE_LOOKUPS.inc(result="miss")
+                return None
+            self._entries.move_to_end(user.addr)
+            if now - entry.checked < self.ttl:
+                CACHE_LOOKUPS.inc(result="hit")
+                return entry.reply
+
+        stamp = user.get_stamp()
+        with self._lock:
+            if self._entries.get(user.addr) is not entry:
+                # invalidated or replaced while the stamp was read
+                CACHE_LOOKUPS.inc(result="stale")
+                return None
+            if stamp is None or stamp != entry.stamp:
+                del self._entries[user.addr]
+                CACHE_LOOKUPS.inc(result="stale")
+                return None
+            entry.checked = now
+        CACHE_LOOKUPS.inc(result="hit")
+        return entry.reply
+
+    def put(self, user, stamp, reply):
+        """Cache `reply` of `user` whose account had `stamp`
+        before it was read."""
+        if not self.maxsize:
+            return
+        entry = _Entry(reply, stamp, time.monotonic())
+        with self._lock:
+            self._entries[user.addr] = entry
+            self._entries.move_to_end(user.addr)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, addr):
+        """Remove `addr` from the cache and return True if it was cached."""
+        with self._lock:
+            return self._entries.pop(addr, None) is not None
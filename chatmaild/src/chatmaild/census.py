@@ -0,0 +1,194 @@
+"""
+Census of all mailboxes with one record per account.
+
+Each record holds the last-login day, the number and total size
+of messages and the modification time of the oldest message,
+in an SQLite database in WAL mode next to the mailboxes.
+Account creation and last-login updates, quota-expire
+and chatmail-expire keep the records up to date incrementally,
+deliveries are not tracked and counted on the next chatmail-expire visit.
+
+The census is only trusted after chatmail-expire walked all mailboxes once
+and marked it complete. From then on chatmail-expire only visits
+the mailboxes which may need work, chatmail-fsreport --census
+reads the records instead of the file system and doveauth
+iterates the addresses without listing the mailboxes directory.
+Records lost to failed writes are added again by a full walk
+which chatmail-expire repeats every FULL_WALK_INTERVAL.
+"""
+
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+
+from .metrics import REGISTRY
+from .tracing import stage
+
+CENSUS_OPS = REGISTRY.counter(
+    "chatmail_census_ops_total",
+    "Queries of the mailbox census by operation.",
+    ["op"],
+)
+
+CensusRecord = namedtuple(
+    "CensusRecord", ("addr", "last_login", "messages", "bytes", "oldest", "scanned")
+)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS census (
+    addr TEXT PRIMARY KEY,
+    last_login INTEGER,
+    messages INTEGER NOT NULL DEFAULT 0,
+    bytes INTEGER NOT NULL DEFAULT 0,
+    oldest INTEGER,
+    scanned INTEGER
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS census_last_login ON census (last_login);
+CREATE INDEX IF NOT EXISTS census_oldest ON census (oldest);
+CREATE INDEX IF NOT EXISTS census_scanned ON census (scanned);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value INTEGER
+) WITHOUT ROWID;
+"""
+
+# stored as the database's user_version after a full walk of all mailboxes
+COMPLETE_VERSION = 1
+
+# seconds after which chatmail-expire walks all mailboxes again
+FULL_WALK_INTERVAL = 7 * 86400
+
+
+def summarize_messages(sizes_and_mtimes):
+    """Return (messages, bytes, oldest) of (size, mtime) pairs."""
+    messages = total = 0
+    oldest = None
+    for size, mtime in sizes_and_mtimes:
+        messages += 1
+        total += size
+        if oldest is None or mtime < oldest:
+            oldest = int(mtime)
+    return messages, total, oldest
+
+
+class Census:
+    """Mailbox census in the SQLite database at `path`.
+
+    Failing writes are logged and ignored,
+    they must not make logins or account creation fail.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._pid = None
+        with self.get_connection() as conn:
+            conn.executescript(SCHEMA)
+
+    def get_connection(self):
+        # connections must neither be shared between threads nor forked processes
+        if self._pid != os.getpid():
+            self._local = threading.local()
+            self._pid = os.getpid()
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def write(self, op, sql, params=()):
+        CENSUS_OPS.inc(op=op)
+        try:
+            with stage("census"):
+                self.get_connection().execute(sql, params)
+        except sqlite3.Error as e:
+            logging.warning(f"could not update mailbox census ({op}): {e}")
+
+    def is_complete(self):
+        conn = self.get_connection()
+        return conn.execute("PRAGMA user_version").fetchone()[0] >= COMPLETE_VERSION
+
+    def mark_complete(self):
+        """Record that all mailboxes were just walked."""
+        conn = self.get_connection()
+        conn.execute(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES ('full_walk', ?)",
+            (int(time.time()),),
+        )
+        conn.execute(f"PRAGMA user_version = {COMPLETE_VERSION}")
+
+    def needs_full_walk(self, interval=FULL_WALK_INTERVAL):
+        """Return True if the census is not complete
+        or its last full walk is more than `interval` seconds ago."""
+        if not self.is_complete():
+            return True
+        conn = self.get_connection()
+        row = conn.execute("SELECT value FROM meta WHERE key = 'full_walk'").fetchone()
+        return row is None or row[0] < time.time() - interval
+
+    def add_account(self, addr, last_login):
+        self.write(
+            "add",
+            "INSERT OR IGNORE INTO census (addr, last_login, scanned) VALUES (?, ?, ?)",
+            (addr, last_login, int(time.time())),
+        )
+
+    def set_last_login(self, addr, last_login):
+        # accounts without a record are added by the next full walk
+        self.write(
+            "last_login",
+            "UPDATE census SET last_login = ? WHERE addr = ? AND last_login IS NOT ?",
+            (last_login, addr, last_login),
+        )
+
+    def set_messages(self, addr, last_login, messages, total, oldest):
+        """Record the result of counting the messages of a mailbox."""
+        self.write(
+            "scan",
+            "INSERT INTO census"
+            " (addr, last_login, messages, bytes, oldest, scanned)"
+            " VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (addr) DO UPDATE SET"
+            " last_login = coalesce(excluded.last_login, last_login),"
+            " messages = excluded.messages, bytes = excluded.bytes,"
+            " oldest = excluded.oldest, scanned = excluded.scanned",
+            (addr, last_login, messages, total, oldest, int(time.time())),
+        )
+
+    def remove(self, addr):
+        self.write("remove", "DELETE FROM census WHERE addr = ?", (addr,))
+
+    def iter_rows(self, sql, params=()):
+        # a separate connection, the caller may update records while iterating
+        CENSUS_OPS.inc(op="iterate")
+        conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+        try:
+            yield from conn.execute(sql, params)
+        finally:
+            conn.close()
+
+    def iter_records(self):
+        sql = f"SELECT {', '.join(CensusRecord._fields)} FROM census"
+        for row in self.iter_rows(sql):
+            yield CensusRecord(*row)
+
+    def iter_addrs(self):
+        for (addr,) in self.iter_rows("SELECT addr FROM census"):
+            yield addr
+
+    def iter_due_addrs(self, login_cutoff, mails_cutoff, rescan_cutoff, max_bytes):
+        """Yield the addresses whose mailbox may need expiry:
+        not logged in since `login_cutoff`, holding a message older than
+        `mails_cutoff` or more than `max_bytes`, or not scanned since
+        `rescan_cutoff` because deliveries since then are unknown."""
+        sql = (
+            "SELECT addr FROM census WHERE last_login < ? OR oldest < ?"
+            " OR bytes > ? OR scanned IS NULL OR scanned < ?"
+        )
+        params = (login_cutoff, mails_cutoff, max_bytes, rescan_cutoff)
+        for (addr,) in self.iter_rows(sql, params):
+            yield addr
@@ -3,6 +3,9 @@ from pathlib import Path
 
 import iniconfig
 
+from chatmaild.accountstore import SQLITE, STORES, MaildirStore, SQLiteStore
+from chatmaild.census import Census
+from chatmaild.mailboxes import LAYOUTS, SHARDED, get_mailbox_dir
 from chatmaild.user import User
 
 
@@ -84,6 +87,28 @@ class Config:
         )
         self.max_imap_connections = int(params.pop("max_imap_connections", 10000))
         self.max_smtp_connections = int(params.pop("max_smtp_connections", 1000))
+        self.dictproxy_engine = params.pop("dictproxy_engine", "threads").strip()
+        if self.dictproxy_engine not in ("threads", "asyncio"):
+            raise ValueError("dictproxy_engine must be 'threads' or 'asyncio'")
+        self.dictproxy_max_workers = int(params.pop("dictproxy_max_workers", 32))
+        self.dictproxy_processes = int(params.pop("dictproxy_processes", 1))
+        self.max_creations_per_second = float(
+            params.pop("max_creations_per_second", 10)
+        )
+        self.creation_burst = int(params.pop("creation_burst", 50))
+        self.max_creation_delay = float(params.pop("max_creation_delay", 2))
+        self.login_lane_concurrency = int(params.pop("login_lane_concurrency", 0))
+        self.create_lane_concurrency = int(params.pop("create_lane_concurrency", 4))
+        self.create_lane_queue = int(params.pop("create_lane_queue", 16))
+        self.password_hash_processes = int(params.pop("password_hash_processes", 2))
+        self.password_hash_queue = int(params.pop("password_hash_queue", 64))
+        self.userdb_cache_size = int(params.pop("userdb_cache_size", 100000))
+        self.userdb_cache_ttl = float(params.pop("userdb_cache_ttl", 10))
+        self.userdb_filter_capacity = int(params.pop("userdb_filter_capacity", 0))
+        self.dictproxy_trace_sample_rate = float(
+            params.pop("dictproxy_trace_sample_rate", 0.01)
+        )
+        self.metrics_textfile_dir = params.pop("metrics_textfile_dir", "").strip()
 
         # TLS certificate management.
         # If tls_external_cert_and_key is set, use externally managed certs.
@@ -113,6 +138,24 @@ class Config:
         # deprecated option
         mbdir = params.pop("mailboxes_dir", f"/home/vmail/mail/{raw_domain}")
         self.mailboxes_dir = Path(mbdir.strip())
+        self.mailboxes_layout = params.pop("mailboxes_layout", "flat").strip()
+        if self.mailboxes_layout not in LAYOUTS:
+            raise ValueError(
+                f"mailboxes_layout must be one of {LAYOUTS}: {self.mailboxes_layout!r}"
+            )
+
+        self.account_store = params.pop("account_store", "maildir").strip()
+        if self.account_store not in STORES:
+            raise ValueError(
+                f"account_store must be one of {STORES}: {self.account_store!r}"
+            )
+        self.account_db_path = Path(
+            params.pop("account_db_path", self.mailboxes_dir / "accounts.sqlite")
+        )
+        self._account_store = None
+        self.mailbox_census = params.pop("mailbox_census", "false").lower() == "true"
+        self._census = None
+        self.metadata_log_size = int(params.pop("metadata_log_size", 0))
 
         # old unused option (except for first migration from sqlite to maildir store)
         self.passdb_path = Path(params.pop("passdb_path", "/home/vmail/passdb.sqlite"))
@@ -126,14 +169,45 @@ class Config:
     def _getbytefile(self):
         return open(self._inipath, "rb")
 
+    def get_mailbox_dir(self, addr):
+        return get_mailbox_dir(
+            self.mailboxes_dir,
+            addr,
+            self.mailboxes_layout,
+            # mailboxes may still be at their flat location until they were moved
+            flat_fallback=self.mailboxes_layout == SHARDED,
+        )
+
+    def get_account_store(self):
+        if self._account_store is None:
+            store = MaildirStore(self.mailboxes_dir)
+            if self.account_store == SQLITE:
+                store = SQLiteStore(self.account_db_path, fallback=store)
+            self._account_store = store
+        return self._account_store
+
+    def get_census(self):
+        """Return the mailbox census or None if it is disabled."""
+        if self._census is None and self.mailbox_census:
+            self._census = Census(self.mailboxes_dir / "census.sqlite")
+        return self._census
+
     def get_user(self, addr) -> User:
         if not addr or "@" not in addr or "/" in addr:
             raise ValueError(f"invalid address {addr!r}")
 
-        maildir = self.mailboxes_dir.joinpath(addr)
+        maildir = self.get_mailbox_dir(addr)
         password_path = maildir.joinpath("password")
 
-        return User(maildir, addr, password_path, uid="vmail", gid="vmail")
+        return User(
+            maildir,
+            addr,
+            password_path,
+            uid="vmail",
+            gid="vmail",
+            store=self.get_account_store(),
+            census=self.get_census(),
+        )
 
 
 def parse_size_mb(limit):
@@ -0,0 +1,262 @@
+"""
+Control socket for inspecting long-running chatmaild services.
+
+Each serving process listens on a unix socket in the runtime directory
+of its service, e.g. /run/doveauth/doveauth.control
+(worker processes N>0 of a pre-forked service use doveauth-N.control).
+Commands are single lines, replies are one line starting with
+"O" on success or "F" on failure:
+
+    python -m chatmaild.control /run/doveauth/doveauth.control stacks
+
+writes the stacks of all threads to /run/doveauth/doveauth-stacks-<pid>.txt
+
+    python -m chatmaild.control /run/doveauth/doveauth.control profile 30
+
+samples the stacks of all threads for 30 seconds
+and writes the most frequent ones to doveauth-profile-<pid>.txt
+
+    python -m chatmaild.control /run/doveauth/doveauth.control tracemalloc start
+    python -m chatmaild.control /run/doveauth/doveauth.control tracemalloc snapshot
+
+start tracing memory allocations and write the top allocation sites
+to doveauth-tracemalloc-<pid>.txt, "tracemalloc stop" ends tracing.
+
+    python -m chatmaild.control /run/doveauth/doveauth.control trace
+
+writes the sampled request traces like SIGUSR1 does.
+SIGUSR2 dumps the stacks of all threads like the "stacks" command.
+
+All commands run in their own thread, the service keeps serving meanwhile.
+"""
+
+import glob
+import logging
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+import traceback
+import tracemalloc
+from collections import Counter
+from socketserver import StreamRequestHandler, ThreadingUnixStreamServer
+
+from .tracing import TRACER
+
+# seconds between two stack samples of the sampling profiler
+PROFILE_INTERVAL = 0.005
+
+# upper limit for the duration of a profile in seconds
+MAX_PROFILE_SECONDS = 600
+
+# number of entries written by the profile and tracemalloc commands
+REPORT_LIMIT = 50
+
+
+def get_control_socket_path(runtime_dir, service, worker_num=0):
+    name = f"{service}-{worker_num}" if worker_num else service
+    return os.path.join(runtime_dir, f"{name}.control")
+
+
+def format_stacks():
+    """Return the current stack of each thread of this process."""
+    names = {thread.ident: thread.name for thread in threading.enumerate()}
+    lines = []
+    for ident, frame in sys._current_frames().items():
+        lines.append(f"Thread {names.get(ident, '?')} ({ident}):\n")
+        lines.extend(traceback.format_stack(frame))
+        lines.append("\n")
+    return "".join(lines)
+
+
+def sample_profile(seconds, interval=PROFILE_INTERVAL):
+    """Sample the stacks of all other threads for `seconds`
+    and return a report of the most frequent stacks and functions.
+
+    Unlike cProfile this also covers threads which are already running,
+    like the connection threads of the dict proxies.
+    """
+    own_ident = threading.get_ident()
+    stacks = Counter()
+    functions = Counter()
+    num_samples = 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        for ident, top_frame in sys._current_frames().items():
+            if ident == own_ident:
+                continue
+            stack = []
+            frame = top_frame
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_filename}:{code.co_name}")
+                frame = frame.f_back
+            stacks[";".join(reversed(stack))] += 1
+            for entry in set(stack):
+                functions[entry] += 1
+        num_samples += 1
+        time.sleep(interval)
+
+    lines = [f"{num_samples} samples over {seconds} seconds\n\n"]
+    lines.append("samples in function (inclusive):\n")
+    for entry, count in functions.most_common(REPORT_LIMIT):
+        lines.append(f"{count:8d} {entry}\n")
+    # folded stacks can be turned into a flame graph with flamegraph.pl
+    lines.append("\nfolded stacks:\n")
+    for stack, count in stacks.most_common():
+        lines.append(f"{stack} {count}\n")
+    return "".join(lines)
+
+
+def format_tracemalloc_snapshot():
+    snapshot = tracemalloc.take_snapshot()
+    stats = snapshot.statistics("lineno")
+    total = sum(stat.size for stat in stats)
+    lines = [f"total traced: {total / 1024:.1f} KiB\n"]
+    lines.extend(f"{stat}\n" for stat in stats[:REPORT_LIMIT])
+    return "".join(lines)
+
+
+class ControlCommands:
+    """Commands of the control socket, each method returns the reply text.
+
+    Subclasses of DictProxy can provide further commands,
+    see `DictProxy.get_control_commands()`.
+    """
+
+    def __init__(self, runtime_dir, service):
+        self.runtime_dir = runtime_dir
+        self.service = service
+
+    def _get_output_path(self, kind, suffix="txt"):
+        filename = f"{self.service}-{kind}-{os.getpid()}.{suffix}"
+        return os.path.join(self.runtime_dir, filename)
+
+    def _write_output(self, kind, content):
+        path = self._get_output_path(kind)
+        with open(path, "w") as f:
+            f.write(content)
+        return path
+
+    def stacks(self):
+        return self._write_output("stacks", format_stacks())
+
+    def profile(self, seconds="10"):
+        seconds = min(float(seconds), MAX_PROFILE_SECONDS)
+        return self._write_output("profile", sample_profile(seconds))
+
+    def tracemalloc(self, action="snapshot"):
+        if action == "start":
+            tracemalloc.start()
+            return "started"
+        elif action == "stop":
+            tracemalloc.stop()
+            return "stopped"
+        elif action == "snapshot":
+            if not tracemalloc.is_tracing():
+                raise ValueError("tracemalloc is not started")
+            return self._write_output("tracemalloc", format_tracemalloc_snapshot())
+        raise ValueError(f"unknown tracemalloc action: {action!r}")
+
+    def trace(self):
+        path = self._get_output_path("trace", suffix="jsonl")
+        TRACER.dump(path)
+        return path
+
+
+class ControlServer(ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+def start_control_server(path, commands):
+    """Serve the methods of `commands` on the unix socket `path`
+    from a background thread and return the server."""
+
+    class Handler(StreamRequestHandler):
+        def handle(self):
+            for line in self.rfile:
+                name, *args = line.decode().split() or [""]
+                func = getattr(commands, name, None)
+                if name.startswith("_") or not callable(func):
+                    reply = f"Funknown command: {name!r}"
+                else:
+                    try:
+                        reply = f"O{func(*args)}"
+                    except Exception as e:
+                        logging.exception(f"control command {name!r} failed")
+                        reply = f"F{e}"
+                self.wfile.write(reply.replace("\n", " ").encode() + b"\n")
+
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+    server = ControlServer(path, Handler)
+    os.chmod(path, 0o600)
+    threading.Thread(
+        target=server.serve_forever, daemon=True, name="control-server"
+    ).start()
+    return server
+
+
+def send_control_command(path, command, timeout=None):
+    """Send `command` to the control socket at `path` and return the reply.
+
+    Raises OSError if the service is not listening.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(path)
+        sock.sendall(command.encode() + b"\n")
+        with sock.makefile("rb") as rfile:
+            return rfile.readline().decode().rstrip("\n")
+
+
+def broadcast_control_command(runtime_dir, service, command, timeout=10):
+    """Send `command` to the control sockets of all processes of `service`
+    and return the replies of the processes which could be reached."""
+    paths = glob.glob(os.path.join(glob.escape(runtime_dir), f"{service}*.control"))
+    replies = []
+    for path in sorted(paths):
+        try:
+            replies.append(send_control_command(path, command, timeout=timeout))
+        except OSError:
+            continue
+    return replies
+
+
+def install_stack_dump_handler(runtime_dir, service):
+    """Dump the stacks of all threads to `runtime_dir` on SIGUSR2.
+
+    Only possible from the main thread, elsewhere this does nothing.
+    """
+    if threading.current_thread() is not threading.main_thread():
+        return
+    commands = ControlCommands(runtime_dir, service)
+
+    def dump():
+        try:
+            path = commands.stacks()
+        except OSError:
+            logging.exception("failed to dump thread stacks")
+        else:
+            logging.info(f"wrote thread stacks to {path}")
+
+    def on_signal(signum, frame):
+        threading.Thread(target=dump).start()
+
+    signal.signal(signal.SIGUSR2, on_signal)
+
+
+def main(args=None):
+    """Send a command to the control socket of a chatmaild service."""
+    path, *command = sys.argv[1:] if args is None else args
+    reply = send_control_command(path, " ".join(command))
+    print(reply[1:])
+    return 0 if reply.startswith("O") else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,408 @@
+"""
+offline load generator and benchmark for the dict proxies
+
+example invocation:
+
+    python -m chatmaild.dictbench auth
+
+to start the doveauth dict proxy on a temporary unix socket
+with a temporary mailboxes directory, drive it for 10 seconds
+from 20 concurrent connections and print throughput
+and latency percentiles per scenario as JSON
+
+    python -m chatmaild.dictbench metadata --connections 100 --seconds 30
+
+to benchmark the metadata dict proxy with more connections
+
+    python -m chatmaild.dictbench auth --mix login=50,create=50 --engine asyncio
+
+to choose the traffic mix and the serving engine
+
+Results of runs on different versions can be compared
+with the JSON written by `--output`.
+"""
+
+import itertools
+import json
+import os
+import random
+import signal
+import socket
+import tempfile
+import threading
+import time
+from argparse import ArgumentParser
+from pathlib import Path
+
+from chatmaild.config import read_config, write_initial_config
+
+MAIL_DOMAIN = "bench.example.org"
+
+HELLO = "H3\t2\t0\t\tbench\n"
+
+# default traffic mix of each service, scenario name and relative weight
+DEFAULT_MIXES = {
+    "auth": {"login": 80, "userdb": 15, "create": 5},
+    "metadata": {"devicetoken": 30, "messagenew": 60, "lookup": 10},
+    "lastlogin": {"lastlogin": 100},
+}
+
+
+def get_addr(num):
+    # fixed-length localparts which fit the default username length limits
+    digits = ""
+    while num or not digits:
+        num, rest = divmod(num, 36)
+        digits = "0123456789abcdefghijklmnopqrstuvwxyz"[rest] + digits
+    return f"b{digits:0>8}@{MAIL_DOMAIN}"
+
+
+def get_password(addr):
+    return "pw" + addr.split("@")[0] * 2
+
+
+class Scenarios:
+    """Dict protocol requests of each scenario
+    and the number of reply lines they produce."""
+
+    def __init__(self, num_accounts, rng):
+        self.num_accounts = num_accounts
+        self.rng = rng
+        self.tx_ids = itertools.count(1)
+        self.new_accounts = itertools.count(num_accounts)
+
+    def random_addr(self):
+        return get_addr(self.rng.randrange(self.num_accounts))
+
+    def passdb_lookup(self, addr):
+        key = f'shared/passdb/{get_password(addr)}"{addr}'
+        return [f"L{key}\t{addr}\n"], 1
+
+    def transaction(self, addr, *sets):
+        tx = next(self.tx_ids)
+        lines = [f"B{tx}\t{addr}\n"]
+        lines.extend(f"S{tx}\t" + "\t".join(parts) + "\n" for parts in sets)
+        lines.append(f"C{tx}\n")
+        return lines, 1
+
+    def login(self):
+        return self.passdb_lookup(self.random_addr())
+
+    def userdb(self):
+        addr = self.random_addr()
+        return [f"Lshared/userdb/{addr}\t{addr}\n"], 1
+
+    def create(self):
+        # a new account hits password hashing and mkdir
+        return self.passdb_lookup(get_addr(next(self.new_accounts)))
+
+    def devicetoken(self):
+        token = f"token{self.rng.randrange(1 << 32):x}"
+        return self.transaction(self.random_addr(), ("priv/guid00/devicetoken", token))
+
+    def messagenew(self):
+        return self.transaction(self.random_addr(), ("priv/guid00/messagenew",))
+
+    def lookup(self):
+        addr = self.random_addr()
+        return [f"Lpriv/guid00/devicetoken\t{addr}\n"], 1
+
+    def lastlogin(self):
+        addr = self.random_addr()
+        timestamp = str(int(time.time()))
+        return self.transaction(addr, (f"shared/last-login/{addr}", timestamp))
+
+
+def parse_mix(value):
+    """Parse a traffic mix like "login=80,create=20"."""
+    mix = {}
+    for item in value.split(","):
+        name, weight = item.split("=")
+        mix[name.strip()] = int(weight)
+    return mix
+
+
+def make_config(basedir, engine, max_workers, processes):
+    mailboxes_dir = basedir.joinpath("vmail", MAIL_DOMAIN)
+    mailboxes_dir.mkdir(parents=True)
+    inipath = basedir.joinpath("chatmail.ini")
+    overrides = dict(
+        mailboxes_dir=str(mailboxes_dir),
+        dictproxy_engine=engine,
+        dictproxy_max_workers=str(max_workers),
+        dictproxy_processes=str(processes),
+        # the benchmark itself loads the machine
+        max_load_1m="99999",
+        min_available_memory="0",
+        min_free_disk_space="0",
+        # measure account creation itself, not the rate limit
+        max_creations_per_second="0",
+    )
+    write_initial_config(inipath, MAIL_DOMAIN, overrides=overrides)
+    return read_config(inipath)
+
+
+def make_dictproxy(service, config):
+    """Return the dict proxy of `service`.
+
+    Notifications are only queued, never sent to the notification server.
+    """
+    if service == "auth":
+        from chatmaild.doveauth import AuthDictProxy
+
+        return AuthDictProxy(config=config)
+    elif service == "lastlogin":
+        from chatmaild.lastlogin import LastLoginDictProxy
+
+        return LastLoginDictProxy(config=config)
+    elif service == "metadata":
+        from chatmaild.metadata import Metadata, MetadataDictProxy
+        from chatmaild.notifier import Notifier
+
+        queue_dir = config.mailboxes_dir.joinpath("pending_notifications")
+        queue_dir.mkdir(exist_ok=True)
+        return MetadataDictProxy(
+            notifier=Notifier(queue_dir),
+            metadata=Metadata(config.mailboxes_dir, config.get_mailbox_dir),
+            iroh_relay="https://iroh.example.org",
+            turn_hostname=MAIL_DOMAIN,
+        )
+    raise ValueError(f"unknown service: {service!r}")
+
+
+def create_accounts(service, config, num_accounts):
+    """Create the accounts used by the scenarios before starting the server."""
+    from chatmaild.doveauth import AuthDictProxy
+    from chatmaild.metadata import Metadata
+
+    authproxy = AuthDictProxy(config=config)
+    metadata = Metadata(config.mailboxes_dir, config.get_mailbox_dir)
+    for num in range(num_accounts):
+        addr = get_addr(num)
+        if not authproxy.lookup_passdb(addr, get_password(addr)):
+            raise RuntimeError(f"could not create account {addr}")
+        if service == "metadata":
+            metadata.add_token_to_addr(addr, f"token{num}")
+    # stop the password hashing processes which would outlive the benchmark
+    authproxy.stop_serving()
+
+
+def start_server(service, config, sock_path):
+    """Fork a process serving the dict proxy of `service` on `sock_path`.
+
+    The server runs in its own process group with all processes it starts,
+    see `stop_server`.
+    """
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.setpgid(0, 0)
+            dictproxy = make_dictproxy(service, config)
+            # stops the password hashing processes when serving ends
+            dictproxy.serve_forever(str(sock_path), config)
+        finally:
+            os._exit(0)
+
+    deadline = time.time() + 10
+    while True:
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                sock.connect(str(sock_path))
+            return pid
+        except (FileNotFoundError, ConnectionRefusedError):
+            if time.time() > deadline:
+                stop_server(pid)
+                raise RuntimeError(f"dict proxy did not listen on {sock_path}")
+            time.sleep(0.01)
+
+
+def stop_server(pid, timeout=10):
+    os.kill(pid, signal.SIGTERM)
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if os.waitpid(pid, os.WNOHANG) != (0, 0):
+            break
+        time.sleep(0.05)
+    else:
+        os.kill(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
+    # left over processes would keep the caller's stdout open
+    try:
+        os.killpg(pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+class Client(threading.Thread):
+    """One Dovecot connection issuing requests of a random scenario
+    one after another until `deadline`.
+
+    Replies other than "O" are counted as errors.
+    """
+
+    def __init__(self, sock_path, scenarios, mix, deadline):
+        super().__init__(daemon=True)
+        self.sock_path = sock_path
+        self.scenarios = scenarios
+        self.names = list(mix)
+        self.weights = list(mix.values())
+        self.deadline = deadline
+        self.latencies = {name: [] for name in self.names}
+        self.errors = {name: 0 for name in self.names}
+        self.exception = None
+
+    def run(self):
+        try:
+            self.drive()
+        except Exception as e:
+            self.exception = e
+
+    def drive(self):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(str(self.sock_path))
+            rfile = sock.makefile("rb")
+            sock.sendall(HELLO.encode())
+            rng = self.scenarios.rng
+            while time.perf_counter() < self.deadline:
+                name = rng.choices(self.names, self.weights)[0]
+                lines, num_replies = getattr(self.scenarios, name)()
+                start = time.perf_counter()
+                sock.sendall("".join(lines).encode())
+                for _ in range(num_replies):
+                    reply = rfile.readline()
+                    if not reply:
+                        raise ConnectionError("dict proxy closed the connection")
+                    if reply[:1] != b"O":
+                        self.errors[name] += 1
+                self.latencies[name].append(time.perf_counter() - start)
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(q * len(sorted_values)))
+    return sorted_values[index]
+
+
+def summarize(latencies, errors, seconds):
+    latencies = sorted(latencies)
+
+    def ms(value):
+        return None if value is None else round(value * 1000, 3)
+
+    return dict(
+        requests=len(latencies),
+        errors=errors,
+        throughput=round(len(latencies) / seconds, 1),
+        p50_ms=ms(percentile(latencies, 0.5)),
+        p90_ms=ms(percentile(latencies, 0.9)),
+        p99_ms=ms(percentile(latencies, 0.99)),
+        max_ms=ms(latencies[-1] if latencies else None),
+    )
+
+
+def run_benchmark(
+    service,
+    mix=None,
+    connections=20,
+    seconds=10.0,
+    accounts=200,
+    engine="threads",
+    max_workers=32,
+    processes=1,
+    seed=0,
+):
+    """Benchmark the dict proxy of `service` and return the results as a dict."""
+    mix = mix or DEFAULT_MIXES[service]
+    for name in mix:
+        if not hasattr(Scenarios, name):
+            raise ValueError(f"unknown scenario: {name!r}")
+
+    with tempfile.TemporaryDirectory(prefix="chatmail-dictbench-") as tmpdir:
+        basedir = Path(tmpdir)
+        config = make_config(basedir, engine, max_workers, processes)
+        create_accounts(service, config, accounts)
+        sock_path = basedir.joinpath(f"{service}.socket")
+        pid = start_server(service, config, sock_path)
+        try:
+            start = time.perf_counter()
+            deadline = start + seconds
+            clients = []
+            for num in range(connections):
+                # disjoint new account numbers for each client
+                scenarios = Scenarios(accounts, random.Random(seed + num))
+                scenarios.new_accounts = itertools.count((num + 1) * 1000000)
+                clients.append(Client(sock_path, scenarios, mix, deadline))
+            for client in clients:
+                client.start()
+            for client in clients:
+                client.join()
+                if client.exception is not None:
+                    raise client.exception
+            elapsed = time.perf_counter() - start
+        finally:
+            stop_server(pid)
+
+    results = {}
+    all_latencies = []
+    for name in mix:
+        latencies = [x for client in clients for x in client.latencies[name]]
+        errors = sum(client.errors[name] for client in clients)
+        results[name] = summarize(latencies, errors, elapsed)
+        all_latencies.extend(latencies)
+
+    return dict(
+        service=service,
+        engine=engine,
+        max_workers=max_workers,
+        processes=processes,
+        connections=connections,
+        seconds=round(elapsed, 3),
+        mix=mix,
+        total=summarize(
+            all_latencies, sum(r["errors"] for r in results.values()), elapsed
+        ),
+        scenarios=results,
+    )
+
+
+def main(args=None):
+    """Run a dict proxy benchmark and print its results as JSON."""
+    parser = ArgumentParser(description=main.__doc__)
+    parser.add_argument("service", choices=sorted(DEFAULT_MIXES))
+    parser.add_argument(
+        "--mix",
+        type=parse_mix,
+        help="traffic mix as scenario=weight pairs, e.g. login=80,create=20",
+    )
+    parser.add_argument("--connections", type=int, default=20)
+    parser.add_argument("--seconds", type=float, default=10.0)
+    parser.add_argument(
+        "--accounts", type=int, default=200, help="number of pre-created accounts"
+    )
+    parser.add_argument("--engine", choices=["threads", "asyncio"], default="threads")
+    parser.add_argument("--max-workers", type=int, default=32)
+    parser.add_argument("--processes", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="also write results to this file")
+    args = parser.parse_args(args)
+
+    results = run_benchmark(
+        args.service,
+        mix=args.mix,
+        connections=args.connections,
+        seconds=args.seconds,
+        accounts=args.accounts,
+        engine=args.engine,
+        max_workers=args.max_workers,
+        processes=args.processes,
+        seed=args.seed,
+    )
+    content = json.dumps(results, indent=2)
+    print(content)
+    if args.output:
+        Path(args.output).write_text(content + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""
+Bytes-level reading of Dovecot dict protocol requests.
+
+Requests are read in large chunks and split into lines in one go
+instead of issuing one readline() call per request.
+Consecutive lookups pipelined by Dovecot are grouped
+so that they can be handled concurrently.
+"""
+
+# number of bytes read from a connection at once
+READ_SIZE = 65536
+
+
+class LineBuffer:
+    """Split a stream of received chunks into request lines."""
+
+    def __init__(self):
+        self._pending = b""
+
+    def feed(self, data):
+        """Return the list of lines completed by `data`, without newlines."""
+        if self._pending:
+            data = self._pending + data
+        lines = data.split(b"\n")
+        self._pending = lines.pop()
+        return lines
+
+    def finish(self):
+        """Return an unterminated last line at end of stream, if any."""
+        pending, self._pending = self._pending, b""
+        return [pending] if pending else []
+
+
+def iter_request_chunks(rfile):
+    """Yield the list of request lines of each chunk read from `rfile`.
+
+    Replies to all requests of one chunk can be written with a single flush.
+    """
+    read = getattr(rfile, "read1", rfile.read)
+    buffer = LineBuffer()
+    while data := read(READ_SIZE):
+        if lines := buffer.feed(data):
+            yield lines
+    if lines := buffer.finish():
+        yield lines
+
+
+def parse_request(line):
+    """Return the command character and the tab-separated arguments
+    of a request line, or None for an empty line.
+
+    Invalid UTF-8 is replaced, so that a garbled request is handled
+    like an unknown command or address instead of failing the connection.
+    """
+    line = line.strip().decode(errors="replace")
+    if not line:
+        return None
+    return line[0], line[1:].split("\t")
+
+
+def iter_request_groups(lines):
+    """Yield the requests of `lines` as lists which are either
+    a single request or a run of consecutive lookups.
+
+    Lookups don't depend on each other and may be handled concurrently
+    as long as their replies are written in order.
+    None is yielded for an empty line which ends the request stream.
+    """
+    lookups = []
+    for line in lines:
+        request = parse_request(line)
+        if request is not None and request[0] == "L":
+            lookups.append(request)
+            continue
+        if lookups:
+            yield lookups
+            lookups = []
+        yield None if request is None else [request]
+    if lookups:
+        yield lookups
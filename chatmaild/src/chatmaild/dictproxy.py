@@ -1,9 +1,60 @@
+import asyncio
 import logging
 import os
+import signal
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from socketserver import StreamRequestHandler, ThreadingUnixStreamServer
 
+from .control import (
+    ControlCommands,
+    get_control_socket_path,
+    install_stack_dump_handler,
+    start_control_server,
+)
+from .dictprotocol import (
+    READ_SIZE,
+    LineBuffer,
+    iter_request_chunks,
+    iter_request_groups,
+)
+from .metrics import REGISTRY, start_textfile_exporter
+from .prefork import Supervisor
+from .systemd import get_inherited_socket, notify_ready, start_handoff
+from .tracing import TRACER, install_dump_handler
+
+# seconds between queue depth reports of the asyncio engine
+REPORT_INTERVAL = 60
+
+# seconds to wait for requests in progress when shutting down
+DRAIN_TIMEOUT = 20
+
+KNOWN_COMMANDS = "HLIBSCR"
+
+REQUESTS = REGISTRY.counter(
+    "chatmail_dictproxy_requests_total",
+    "Dict requests by command and first character of the reply.",
+    ["command", "reply"],
+)
+REQUEST_SECONDS = REGISTRY.histogram(
+    "chatmail_dictproxy_request_seconds",
+    "Time spent handling dict requests.",
+    ["command"],
+)
+EXECUTOR_QUEUED = REGISTRY.gauge(
+    "chatmail_dictproxy_executor_queued",
+    "Requests of the asyncio engine waiting for a worker thread.",
+)
+
 
 class DictProxy:
+    # maximum number of threads handling pipelined lookups, see handle_requests()
+    pipeline_workers = 8
+    _pipeline_executor = None
+    _pipeline_lock = threading.Lock()
+
     def loop_forever(self, rfile, wfile):
         # Transaction storage is local to each handler loop.
         # Dovecot reuses transaction IDs across connections,
@@ -11,21 +62,69 @@ class DictProxy:
         # on two different connections to the same proxy sometimes.
         transactions = {}
 
-        while True:
-            msg = rfile.readline().strip().decode()
-            if not msg:
-                break
+        for lines in iter_request_chunks(rfile):
+            for requests in iter_request_groups(lines):
+                if requests is None:
+                    return
+
+                for res in self.handle_requests(requests, transactions):
+                    if isinstance(res, str):
+                        wfile.write(res.encode("ascii"))
+                    elif res is not None:
+                        # stream long iteration replies as they are produced
+                        for chunk in res:
+                            wfile.write(chunk.encode("ascii"))
+                            wfile.flush()
+            wfile.flush()
 
-            res = self.handle_dovecot_request(msg, transactions)
-            if res:
-                wfile.write(res.encode("ascii"))
-                wfile.flush()
+    def handle_requests(self, requests, transactions):
+        """Return the replies to a group of requests in order.
+
+        Several pipelined lookups are handled concurrently
+        so that a slow one does not hold up the others.
+        """
+        if len(requests) == 1:
+            return [self.handle_request(*requests[0], transactions)]
+        executor = self.get_pipeline_executor()
+        futures = [
+            executor.submit(self.handle_request, *request, transactions)
+            for request in requests
+        ]
+        return [future.result() for future in futures]
+
+    def get_pipeline_executor(self):
+        with self._pipeline_lock:
+            if self._pipeline_executor is None:
+                self._pipeline_executor = ThreadPoolExecutor(
+                    max_workers=self.pipeline_workers,
+                    thread_name_prefix="dictproxy-pipeline",
+                )
+            return self._pipeline_executor
 
     def handle_dovecot_request(self, msg, transactions):
-        # see https://doc.dovecot.org/2.3/developer_manual/design/dict_protocol/#dovecot-dict-protocol
-        short_command = msg[0]
-        parts = msg[1:].split("\t")
+        return self.handle_request(msg[0], msg[1:].split("\t"), transactions)
+
+    def handle_request(self, short_command, parts, transactions):
+        command = short_command if short_command in KNOWN_COMMANDS else "other"
+        span = TRACER.start_span(short_command, parts, transactions)
+        start = time.perf_counter()
+        res = None
+        try:
+            res = self.dispatch_request(short_command, parts, transactions)
+            return res
+        finally:
+            seconds = time.perf_counter() - start
+            REQUEST_SECONDS.observe(seconds, command=command)
+            if res is None or isinstance(res, str):
+                reply = res[0] if res and res[0] in "ONF" else "none"
+            else:
+                reply = "O"  # streamed iteration reply
+            REQUESTS.inc(command=command, reply=reply)
+            if span is not None:
+                TRACER.finish_span(span, seconds, reply)
 
+    def dispatch_request(self, short_command, parts, transactions):
+        # see https://doc.dovecot.org/2.3/developer_manual/design/dict_protocol/#dovecot-dict-protocol
         if short_command == "L":
             return self.handle_lookup(parts)
         elif short_command == "I":
@@ -33,7 +132,8 @@ class DictProxy:
         elif short_command == "H":
             return  # no version checking
 
-        if short_command not in ("BSC"):
+        if short_command not in ("BSCR"):
+            msg = short_command + "\t".join(parts)
             logging.warning(f"unknown dictproxy request: {msg!r}")
             return
 
@@ -43,11 +143,12 @@ class DictProxy:
             return self.handle_begin_transaction(transaction_id, parts, transactions)
         elif short_command == "C":
             return self.handle_commit_transaction(transaction_id, parts, transactions)
+        elif short_command == "R":
+            # nothing was written yet, dovecot expects no reply
+            transactions.pop(transaction_id, None)
         elif short_command == "S":
-            addr = transactions[transaction_id]["addr"]
-            if not self.handle_set(addr, parts):
-                transactions[transaction_id]["res"] = "F\n"
-                logging.error(f"dictproxy-set failed for {addr!r}: {msg!r}")
+            # applied all at once when the transaction is committed
+            transactions[transaction_id]["sets"].append(parts)
 
     def handle_lookup(self, parts):
         logging.warning(f"lookup ignored: {parts!r}")
@@ -56,11 +157,13 @@ class DictProxy:
     def handle_iterate(self, parts):
         # Empty line means ITER_FINISHED.
         # If we don't return empty line Dovecot will timeout.
+        # Subclasses may return an iterator of reply chunks instead of a string,
+        # each chunk is written to the client as soon as it is produced.
         return "\n"
 
     def handle_begin_transaction(self, transaction_id, parts, transactions):
         addr = parts[1]
-        transactions[transaction_id] = dict(addr=addr, res="O\n")
+        transactions[transaction_id] = dict(addr=addr, sets=[])
 
     def handle_set(self, addr, parts):
         # For documentation on key structure see
@@ -68,31 +171,315 @@ class DictProxy:
         return False
 
     def handle_commit_transaction(self, transaction_id, parts, transactions):
-        # return whatever "set" command(s) set as result.
-        return transactions.pop(transaction_id)["res"]
+        transaction = transactions.pop(transaction_id)
+        if self.handle_commit_sets(transaction["addr"], transaction["sets"]):
+            return "O\n"
+        return "F\n"
+
+    def handle_commit_sets(self, addr, sets):
+        """Apply the "set" commands of a committed transaction
+        and return False if any of them failed.
+
+        Subclasses can override this to apply several sets in one batch.
+        """
+        ok = True
+        for parts in sets:
+            if not self.handle_set(addr, parts):
+                ok = False
+                logging.error(f"dictproxy-set failed for {addr!r}: {parts!r}")
+        return ok
+
+    def serve_forever(self, socket, config, init_worker=None):
+        """Serve the dict protocol on the unix socket path
+        using the engine and number of processes selected in the chatmail config.
+
+        The listening socket is taken over from systemd socket activation
+        or from a process handing over to us if there is one.
+        Sampled request traces are written next to the socket on SIGUSR1,
+        thread stacks on SIGUSR2, and each serving process
+        listens on a control socket there, see `chatmaild.control`.
+        `init_worker(worker_num)` is called in each serving process
+        before it starts accepting connections
+        and `stop_serving()` after it stopped serving or failed to start.
+        """
+        listen_sock = get_inherited_socket() or listen_unix_socket(socket)
+        prefork = config.dictproxy_processes > 1
+        service = os.path.splitext(os.path.basename(socket))[0]
+        runtime_dir = os.path.dirname(os.path.abspath(socket))
+        TRACER.sample_rate = config.dictproxy_trace_sample_rate
+        install_dump_handler(runtime_dir, service)
+        install_stack_dump_handler(runtime_dir, service)
+
+        def handoff():
+            return start_handoff(listen_sock)
+
+        def serve(worker_num):
+            if config.metrics_textfile_dir:
+                start_textfile_exporter(
+                    config.metrics_textfile_dir, service, worker_num
+                )
+            if init_worker is not None:
+                init_worker(worker_num)
+            start_control_server(
+                get_control_socket_path(runtime_dir, service, worker_num),
+                self.get_control_commands(runtime_dir, service),
+            )
+            self.pipeline_workers = config.dictproxy_max_workers
+            # in pre-fork mode the supervisor signals readiness and performs the handoff
+            worker_handoff = None if prefork else handoff
+            if config.dictproxy_engine == "asyncio":
+                self.serve_asyncio(
+                    listen_sock, config.dictproxy_max_workers, worker_handoff
+                )
+            else:
+                self.serve_threads(listen_sock, worker_handoff)
+
+        if prefork:
+            # workers exit with os._exit(), also when serving failed
+            Supervisor(
+                config.dictproxy_processes,
+                serve,
+                handoff=handoff,
+                cleanup=self.stop_serving,
+            ).run()
+        else:
+            try:
+                serve(0)
+            finally:
+                self.stop_serving()
+
+    def stop_serving(self):
+        """Called in a serving process when it stopped serving connections,
+        subclasses can override this to persist buffered state.
+
+        Pre-fork workers exit without running atexit handlers.
+        """
+
+    def get_control_commands(self, runtime_dir, service):
+        return ControlCommands(runtime_dir, service)
 
     def serve_forever_from_socket(self, socket):
+        self.serve_threads(listen_unix_socket(socket))
+
+    def serve_forever_asyncio(self, socket, max_workers):
+        self.serve_asyncio(listen_unix_socket(socket), max_workers)
+
+    def serve_threads(self, listen_sock, handoff=None):
+        """Serve each connection of the listening socket in its own thread.
+
+        On SIGTERM, or on SIGHUP after a successful `handoff()`,
+        stop accepting, let requests in progress finish and close connections.
+        """
         dictproxy = self
+        connections = set()
+        draining = threading.Event()
 
         class Handler(StreamRequestHandler):
             def handle(self):
+                connections.add(self.connection)
                 try:
-                    dictproxy.loop_forever(self.rfile, self.wfile)
+                    if not draining.is_set():
+                        dictproxy.loop_forever(self.rfile, self.wfile)
                 except Exception:
                     logging.exception("Exception in the handler")
                     raise
+                finally:
+                    connections.discard(self.connection)
 
-        try:
-            os.unlink(socket)
-        except FileNotFoundError:
-            pass
+        server = CustomThreadingUnixStreamServer(
+            listen_sock.getsockname(), Handler, bind_and_activate=False
+        )
+        server.socket.close()
+        server.socket = listen_sock
 
-        with CustomThreadingUnixStreamServer(socket, Handler) as server:
+        def drain():
+            logging.info(f"draining {len(connections)} connections")
+            draining.set()
+            server.shutdown()
+            for conn in list(connections):
+                try:
+                    conn.shutdown(socket.SHUT_RD)
+                except OSError:
+                    pass
+
+        install_drain_handlers(drain, handoff)
+        if handoff is not None:
+            notify_ready()
+        with server:
             try:
                 server.serve_forever()
             except KeyboardInterrupt:
                 pass
 
+    def serve_asyncio(self, listen_sock, max_workers, handoff=None):
+        """Serve all connections from a single event loop thread.
+
+        Idle connections only cost a coroutine, blocking request handlers
+        run in a bounded pool of `max_workers` threads.
+        Signals are handled as with `serve_threads()`.
+        """
+        executor = BoundedExecutor(max_workers)
+        EXECUTOR_QUEUED.set_function(lambda: executor.queued)
+        try:
+            asyncio.run(self._serve_asyncio(listen_sock, executor, handoff))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            executor.shutdown()
+
+    async def _serve_asyncio(self, listen_sock, executor, handoff=None):
+        self.num_connections = 0
+        connections = set()
+        draining = asyncio.Event()
+
+        async def handle_connection(reader, writer):
+            self.num_connections += 1
+            connections.add((reader, writer))
+            try:
+                await self.loop_forever_asyncio(reader, writer, executor)
+            except Exception:
+                logging.exception("Exception in the handler")
+            finally:
+                connections.discard((reader, writer))
+                self.num_connections -= 1
+                writer.close()
+
+        async def report_queue_depth():
+            while True:
+                await asyncio.sleep(REPORT_INTERVAL)
+                if executor.queued:
+                    logging.warning(
+                        f"dictproxy queue depth {executor.queued} "
+                        f"({executor.running}/{executor.max_workers} workers busy, "
+                        f"{self.num_connections} connections)"
+                    )
+
+        loop = asyncio.get_running_loop()
+        install_drain_handlers(lambda: loop.call_soon_threadsafe(draining.set), handoff)
+
+        server = await asyncio.start_unix_server(
+            handle_connection,
+            sock=listen_sock,
+            backlog=CustomThreadingUnixStreamServer.request_queue_size,
+        )
+        if handoff is not None:
+            notify_ready()
+        reporter = asyncio.create_task(report_queue_depth())
+        async with server:
+            await draining.wait()
+            logging.info(f"draining {len(connections)} connections")
+            server.close()
+            for reader, writer in connections:
+                # requests already received are still answered
+                writer.transport.pause_reading()
+                reader.feed_eof()
+            deadline = loop.time() + DRAIN_TIMEOUT
+            while connections and loop.time() < deadline:
+                await asyncio.sleep(0.05)
+        reporter.cancel()
+
+    async def loop_forever_asyncio(self, reader, writer, executor):
+        # same as loop_forever() but the handler runs in the executor
+        transactions = {}
+        buffer = LineBuffer()
+
+        while True:
+            data = await reader.read(READ_SIZE)
+            lines = buffer.feed(data) if data else buffer.finish()
+            for requests in iter_request_groups(lines):
+                if requests is None:
+                    return
+
+                replies = await asyncio.gather(
+                    *(
+                        executor.run(self.handle_request, *request, transactions)
+                        for request in requests
+                    )
+                )
+                for res in replies:
+                    if isinstance(res, str):
+                        writer.write(res.encode("ascii"))
+                    elif res is not None:
+                        # chunks may block on the file system, produce them
+                        # in the executor and write them as they arrive
+                        while chunk := await executor.run(next, res, None):
+                            writer.write(chunk.encode("ascii"))
+                            await writer.drain()
+            await writer.drain()
+            if not data:
+                break
+
+
+class BoundedExecutor:
+    """Thread pool for blocking request handlers
+    which tracks how many calls wait for a free worker."""
+
+    def __init__(self, max_workers):
+        self.max_workers = max_workers
+        self.queued = 0
+        self.running = 0
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="dictproxy"
+        )
+
+    def _call(self, func, args):
+        with self._lock:
+            self.queued -= 1
+            self.running += 1
+        try:
+            return func(*args)
+        finally:
+            with self._lock:
+                self.running -= 1
+
+    async def run(self, func, *args):
+        with self._lock:
+            self.queued += 1
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self._call, func, args)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+def install_drain_handlers(drain, handoff=None):
+    """Call `drain()` on SIGTERM, and on SIGHUP after `handoff()` succeeded.
+
+    Handlers run in a separate thread because they block.
+    Signal handlers can only be installed from the main thread,
+    elsewhere (e.g. in tests) this does nothing.
+    """
+    if threading.current_thread() is not threading.main_thread():
+        return
+
+    def handoff_and_drain():
+        if handoff():
+            drain()
+
+    def on_signal(target):
+        return lambda signum, frame: threading.Thread(target=target).start()
+
+    signal.signal(signal.SIGTERM, on_signal(drain))
+    if handoff is not None:
+        signal.signal(signal.SIGHUP, on_signal(handoff_and_drain))
+
+
+def listen_unix_socket(path):
+    """Return a listening unix socket bound to a freshly created `path`."""
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+    listen_sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listen_sock.bind(path)
+    listen_sock.listen(CustomThreadingUnixStreamServer.request_queue_size)
+    # with several processes accepting on the socket
+    # only one of them gets a connection, the others must not block
+    listen_sock.setblocking(False)
+    return listen_sock
+
 
 class CustomThreadingUnixStreamServer(ThreadingUnixStreamServer):
     request_queue_size = 1000
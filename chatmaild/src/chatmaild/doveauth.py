@@ -1,37 +1,31 @@
+import itertools
 import json
 import logging
-import os
 import re
 import sys
+import threading
+from concurrent.futures.process import BrokenProcessPool
 
-import filelock
-
-try:
-    import crypt_r
-except ImportError:
-    import crypt as crypt_r
-
+from .accountfilter import AccountFilter
+from .authcache import UserdbCache
 from .config import Config, read_config
+from .control import ControlCommands
 from .dictproxy import DictProxy
+from .lanes import Lane, LaneFull
 from .migrate_db import migrate_from_db_to_maildir
-from .syslimits import has_sufficient_resources
+from .passhash import HashingOverloaded, PasswordHasher
+from .syslimits import CreationAdmission
+from .tracing import stage
 
 NOCREATE_FILE = "/etc/chatmail-nocreate"
+# number of addresses written at once when iterating the userdb
+ITERATE_CHUNK_SIZE = 1000
 VALID_LOCALPART_RE = re.compile(r"^[a-z0-9._-]+$")
-
-
-def encrypt_password(password: str):
-    # https://doc.dovecot.org/2.3/configuration_manual/authentication/password_schemes/
-    passhash = crypt_r.crypt(password, crypt_r.METHOD_SHA512)
-    return "{SHA512-CRYPT}" + passhash
+ESCAPE_OR_SEPARATOR_RE = re.compile(r'\\(.)|"', re.DOTALL)
 
 
 def is_allowed_to_create(config: Config, user, cleartext_password) -> bool:
     """Return True if user and password are admissable."""
-    if os.path.exists(NOCREATE_FILE):
-        logging.warning(f"blocked account creation because {NOCREATE_FILE!r} exists.")
-        return False
-
     if len(cleartext_password) < config.password_min_length:
         logging.warning(
             "Password needs to be at least %s characters long",
@@ -67,76 +61,182 @@ def is_allowed_to_create(config: Config, user, cleartext_password) -> bool:
 def split_and_unescape(s):
     """Split strings using double quote as a separator and backslash as escape character
     into parts."""
-
-    out = ""
-    i = 0
-    while i < len(s):
-        c = s[i]
-        if c == "\\":
-            # Skip escape character.
-            i += 1
-
-            # This will raise IndexError if there is no character
-            # after escape character. This is expected
-            # as this is an invalid input.
-            out += s[i]
-        elif c == '"':
+    if "\\" not in s:
+        return s.split('"')
+
+    parts = []
+    out = []
+    pos = 0
+    for m in ESCAPE_OR_SEPARATOR_RE.finditer(s):
+        out.append(s[pos : m.start()])
+        pos = m.end()
+        if m.group(1) is None:
             # Separator
-            yield out
-            out = ""
+            parts.append("".join(out))
+            out = []
         else:
-            out += c
-        i += 1
-    yield out
+            out.append(m.group(1))
+
+    tail = s[pos:]
+    if "\\" in tail:
+        # There is no character after the escape character,
+        # this is an invalid input.
+        raise IndexError(f"dangling escape character in {s!r}")
+    out.append(tail)
+    parts.append("".join(out))
+    return parts
+
+
+class AuthControlCommands(ControlCommands):
+    def __init__(self, runtime_dir, service, userdb_cache):
+        super().__init__(runtime_dir, service)
+        self.userdb_cache = userdb_cache
+
+    def invalidate(self, *addrs):
+        """Drop cached replies of addresses, e.g. of deleted mailboxes."""
+        return sum(self.userdb_cache.invalidate(addr) for addr in addrs)
 
 
 class AuthDictProxy(DictProxy):
     def __init__(self, config):
         super().__init__()
         self.config = config
+        self.userdb_cache = UserdbCache(
+            config.userdb_cache_size, config.userdb_cache_ttl
+        )
+        self.password_hasher = PasswordHasher(
+            config.password_hash_processes, config.password_hash_queue
+        )
+        self._admission = None
+        self._admission_lock = threading.Lock()
+        self.account_filter = None
+        if config.userdb_filter_capacity:
+            # built before serve_forever() forks so that workers share it
+            self.account_filter = AccountFilter(
+                config.mailboxes_dir, config.userdb_filter_capacity
+            )
+        self.login_lane = Lane("login", config.login_lane_concurrency)
+        self.create_lane = Lane(
+            "create", config.create_lane_concurrency, config.create_lane_queue
+        )
+
+    def get_admission(self):
+        # started on first use so that its sampler thread runs in the serving process
+        with self._admission_lock:
+            if self._admission is None:
+                self._admission = CreationAdmission(self.config, NOCREATE_FILE)
+            return self._admission
+
+    def stop_serving(self):
+        with self._admission_lock:
+            if self._admission is not None:
+                self._admission.stop()
+        # pre-fork workers exit with os._exit() which leaves child processes
+        self.password_hasher.shutdown()
+
+    def get_control_commands(self, runtime_dir, service):
+        return AuthControlCommands(runtime_dir, service, self.userdb_cache)
 
     def handle_lookup(self, parts):
         # Dovecot <2.3.17 has only one part,
         # do not attempt to read any other parts for compatibility.
         keyname = parts[0]
 
-        namespace, type, args = keyname.split("/", 2)
-        args = list(split_and_unescape(args))
+        with stage("parse"):
+            namespace, type, args = keyname.split("/", 2)
+            args = split_and_unescape(args)
 
         config = self.config
-        reply_command = "F"
-        res = ""
+        reply = None
         if namespace == "shared":
             if type == "userdb":
                 user = args[0]
-                if user.endswith(f"@{config.mail_domain}"):
-                    res = self.lookup_userdb(user)
-                if res:
-                    reply_command = "O"
-                else:
-                    reply_command = "N"
+                if user.endswith(f"@{config.mail_domain}") and self.might_exist(user):
+                    with self.login_lane.enter():
+                        reply = self.lookup_cached(user, self.lookup_userdb)
+                return reply or "N\n"
             elif type == "passdb":
                 user = args[1]
                 if user.endswith(f"@{config.mail_domain}"):
-                    res = self.lookup_passdb(user, cleartext_password=args[0])
-                if res:
-                    reply_command = "O"
-                else:
-                    reply_command = "N"
-        json_res = json.dumps(res) if res else ""
-        return f"{reply_command}{json_res}\n"
+                    reply = self.lookup_or_create(user, cleartext_password=args[0])
+                return reply or "N\n"
+        return "F\n"
+
+    def lookup_or_create(self, addr, cleartext_password):
+        """Return the passdb reply of an existing user from the login lane,
+        otherwise try to create the account in the create lane."""
+        if self.might_exist(addr):
+            with self.login_lane.enter():
+                reply = self.lookup_cached(addr, self.lookup_userdb)
+            if reply is not None:
+                return reply
+        try:
+            with self.create_lane.enter():
+                return self.lookup_cached(addr, self.lookup_passdb, cleartext_password)
+        except LaneFull as e:
+            logging.warning(f"registration rejected: {e}")
+            return None
+
+    def might_exist(self, addr):
+        """Return False if `addr` certainly has no account."""
+        return self.account_filter is None or self.account_filter.might_exist(addr)
+
+    def lookup_cached(self, addr, lookup, *args):
+        """Return the reply for `addr` from the userdb cache
+        or from `lookup(addr, *args)`, None if the lookup returned nothing.
+
+        Userdb and passdb replies are the same for an existing user.
+        """
+        user = self.config.get_user(addr)
+        reply = self.userdb_cache.get(user)
+        if reply is not None:
+            return reply
+        # stamp before reading so that a concurrent change is noticed later
+        stamp = user.get_stamp()
+        res = lookup(addr, *args)
+        if not res:
+            return None
+        if self.account_filter is not None:
+            # e.g. accounts created by another doveauth process
+            self.account_filter.add(addr)
+        reply = f"O{json.dumps(res)}\n"
+        if stamp is None:
+            # the account was just created
+            stamp = user.get_stamp()
+        if stamp is not None:
+            self.userdb_cache.put(user, stamp, reply)
+        return reply
 
     def handle_iterate(self, parts):
         # example: I0\t0\tshared/userdb/
+        # with flags, max rows (0 for no limit) and the path to iterate
         if parts[2] == "shared/userdb/":
-            result = "".join(
-                f"Oshared/userdb/{user}\t\n" for user in self.iter_userdb()
-            )
-            return f"{result}\n"
-
-    def iter_userdb(self) -> list:
-        """Get a list of all user addresses."""
-        return [x for x in os.listdir(self.config.mailboxes_dir) if "@" in x]
+            max_rows = int(parts[1] or 0)
+            return self.iter_userdb_replies(max_rows)
+        return super().handle_iterate(parts)
+
+    def iter_userdb_replies(self, max_rows=0):
+        """Yield the iteration reply in chunks of ITERATE_CHUNK_SIZE addresses
+        so that the first rows are written before the directory is fully read."""
+        addrs = self.iter_userdb()
+        if max_rows:
+            addrs = itertools.islice(addrs, max_rows)
+        rows = []
+        for addr in addrs:
+            rows.append(f"Oshared/userdb/{addr}\t\n")
+            if len(rows) >= ITERATE_CHUNK_SIZE:
+                yield "".join(rows)
+                rows = []
+        rows.append("\n")
+        yield "".join(rows)
+
+    def iter_userdb(self):
+        """Yield all user addresses from the mailbox census if it is complete,
+        otherwise from the account store."""
+        census = self.config.get_census()
+        if census is not None and census.is_complete():
+            return census.iter_addrs()
+        return self.config.get_account_store().iter_addrs()
 
     def lookup_userdb(self, addr):
         return self.config.get_user(addr).get_userdb_dict()
@@ -148,15 +248,24 @@ class AuthDictProxy(DictProxy):
             return userdata
         if not is_allowed_to_create(self.config, addr, cleartext_password):
             return
-        if not has_sufficient_resources(self.config):
+        if not self.get_admission().admit():
             return
 
-        lock = filelock.FileLock(str(user.password_path) + ".lock", timeout=5)
-        with lock:
-            userdata = user.get_userdb_dict()
-            if userdata:
-                return userdata
-            user.set_password(encrypt_password(cleartext_password))
+        try:
+            with stage("crypt"):
+                enc_password = self.password_hasher.encrypt(cleartext_password)
+        except HashingOverloaded as e:
+            logging.warning(f"registration rejected: {e}")
+            return
+        except BrokenProcessPool:
+            # logged by the hasher which restarts its pool for the next creation
+            logging.warning(f"registration of {addr} failed: hashing process died")
+            return
+        if self.account_filter is not None:
+            self.account_filter.add(addr)
+        # a concurrent creator of the same address may win,
+        # its password is returned then
+        if user.create(enc_password):
             print(f"Created address: {addr}", file=sys.stderr)
         return user.get_userdb_dict()
 
@@ -169,4 +278,4 @@ def main():
 
     dictproxy = AuthDictProxy(config=config)
 
-    dictproxy.serve_forever_from_socket(socket)
+    dictproxy.serve_forever(socket, config)
@@ -3,6 +3,7 @@ Expire old messages and addresses.
 
 """
 
+import itertools
 import os
 import re
 import shutil
@@ -14,11 +15,26 @@ from datetime import datetime
 from pathlib import Path
 from stat import S_ISREG
 
+from chatmaild.census import Census, summarize_messages
 from chatmaild.config import read_config
+from chatmaild.control import broadcast_control_command
+from chatmaild.mailboxes import (
+    DOVEAUTH_RUNTIME_DIR,
+    SHARDED,
+    Sharder,
+    flush_cached_locations,
+    get_account_check,
+    is_fully_sharded,
+    iter_mailbox_dirs,
+)
 
 FileEntry = namedtuple("FileEntry", ("path", "mtime", "size"))
 QuotaFileEntry = namedtuple("QuotaFileEntry", ("mtime", "quota_size", "path"))
 
+# lock files left in mailboxes by older versions
+# which locked account creation and metadata writes with lock files
+LEFTOVER_LOCK_FILES = ("password.lock", "metadata.json.lock")
+
 # Quota cleanup factor of max_mailbox_size. The mailbox is reset to this size.
 QUOTA_CLEANUP_FACTOR = 0.7
 
@@ -26,14 +42,23 @@ QUOTA_CLEANUP_FACTOR = 0.7
 _dovecot_fn_rex = re.compile(r".+/(\d+)\..+,S=(\d+)")
 
 
-def iter_mailboxes(basedir, maxnum):
+def iter_mailboxes(basedir, maxnum, config=None):
     if not os.path.exists(basedir):
         print_info(f"no mailboxes found at: {basedir}")
         return
 
-    for name in os_listdir_if_exists(basedir)[:maxnum]:
-        if "@" in name:
-            yield MailboxStat(basedir + "/" + name)
+    # mailboxes are yielded while listing, from shards and flat locations
+    for addr, path in itertools.islice(iter_mailbox_dirs(basedir), maxnum):
+        yield get_mailbox_stat(addr, path, config)
+
+
+def get_mailbox_stat(addr, path, config=None):
+    mbox = MailboxStat(path)
+    store = config.get_account_store() if config is not None else None
+    if store is not None and store.indexed:
+        # only the maildir store keeps the last login in the mailbox
+        mbox.last_login = store.get_last_login(config.get_user(addr))
+    return mbox
 
 
 def get_file_entry(path):
@@ -119,6 +144,13 @@ def expire_to_target(mbox, target_bytes):
     return removed
 
 
+def summarize_census_messages(mbox):
+    """Return (messages, bytes, oldest) from the message file names of `mbox`."""
+    return summarize_messages(
+        (entry.quota_size, entry.mtime) for entry in scan_mailbox_messages(mbox)
+    )
+
+
 def print_info(msg):
     print(msg, file=sys.stderr)
 
@@ -133,15 +165,68 @@ class Expiry:
         self.all_mboxes = 0
         self.del_files = 0
         self.all_files = 0
+        self.removed_addrs = []
         self.start = time.time()
+        # only updated when actually removing
+        self.census = None if dry else config.get_census()
 
     def remove_mailbox(self, mboxdir):
         if self.verbose:
             print_info(f"removing {mboxdir}")
         if not self.dry:
+            addr = os.path.basename(mboxdir)
             shutil.rmtree(mboxdir)
+            self.config.get_account_store().remove(addr)
+            if self.census is not None:
+                self.census.remove(addr)
+            self.removed_addrs.append(addr)
         self.del_mboxes += 1
 
+    def remove_inactive_accounts(self):
+        """Remove the accounts which an indexed account store
+        knows to be inactive, without scanning their mailboxes."""
+        store = self.config.get_account_store()
+        days = int(self.config.delete_inactive_users_after)
+        for addr in store.iter_inactive_addrs(self.now - days * 86400):
+            mboxdir = self.config.get_mailbox_dir(addr)
+            if mboxdir.exists():
+                self.remove_mailbox(str(mboxdir))
+            elif not self.dry:
+                store.remove(addr)
+
+    def iter_due_mailboxes(self):
+        """Yield the mailboxes which the complete census knows to need work,
+        see `Census.iter_due_addrs`."""
+        config = self.config
+        census = config.get_census()
+        rescan_days = min(
+            int(config.delete_mails_after), int(config.delete_large_after)
+        )
+        addrs = census.iter_due_addrs(
+            login_cutoff=self.now - int(config.delete_inactive_users_after) * 86400,
+            mails_cutoff=self.now - int(config.delete_mails_after) * 86400,
+            rescan_cutoff=self.now - rescan_days * 86400,
+            max_bytes=config.max_mailbox_size_mb * 1024 * 1024 * QUOTA_CLEANUP_FACTOR,
+        )
+        for addr in addrs:
+            path = config.get_mailbox_dir(addr)
+            if not path.exists():
+                if not self.dry:
+                    census.remove(addr)
+                continue
+            yield get_mailbox_stat(addr, str(path), config)
+
+    def invalidate_auth_caches(self, runtime_dir=DOVEAUTH_RUNTIME_DIR, chunk=100):
+        """Tell doveauth to forget removed mailboxes.
+
+        This is best effort, doveauth also notices removed password files
+        when it revalidates cached entries.
+        """
+        addrs = self.removed_addrs
+        for i in range(0, len(addrs), chunk):
+            command = "invalidate " + " ".join(addrs[i : i + chunk])
+            broadcast_control_command(runtime_dir, "doveauth", command)
+
     def remove_file(self, path, mtime=None):
         if self.verbose:
             if mtime is not None:
@@ -168,10 +253,17 @@ class Expiry:
         if mbox.last_login and mbox.last_login < cutoff_without_login:
             self.remove_mailbox(mbox.basedir)
             return
-        elif mbox.last_login is None:
+
+        for entry in mbox.extrafiles:
+            if os.path.basename(entry.path) in LEFTOVER_LOCK_FILES:
+                self.remove_file(entry.path)
+
+        if mbox.last_login is None:
             try:
                 if not self.dry:
                     os.rmdir(mbox.basedir)
+                    if self.census is not None:
+                        self.census.remove(os.path.basename(mbox.basedir))
                     self.del_mboxes += 1
             except OSError:
                 print_info(
@@ -187,6 +279,7 @@ class Expiry:
             else:
                 print_info(f"checking mailbox (no last_login) {mboxname}")
         self.all_files += len(mbox.messages)
+        remaining = []
         for message in mbox.messages:
             if message.mtime < cutoff_mails:
                 self.remove_file(message.path, mtime=message.mtime)
@@ -195,7 +288,10 @@ class Expiry:
                 parts = message.path.split("/")
                 if len(parts) >= 2 and parts[-2] == "cur":
                     self.remove_file(message.path, mtime=message.mtime)
+                else:
+                    remaining.append(message)
             else:
+                remaining.append(message)
                 continue
             changed = True
 
@@ -214,6 +310,13 @@ class Expiry:
         if changed:
             self.remove_file(f"{mbox.basedir}/maildirsize")
 
+        if self.census is not None:
+            if removed:
+                summary = summarize_census_messages(Path(mbox.basedir))
+            else:
+                summary = summarize_messages((m.size, m.mtime) for m in remaining)
+            self.census.set_messages(mboxname, int(mbox.last_login), *summary)
+
     def get_summary(self):
         return (
             f"Removed {self.del_mboxes} out of {self.all_mboxes} mailboxes "
@@ -256,6 +359,12 @@ def daily_expire_main(args=None):
         action="store_true",
         help="actually remove all expired files and dirs",
     )
+    parser.add_argument(
+        "--full",
+        dest="full",
+        action="store_true",
+        help="check all mailboxes even if the mailbox census is complete",
+    )
     args = parser.parse_args(args)
 
     config = read_config(args.chatmail_ini)
@@ -265,8 +374,33 @@ def daily_expire_main(args=None):
 
     maxnum = int(args.maxnum) if args.maxnum else None
     exp = Expiry(config, dry=not args.remove, now=now, verbose=args.verbose)
-    for mailbox in iter_mailboxes(str(config.mailboxes_dir), maxnum=maxnum):
+    if config.get_account_store().indexed and not exp.dry:
+        exp.remove_inactive_accounts()
+    if config.mailboxes_layout == SHARDED and is_fully_sharded(config.mailboxes_dir):
+        # flat mailboxes recreated after chatmail-shard-mailboxes finished
+        sharder = Sharder(
+            config.mailboxes_dir,
+            dry=exp.dry,
+            verbose=args.verbose,
+            has_account=get_account_check(config),
+        )
+        sharder.move_flat(flush=flush_cached_locations)
+    census = config.get_census()
+    full_walk = args.full or census is None or census.needs_full_walk()
+    if full_walk:
+        mailboxes = iter_mailboxes(str(config.mailboxes_dir), maxnum, config)
+    else:
+        mailboxes = itertools.islice(exp.iter_due_mailboxes(), maxnum)
+    for mailbox in mailboxes:
         exp.process_mailbox_stat(mailbox)
+    if not exp.dry and full_walk and maxnum is None:
+        # all mailboxes have a record and all accounts were imported now
+        if exp.census is not None:
+            exp.census.mark_complete()
+        store = config.get_account_store()
+        if store.indexed:
+            store.mark_imported()
+    exp.invalidate_auth_caches()
     print(exp.get_summary())
 
 
@@ -287,6 +421,12 @@ def quota_expire_main(args=None):
         type=Path,
         help="path to a user mailbox",
     )
+    parser.add_argument(
+        "--census",
+        metavar="PATH",
+        default=None,
+        help="update the mailbox's record in the mailbox census database at PATH",
+    )
     args = parser.parse_args(args)
 
     target_bytes = args.target_mb * 1024 * 1024
@@ -299,4 +439,7 @@ def quota_expire_main(args=None):
             f" from {args.mailbox_path.name}",
             file=sys.stderr,
         )
+    if args.census:
+        summary = summarize_census_messages(args.mailbox_path)
+        Census(args.census).set_messages(args.mailbox_path.name, None, *summary)
     return 0
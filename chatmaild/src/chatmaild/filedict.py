@@ -1,40 +1,104 @@
+import copy
+import fcntl
 import json
 import logging
 import os
 from contextlib import contextmanager
 from random import randint
 
-import filelock
+from chatmaild.tracing import stage
+
+# bytes of change records after which a LogFileDict is compacted
+MAX_LOG_SIZE = 64 * 1024
+
+
+def open_dir(path):
+    try:
+        return os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+    except FileNotFoundError:
+        os.makedirs(path, exist_ok=True)
+        return os.open(path, os.O_RDONLY | os.O_DIRECTORY)
 
 
 class FileDict:
-    """Concurrency-safe multi-reader/single-writer persistent dict."""
+    """Concurrency-safe multi-reader/single-writer persistent dict.
+
+    Writers lock the directory containing the file with flock(),
+    which needs no lock file. Modifications of different files
+    in the same directory are thus serialized, too.
+
+    Each write replaces the file, so its (inode, mtime, ctime, size)
+    stamp tells whether data read before is still current.
+    """
 
     def __init__(self, path):
         self.path = path
-        self.lock_path = path.with_name(path.name + ".lock")
+        # stamp of the file as last written by modify()
+        self.stamp = None
 
     @contextmanager
     def modify(self):
         # the OS will release the lock if the process dies,
         # and the contextmanager will otherwise guarantee release
-        with filelock.FileLock(self.lock_path):
+        dir_fd = open_dir(self.path.parent)
+        try:
+            with stage("lock"):
+                fcntl.flock(dir_fd, fcntl.LOCK_EX)
             data = self.read()
             yield data
+            self.stamp = self.write_snapshot(data)
+        finally:
+            # closing the only descriptor releases the lock
+            os.close(dir_fd)
+
+    def write_snapshot(self, data):
+        """Replace the file with `data` and return its stamp."""
+        with stage("write"):
             write_path = self.path.with_name(self.path.name + ".tmp")
             with write_path.open("w") as f:
                 json.dump(data, f)
-            os.rename(write_path, self.path)
+                f.flush()
+                os.rename(write_path, self.path)
+                # after the rename which changes the ctime
+                return get_stamp(os.fstat(f.fileno()))
+
+    def get_stamp(self):
+        """Return the current stamp of the file without reading it."""
+        return stat_stamp(self.path)
 
     def read(self):
+        return self.read_with_stamp()[0]
+
+    def read_with_stamp(self):
+        """Return the data and the stamp of the file it was read from,
+        None if it does not exist."""
         try:
-            with self.path.open("r") as f:
-                return json.load(f)
+            with stage("read"), self.path.open("r") as f:
+                stamp = get_stamp(os.fstat(f.fileno()))
+                try:
+                    return json.load(f), stamp
+                except Exception:
+                    logging.warning(f"corrupt serialization state at: {self.path!r}")
+                    return {}, stamp
         except FileNotFoundError:
-            return {}
+            return {}, None
         except Exception:
             logging.warning(f"corrupt serialization state at: {self.path!r}")
-            return {}
+            return {}, None
+
+
+def get_stamp(st):
+    # a rewrite may reuse the inode of a removed file within the same mtime tick,
+    # the ctime of the rename and the size tell most of them apart
+    return (st.st_ino, st.st_mtime_ns, st.st_ctime_ns, st.st_size)
+
+
+def stat_stamp(path):
+    """Return the stamp of the file at `path`, None if it does not exist."""
+    try:
+        return get_stamp(os.stat(path))
+    except FileNotFoundError:
+        return None
 
 
 def write_bytes_atomic(path, content):
@@ -42,3 +106,155 @@ def write_bytes_atomic(path, content):
     tmp = path.with_name(path.name + f".tmp-{rint}")
     tmp.write_bytes(content)
     os.rename(tmp, path)
+
+
+def create_bytes_exclusive(path, content):
+    """Write `content` to `path` unless it exists, return True if written.
+
+    The content is written to a temporary file first and then hard-linked
+    to `path`, so concurrent readers never see a partially written file
+    and of concurrent creators exactly one succeeds.
+    """
+    rint = randint(0, 10000000)
+    tmp = path.with_name(path.name + f".tmp-{rint}")
+    tmp.write_bytes(content)
+    try:
+        os.link(tmp, path)
+    except FileExistsError:
+        return False
+    finally:
+        os.unlink(tmp)
+    return True
+
+
+def iter_changes(old, new, path=()):
+    """Yield the records which turn dict `old` into dict `new`."""
+    for key, value in new.items():
+        if key not in old:
+            yield ["s", [*path, key], value]
+        elif value != old[key]:
+            if isinstance(value, dict) and isinstance(old[key], dict):
+                yield from iter_changes(old[key], value, (*path, key))
+            else:
+                yield ["s", [*path, key], value]
+    for key in old:
+        if key not in new:
+            yield ["d", [*path, key]]
+
+
+def apply_change(data, record):
+    op, path = record[0], record[1]
+    for key in path[:-1]:
+        data = data.setdefault(key, {})
+    if op == "s":
+        data[path[-1]] = record[2]
+    elif op == "d":
+        data.pop(path[-1], None)
+    else:
+        raise ValueError(f"unknown change record {record!r}")
+
+
+class LogFileDict(FileDict):
+    """FileDict which appends changes to a log next to the file
+    instead of rewriting the whole file.
+
+    The log holds one JSON record per line which sets or deletes
+    the value at a key path. When the log would grow beyond `max_log_size`
+    bytes it is compacted into the file, which remains readable by FileDict.
+    With a `max_log_size` of 0 every change rewrites the file
+    and compacts a log left from a larger `max_log_size`.
+    A torn last record of an interrupted write is ignored
+    and cut off by the next writer. Readers share the directory lock
+    so they never see a compacted file together with a removed log.
+    """
+
+    def __init__(self, path, max_log_size=MAX_LOG_SIZE):
+        super().__init__(path)
+        self.log_path = path.with_name(path.name + ".log")
+        self.max_log_size = max_log_size
+
+    @contextmanager
+    def modify(self):
+        dir_fd = open_dir(self.path.parent)
+        try:
+            with stage("lock"):
+                fcntl.flock(dir_fd, fcntl.LOCK_EX)
+            data, stamp, valid_size, size = self._load()
+            old = copy.deepcopy(data)
+            yield data
+            records = list(iter_changes(old, data))
+            if valid_size < size:
+                os.truncate(self.log_path, valid_size)
+            if not records and valid_size == size <= self.max_log_size:
+                self.stamp = stamp
+                return
+            payload = b"".join(
+                json.dumps(record).encode() + b"\n" for record in records
+            )
+            if valid_size + len(payload) > self.max_log_size:
+                self.write_snapshot(data)
+                if stamp[1] is not None:
+                    os.unlink(self.log_path)
+            elif payload:
+                with stage("write"):
+                    fd = os.open(
+                        self.log_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644
+                    )
+                    try:
+                        # a short write ending on a record boundary
+                        # would not be noticed as torn when reading
+                        view = memoryview(payload)
+                        while view:
+                            view = view[os.write(fd, view) :]
+                    finally:
+                        os.close(fd)
+            self.stamp = self.get_stamp()
+        finally:
+            os.close(dir_fd)
+
+    def read_with_stamp(self):
+        try:
+            dir_fd = os.open(self.path.parent, os.O_RDONLY | os.O_DIRECTORY)
+        except FileNotFoundError:
+            return {}, None
+        try:
+            with stage("lock"):
+                fcntl.flock(dir_fd, fcntl.LOCK_SH)
+            data, stamp, valid_size, size = self._load()
+            return data, stamp
+        finally:
+            os.close(dir_fd)
+
+    def _load(self):
+        """Return the data of the file with the log applied, the stamp,
+        and the sizes of the log's valid records and of the whole log."""
+        data, file_stamp = super().read_with_stamp()
+        try:
+            with stage("read"), self.log_path.open("rb") as f:
+                log_stamp = get_log_stamp(os.fstat(f.fileno()))
+                content = f.read()
+        except FileNotFoundError:
+            return data, (file_stamp, None), 0, 0
+        valid_size = 0
+        for line in content.splitlines(keepends=True):
+            try:
+                if not line.endswith(b"\n"):
+                    raise ValueError("incomplete record")
+                apply_change(data, json.loads(line))
+            except Exception:
+                logging.warning(f"ignoring torn records at end of {self.log_path}")
+                break
+            valid_size += len(line)
+        return data, (file_stamp, log_stamp), valid_size, len(content)
+
+    def get_stamp(self):
+        try:
+            log_stamp = get_log_stamp(os.stat(self.log_path))
+        except FileNotFoundError:
+            log_stamp = None
+        return (stat_stamp(self.path), log_stamp)
+
+
+def get_log_stamp(st):
+    # appends keep the inode, the size always grows
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
@@ -13,6 +13,11 @@ to show storage summaries only for first 1000 mailboxes
 
     python -m chatmaild.fsreport /path/to/chatmail.ini --maxnum 1000
 
+to read the mailbox census instead of scanning all mailboxes,
+which only reports the total size of messages and no extra files
+
+    python -m chatmaild.fsreport /path/to/chatmail.ini --census
+
 to write Prometheus textfile for node_exporter
 
     python -m chatmaild.fsreport --textfile /var/lib/prometheus/node-exporter/
@@ -25,6 +30,7 @@ to also write legacy metrics.py style output (default: /var/www/html/metrics):
 
 """
 
+import itertools
 import os
 import tempfile
 from argparse import ArgumentParser
@@ -49,7 +55,7 @@ def HSize(size: int):
 
 
 class Report:
-    def __init__(self, now, min_login_age, mdir):
+    def __init__(self, now, min_login_age, mdir, census=False):
         self.size_extra = 0
         self.size_messages = 0
         self.now = now
@@ -70,15 +76,18 @@ class Report:
             5 * MiB,
             10 * MiB,
         )
+        if census:
+            # census records have no sizes of single messages
+            self.message_size_thresholds = (0,)
         self.message_buckets = {x: 0 for x in self.message_size_thresholds}
         self.message_count_buckets = {x: 0 for x in self.message_size_thresholds}
 
-    def process_mailbox_stat(self, mailbox):
-        # categorize login times
-        last_login = mailbox.last_login
+    def process_login(self, addr, last_login):
+        """Categorize the login time and return True if it is old enough
+        for summing up message sizes."""
         if last_login:
             self.num_all_logins += 1
-            if os.path.basename(mailbox.basedir)[:3] == "ci-":
+            if addr[:3] == "ci-":
                 self.num_ci_logins += 1
             else:
                 for days in self.login_buckets:
@@ -86,7 +95,17 @@ class Report:
                         self.login_buckets[days] += 1
 
         cutoff_login_date = self.now - self.min_login_age * DAYSECONDS
-        if last_login and last_login <= cutoff_login_date:
+        return bool(last_login) and last_login <= cutoff_login_date
+
+    def process_census_record(self, record):
+        if self.process_login(record.addr, record.last_login):
+            self.message_buckets[0] += record.bytes
+            self.message_count_buckets[0] += record.messages
+        self.size_messages += record.bytes
+
+    def process_mailbox_stat(self, mailbox):
+        addr = os.path.basename(mailbox.basedir)
+        if self.process_login(addr, mailbox.last_login):
             # categorize message sizes
             for size in self.message_buckets:
                 for msg in mailbox.messages:
@@ -244,6 +263,12 @@ def main(args=None):
         action="store",
         help="maximum number of mailboxes to iterate on",
     )
+    parser.add_argument(
+        "--census",
+        action="store_true",
+        help="read the complete mailbox census instead of scanning mailboxes, "
+        "only message totals are reported",
+    )
     parser.add_argument(
         "--textfile",
         metavar="PATH",
@@ -269,9 +294,24 @@ def main(args=None):
         now = now - 86400 * int(args.days)
 
     maxnum = int(args.maxnum) if args.maxnum else None
-    rep = Report(now=now, min_login_age=int(args.min_login_age), mdir=args.mdir)
-    for mbox in iter_mailboxes(str(config.mailboxes_dir), maxnum=maxnum):
-        rep.process_mailbox_stat(mbox)
+    census = config.get_census() if args.census else None
+    if args.census:
+        if census is None or not census.is_complete():
+            parser.error("the mailbox census is disabled or not complete yet")
+        if args.mdir:
+            parser.error("--mdir can not be used with --census")
+    rep = Report(
+        now=now,
+        min_login_age=int(args.min_login_age),
+        mdir=args.mdir,
+        census=args.census,
+    )
+    if census is not None:
+        for record in itertools.islice(census.iter_records(), maxnum):
+            rep.process_census_record(record)
+    else:
+        for mbox in iter_mailboxes(str(config.mailboxes_dir), maxnum, config):
+            rep.process_mailbox_stat(mbox)
     if args.textfile:
         path = args.textfile
         if os.path.isdir(path):
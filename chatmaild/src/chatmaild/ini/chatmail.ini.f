@@ -60,6 +60,17 @@ mail_domain = {mail_domain}
 # Minimum free disk space on the file system holding the mailboxes.
 #min_free_disk_space = 1G
 
+# Load, memory and disk are sampled every few seconds in the background.
+# Account creations are additionally smoothed to this average rate
+# with bursts of up to creation_burst accounts, a creation waits
+# up to max_creation_delay seconds for its turn before it is rejected.
+# Both apply to the whole relay, each of the dictproxy_processes
+# doveauth processes admits its share of them.
+# 0 disables the rate limit.
+#max_creations_per_second = 10
+#creation_burst = 50
+#max_creation_delay = 2
+
 # Maximum number of concurrent IMAP connections
 # (the Dovecot imap process limit).
 #max_imap_connections = 10000
@@ -69,6 +80,82 @@ mail_domain = {mail_domain}
 # A single client IP may use up to a fifth of this.
 #max_smtp_connections = 1000
 
+# How the doveauth, metadata and lastlogin dict proxies serve Dovecot:
+# "threads" starts one thread per Dovecot connection,
+# "asyncio" keeps all connections in one event loop
+# and runs requests in a pool of dictproxy_max_workers threads.
+# Lookups pipelined on one connection are handled concurrently
+# by up to dictproxy_max_workers threads with either engine.
+#dictproxy_engine = threads
+#dictproxy_max_workers = 32
+
+# Number of processes of each dict proxy accepting on the same socket.
+# Values above 1 let password hashing and JSON work use several CPU cores,
+# crashed processes are restarted.
+#dictproxy_processes = 1
+
+# Fraction of dict proxy requests traced with per-stage timings.
+# The most recent traces are written to the runtime directory
+# of a service on "systemctl kill -s USR1 <service>",
+# with addresses replaced by hashes. 0 disables tracing.
+#dictproxy_trace_sample_rate = 0.01
+
+# Number of addresses whose userdb/passdb replies doveauth keeps in memory
+# (0 disables the cache) and seconds after which a cached reply
+# is checked against the password file again.
+#userdb_cache_size = 100000
+#userdb_cache_ttl = 10
+
+# Minimum number of addresses of the in-memory filter with which doveauth
+# answers lookups of nonexistent addresses without touching the disk.
+# It takes 10 bytes per address and is sized for at least twice
+# the existing accounts (0 disables the filter).
+# Mailboxes created other than by doveauth, e.g. restored from a backup,
+# are only found after the next rescan of the mailboxes directory
+# about a minute later, until then mail to them is rejected.
+#userdb_filter_capacity = 0
+
+# "flat" stores each mailbox directly in the mailboxes directory,
+# "sharded" in one of 256 subdirectories to keep directories small
+# with millions of accounts. After switching an existing relay
+# to "sharded", move its mailboxes with "chatmail-shard-mailboxes".
+#mailboxes_layout = flat
+
+# Where account passwords and last-login days are kept:
+# "maildir" uses a "password" file in each mailbox,
+# "sqlite" an indexed database at account_db_path
+# (default: accounts.sqlite in the mailboxes directory).
+# Switching to "sqlite" imports existing accounts on first use.
+#account_store = maildir
+
+# Keep a census of all mailboxes with their last login, message count,
+# size and oldest message in census.sqlite in the mailboxes directory.
+# After chatmail-expire walked all mailboxes once it only visits mailboxes
+# which may need expiry, besides a weekly walk of all mailboxes,
+# "chatmail-fsreport --census" reads it and doveauth iterates accounts from it.
+#mailbox_census = false
+
+# If set, chatmail-metadata appends device token changes
+# to a metadata.json.log file in each mailbox instead of rewriting
+# metadata.json, and compacts the log into it beyond this many bytes
+# (0 rewrites metadata.json on each change).
+#metadata_log_size = 0
+
+# Number of processes hashing the passwords of new accounts
+# (0 hashes in the doveauth process itself) and the number of passwords
+# which may wait for them, beyond that account creation fails right away.
+#password_hash_processes = 2
+#password_hash_queue = 64
+
+# doveauth handles lookups of existing addresses and account creations
+# in separate lanes which run at most this many requests at once
+# (0 means no limit), so that logins never queue behind creations.
+# Beyond create_lane_queue waiting creations, further ones are rejected;
+# keep both create lane values together below dictproxy_max_workers.
+#login_lane_concurrency = 0
+#create_lane_concurrency = 4
+#create_lane_queue = 16
+
 # Use externally managed TLS certificates instead of built-in acmetool.
 # Paths refer to files on the deployment server (not the build machine).
 # Both files must already exist before running cmdeploy.
@@ -112,6 +199,13 @@ mail_domain = {mail_domain}
 
 # mtail_address = 127.0.0.1
 
+# Directory of the node_exporter textfile collector,
+# e.g. /var/lib/prometheus/node-exporter.
+# If set, doveauth, chatmail-metadata and lastlogin write
+# request counts and latency histograms
+# to chatmail-<service>.prom files in it every 15 seconds.
+#metrics_textfile_dir =
+
 #
 # Debugging options 
 #
@@ -0,0 +1,84 @@
+"""
+Scheduling lanes with their own concurrency limits.
+
+doveauth handles lookups of existing users in the "login" lane
+and the creation of new accounts in the "create" lane,
+so that a wave of registrations can only occupy a bounded number
+of threads and logins never wait behind password hashing.
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+
+from .metrics import REGISTRY
+from .tracing import stage
+
+LANE_SECONDS = REGISTRY.histogram(
+    "chatmail_doveauth_lane_seconds",
+    "Time requests spent in a lane including waiting for it.",
+    ["lane"],
+)
+LANE_REJECTED = REGISTRY.counter(
+    "chatmail_doveauth_lane_rejected_total",
+    "Requests rejected because too many were waiting for a lane.",
+    ["lane"],
+)
+LANE_ACTIVE = REGISTRY.gauge(
+    "chatmail_doveauth_lane_active",
+    "Requests running in a lane.",
+    ["lane"],
+)
+LANE_WAITING = REGISTRY.gauge(
+    "chatmail_doveauth_lane_waiting",
+    "Requests waiting for a lane.",
+    ["lane"],
+)
+
+
+class LaneFull(Exception):
+    """Too many requests are waiting for a lane."""
+
+
+class Lane:
+    """Run at most `concurrency` requests at once (0 for no limit)
+    with at most `max_waiting` more waiting (None for no limit)."""
+
+    def __init__(self, name, concurrency, max_waiting=None):
+        self.name = name
+        self.concurrency = concurrency
+        self.max_waiting = max_waiting
+        self.active = 0
+        self.waiting = 0
+        self._lock = threading.Lock()
+        self._semaphore = threading.Semaphore(concurrency) if concurrency else None
+        LANE_ACTIVE.set_function(lambda: self.active, lane=name)
+        LANE_WAITING.set_function(lambda: self.waiting, lane=name)
+
+    @contextmanager
+    def enter(self):
+        """Run the body in this lane, raises LaneFull if the lane is full."""
+        start = time.perf_counter()
+        semaphore = self._semaphore
+        if semaphore is not None and not semaphore.acquire(blocking=False):
+            with self._lock:
+                if self.max_waiting is not None and self.waiting >= self.max_waiting:
+                    LANE_REJECTED.inc(lane=self.name)
+                    raise LaneFull(f"{self.waiting} requests wait for {self.name}")
+                self.waiting += 1
+            try:
+                with stage("queue"):
+                    semaphore.acquire()
+            finally:
+                with self._lock:
+                    self.waiting -= 1
+        with self._lock:
+            self.active += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.active -= 1
+            if semaphore is not None:
+                semaphore.release()
+            LANE_SECONDS.observe(time.perf_counter() - start, lane=self.name)
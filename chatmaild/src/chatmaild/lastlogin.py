@@ -1,29 +1,98 @@
+"""
+Track the last login of each address for expiring inactive accounts.
+
+Last logins are only recorded with daily granularity,
+so each address is written at most once per day.
+Addresses already marked for the current day are remembered in memory
+and further logins of them cost no syscalls.
+Updates of newly marked addresses are written in batches
+by a background thread and when the process stops serving.
+"""
+
+import logging
 import sys
+import threading
 
 from .config import read_config
 from .dictproxy import DictProxy
+from .metrics import REGISTRY
+from .user import get_daytimestamp
+
+# seconds between two writes of buffered last-login updates
+FLUSH_INTERVAL = 10
+
+LASTLOGIN_UPDATES = REGISTRY.counter(
+    "chatmail_lastlogin_updates_total",
+    "Last-login updates by result (skipped, written).",
+    ["result"],
+)
 
 
 class LastLoginDictProxy(DictProxy):
-    def __init__(self, config):
+    def __init__(self, config, flush_interval=FLUSH_INTERVAL):
         super().__init__()
         self.config = config
+        self.flush_interval = flush_interval
+        # addresses whose last login is already marked for `self.day`
+        self.day = 0
+        self.marked = set()
+        # addr -> timestamp of updates which are not yet written
+        self.pending = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
 
     def handle_set(self, addr, parts):
         keyname = parts[1].split("/")
         value = parts[2] if len(parts) > 2 else ""
         if keyname[0] == "shared" and keyname[1] == "last-login":
-            addr = keyname[2]
-            timestamp = int(value)
-            user = self.config.get_user(addr)
-            user.set_last_login_timestamp(timestamp)
+            self.mark_login(keyname[2], int(value))
             return True
 
         return False
 
+    def mark_login(self, addr, timestamp):
+        """Queue a last-login update unless `addr` is marked for that day."""
+        day = get_daytimestamp(timestamp)
+        with self._lock:
+            if day > self.day:
+                self.day = day
+                self.marked = set()
+            if day < self.day or addr in self.marked:
+                LASTLOGIN_UPDATES.inc(result="skipped")
+                return
+            self.marked.add(addr)
+            self.pending[addr] = timestamp
+
+    def flush(self):
+        """Write all queued last-login updates."""
+        with self._lock:
+            pending, self.pending = self.pending, {}
+        for addr, timestamp in pending.items():
+            try:
+                self.config.get_user(addr).set_last_login_timestamp(timestamp)
+            except Exception:
+                logging.exception(f"could not write last login of {addr}")
+                continue
+            LASTLOGIN_UPDATES.inc(result="written")
+
+    def start_flusher(self):
+        threading.Thread(target=self.run_flusher, daemon=True, name="lastlogin").start()
+
+    def run_flusher(self):
+        while not self._stopped.wait(self.flush_interval):
+            self.flush()
+
+    def stop_serving(self):
+        self._stopped.set()
+        self.flush()
+
 
 def main():
     socket, config_path = sys.argv[1:]
     config = read_config(config_path)
     dictproxy = LastLoginDictProxy(config=config)
-    dictproxy.serve_forever_from_socket(socket)
+
+    def init_worker(worker_num):
+        dictproxy.start_flusher()
+
+    dictproxy.serve_forever(socket, config, init_worker=init_worker)
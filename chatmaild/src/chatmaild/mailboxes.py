@@ -0,0 +1,262 @@
+"""
+Layout of the mailbox directories below `mailboxes_dir`.
+
+With the default "flat" layout each mailbox is a direct subdirectory
+named after its address, e.g. /home/vmail/mail/example.org/alice@example.org
+
+With the "sharded" layout mailboxes are spread over 256 subdirectories
+named after the first two hex digits of a hash of the address,
+e.g. /home/vmail/mail/example.org/3f/alice@example.org
+so that no directory gets huge with millions of accounts.
+
+To switch an existing relay, set `mailboxes_layout = sharded`,
+redeploy and then move the existing mailboxes while the relay keeps running:
+
+    chatmail-shard-mailboxes /usr/local/lib/chatmaild/chatmail.ini
+
+Until that finished, mailboxes which are not yet moved
+are still found at their flat location.
+Flat mailboxes appearing later are moved by chatmail-expire.
+"""
+
+import hashlib
+import logging
+import os
+import shutil
+import subprocess
+import sys
+from argparse import ArgumentParser
+
+from .control import broadcast_control_command
+
+FLAT = "flat"
+SHARDED = "sharded"
+LAYOUTS = (FLAT, SHARDED)
+
+# written to the mailboxes dir when all mailboxes were moved to shards
+SHARDED_MARKER = ".sharded"
+
+SHARD_NAMES = [f"{i:02x}" for i in range(256)]
+
+# where doveauth listens for control commands, see chatmaild.control
+DOVEAUTH_RUNTIME_DIR = "/run/doveauth"
+
+
+def get_shard(addr):
+    return hashlib.sha256(addr.encode()).hexdigest()[:2]
+
+
+def get_mailbox_dir(mailboxes_dir, addr, layout=FLAT, flat_fallback=False):
+    """Return the mailbox directory of `addr`.
+
+    With `flat_fallback` the flat location of a not yet moved mailbox
+    is returned if there is no sharded one
+    and not all mailboxes were moved yet.
+    """
+    if layout == FLAT:
+        return mailboxes_dir.joinpath(addr)
+    path = mailboxes_dir.joinpath(get_shard(addr), addr)
+    if flat_fallback and not path.exists() and not is_fully_sharded(mailboxes_dir):
+        flat_path = mailboxes_dir.joinpath(addr)
+        if flat_path.exists():
+            return flat_path
+    return path
+
+
+def is_fully_sharded(mailboxes_dir):
+    return mailboxes_dir.joinpath(SHARDED_MARKER).exists()
+
+
+def iter_shard_dirs(mailboxes_dir):
+    """Yield the paths of existing shard directories."""
+    for name in SHARD_NAMES:
+        path = os.path.join(mailboxes_dir, name)
+        if os.path.isdir(path):
+            yield path
+
+
+def _iter_addr_entries(path):
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if "@" in entry.name:
+                    yield entry.name, entry.path
+    except FileNotFoundError:
+        return
+
+
+def iter_mailbox_dirs(mailboxes_dir):
+    """Yield (addr, path) of all mailboxes, in shards and at flat locations.
+
+    Shards are listed first so that a mailbox being moved into its shard
+    concurrently is not yielded twice.
+    """
+    mailboxes_dir = str(mailboxes_dir)
+    for shard_dir in iter_shard_dirs(mailboxes_dir):
+        yield from _iter_addr_entries(shard_dir)
+    yield from _iter_addr_entries(mailboxes_dir)
+
+
+def get_mailboxes_mtime_ns(mailboxes_dir):
+    """Return the latest modification time of the mailboxes dir and its shards,
+    which changes when a mailbox is created or removed, or None."""
+    mtimes = []
+    for path in (str(mailboxes_dir), *iter_shard_dirs(mailboxes_dir)):
+        try:
+            mtimes.append(os.stat(path).st_mtime_ns)
+        except FileNotFoundError:
+            continue
+    return max(mtimes, default=None)
+
+
+def merge_mailbox(source, target):
+    """Move the messages of mailbox `source` into mailbox `target`
+    and remove `source`.
+
+    Dovecot may have delivered to the flat location of a moved mailbox
+    if it had a cached userdb entry, message file names are unique.
+    """
+    for root, dirs, files in os.walk(source):
+        if os.path.basename(root) not in ("cur", "new"):
+            continue
+        targetdir = os.path.join(target, os.path.relpath(root, source))
+        os.makedirs(targetdir, exist_ok=True)
+        for name in files:
+            os.rename(os.path.join(root, name), os.path.join(targetdir, name))
+    shutil.rmtree(source)
+
+
+def get_account_check(config):
+    """Return a function telling whether the account of an address exists
+    in the account store of `config`, see `Sharder`."""
+    store = config.get_account_store()
+    return lambda addr: store.get_password(config.get_user(addr)) is not None
+
+
+class Sharder:
+    """Move flat mailboxes into their shards.
+
+    `has_account(addr)` tells whether an existing shard is the mailbox
+    of an account or a stray one, by default whether it holds a password file.
+    """
+
+    def __init__(self, mailboxes_dir, dry=False, verbose=False, has_account=None):
+        self.mailboxes_dir = mailboxes_dir
+        self.dry = dry
+        self.verbose = verbose
+        self.has_account = has_account
+        self.moved = 0
+        self.merged = 0
+
+    def move(self, addr, path):
+        target = get_mailbox_dir(self.mailboxes_dir, addr, SHARDED)
+        if self.verbose:
+            print(f"moving {path} to {target}", file=sys.stderr)
+        if self.dry:
+            return
+        if target.exists():
+            if self.has_account is not None:
+                # the sqlite store keeps no password file in the mailbox
+                real = self.has_account(addr)
+            else:
+                real = target.joinpath("password").exists()
+            if real:
+                merge_mailbox(path, target)
+            else:
+                # a stray mailbox was created in the shard
+                merge_mailbox(str(target), path)
+                os.rename(path, target)
+            self.merged += 1
+            return
+        target.parent.mkdir(exist_ok=True)
+        os.rename(path, target)
+        self.moved += 1
+
+    def run(self, chunk=100, flush=None):
+        """Move all flat mailboxes, calling `flush(addrs)` before and after
+        each chunk of mailboxes is moved to drop cached locations."""
+        self.move_flat(chunk, flush)
+        if not self.dry:
+            self.mailboxes_dir.joinpath(SHARDED_MARKER).touch()
+            # processes which did not see the marker yet
+            # may have recreated flat mailboxes meanwhile
+            self.move_flat(chunk, flush)
+
+    def move_flat(self, chunk=100, flush=None):
+        """Move the flat mailboxes found now, see `run`."""
+        flat = list(_iter_addr_entries(str(self.mailboxes_dir)))
+        for i in range(0, len(flat), chunk):
+            entries = flat[i : i + chunk]
+            addrs = [addr for addr, path in entries]
+            if flush is not None and not self.dry:
+                flush(addrs)
+            for addr, path in entries:
+                try:
+                    self.move(addr, path)
+                except FileNotFoundError:
+                    logging.warning(f"mailbox vanished while moving: {path}")
+            if flush is not None and not self.dry:
+                flush(addrs)
+
+
+def flush_cached_locations(addrs, runtime_dir=DOVEAUTH_RUNTIME_DIR):
+    """Drop the cached userdb entries of `addrs` in doveauth and Dovecot,
+    which contain the mailbox location."""
+    broadcast_control_command(runtime_dir, "doveauth", "invalidate " + " ".join(addrs))
+    if shutil.which("doveadm"):
+        subprocess.run(["doveadm", "auth", "cache", "flush", *addrs], check=False)
+
+
+def main(args=None):
+    """Move the mailboxes of a flat layout into shards while the relay is running."""
+    parser = ArgumentParser(description=main.__doc__)
+    ini = "/usr/local/lib/chatmaild/chatmail.ini"
+    parser.add_argument(
+        "chatmail_ini",
+        action="store",
+        nargs="?",
+        help=f"path pointing to chatmail.ini file, default: {ini}",
+        default=ini,
+    )
+    parser.add_argument(
+        "-v",
+        dest="verbose",
+        action="store_true",
+        help="print out moved mailboxes",
+    )
+    parser.add_argument(
+        "--dry",
+        dest="dry",
+        action="store_true",
+        help="only show which mailboxes would be moved",
+    )
+    args = parser.parse_args(args)
+
+    # the config depends on this module for locating mailboxes
+    from .config import read_config
+
+    config = read_config(args.chatmail_ini)
+    if config.mailboxes_layout != SHARDED:
+        print(
+            "set 'mailboxes_layout = sharded' in chatmail.ini"
+            " and redeploy before moving mailboxes",
+            file=sys.stderr,
+        )
+        return 1
+
+    sharder = Sharder(
+        config.mailboxes_dir,
+        dry=args.dry,
+        verbose=args.verbose,
+        has_account=get_account_check(config),
+    )
+    sharder.run(flush=flush_cached_locations)
+    print(
+        f"moved {sharder.moved} mailboxes, merged {sharder.merged} leftover mailboxes",
+        file=sys.stderr,
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
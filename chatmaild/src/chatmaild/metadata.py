@@ -2,14 +2,46 @@ import json
 import logging
 import socket
 import sys
+import threading
 import time
+from collections import OrderedDict
 from contextlib import contextmanager
 from importlib.resources import files
 
 from .config import read_config
 from .dictproxy import DictProxy
-from .filedict import FileDict
-from .notifier import Notifier
+from .filedict import LogFileDict
+from .mailboxes import iter_mailbox_dirs
+from .metrics import REGISTRY
+from .notifier import Notifier, adopt_worker_queue_dirs, get_worker_queue_dir
+from .tracing import stage
+
+# number of addresses whose device tokens are kept in memory
+TOKEN_CACHE_SIZE = 100000
+
+# seconds between two removals of expired device tokens
+SWEEP_INTERVAL = 3600
+
+# mailboxes per second visited when removing expired device tokens
+SWEEP_RATE = 100
+
+TOKEN_CACHE = REGISTRY.counter(
+    "chatmail_metadata_token_cache_total",
+    "Device token lookups by cache result (hit, miss).",
+    ["result"],
+)
+
+# seconds for which TURN credentials without an expiry timestamp are served
+TURN_CREDENTIALS_TTL = 60
+
+# seconds during which lookups fail right away after fetching failed
+TURN_FAILURE_BACKOFF = 1
+
+TURN_LOOKUPS = REGISTRY.counter(
+    "chatmail_metadata_turn_lookups_total",
+    "TURN credential lookups by result (cached, fetched, failed).",
+    ["result"],
+)
 
 
 def turn_credentials(turn_socket_path):
@@ -20,6 +52,80 @@ def turn_credentials(turn_socket_path):
             return file.readline().decode("utf-8").strip()
 
 
+def get_turn_expiry(credentials):
+    """Return the expiry time of TURN REST API credentials
+    whose username starts with a unix timestamp, or None."""
+    username = credentials.split(":", 1)[0]
+    return int(username) if username.isdigit() else None
+
+
+class TurnCredentialProvider:
+    """Serve TURN credentials of chatmail-turn to all callers.
+
+    chatmail-turn answers one request per connection,
+    so bursts of lookups are served from the last credentials.
+    They are refetched in the background after half of their lifetime
+    and only fetched while callers wait once they are past 80% of it.
+    At most one fetch runs at a time, concurrent callers wait for its result.
+    """
+
+    def __init__(self, socket_path, ttl=TURN_CREDENTIALS_TTL, clock=time.time):
+        self.socket_path = socket_path
+        self.ttl = ttl
+        self.clock = clock
+        self.credentials = None
+        self.refresh_at = self.usable_until = 0
+        self.failed_until = 0
+        self._lock = threading.Lock()
+        self._fetch_lock = threading.Lock()
+
+    def get(self):
+        now = self.clock()
+        with self._lock:
+            if self.credentials is not None and now < self.usable_until:
+                if now >= self.refresh_at and not self._fetch_lock.locked():
+                    threading.Thread(
+                        target=self.refresh, daemon=True, name="turn-refresh"
+                    ).start()
+                TURN_LOOKUPS.inc(result="cached")
+                return self.credentials
+        return self.fetch()
+
+    def refresh(self):
+        try:
+            self.fetch()
+        except Exception:
+            logging.exception("failed to refresh TURN credentials")
+
+    def fetch(self):
+        with self._fetch_lock:
+            now = self.clock()
+            with self._lock:
+                # another caller fetched while we waited
+                if self.credentials is not None and now < self.refresh_at:
+                    TURN_LOOKUPS.inc(result="cached")
+                    return self.credentials
+                if now < self.failed_until:
+                    TURN_LOOKUPS.inc(result="failed")
+                    raise ConnectionError("fetching TURN credentials failed recently")
+            try:
+                with stage("turn"):
+                    credentials = turn_credentials(self.socket_path)
+            except Exception:
+                TURN_LOOKUPS.inc(result="failed")
+                self.failed_until = self.clock() + TURN_FAILURE_BACKOFF
+                raise
+            TURN_LOOKUPS.inc(result="fetched")
+            now = self.clock()
+            expiry = get_turn_expiry(credentials)
+            lifetime = expiry - now if expiry is not None else self.ttl
+            with self._lock:
+                self.credentials = credentials
+                self.refresh_at = now + lifetime * 0.5
+                self.usable_until = now + lifetime * 0.8
+            return credentials
+
+
 def read_appversions(path):
     try:
         data = json.loads(path.read_bytes())
@@ -44,60 +150,121 @@ class Metadata:
     # which only ever get removed if the upstream indicates the token is invalid
     DEVICETOKEN_KEY = "devicetoken"
 
-    def __init__(self, vmail_dir):
+    def __init__(
+        self, vmail_dir, get_mailbox_dir=None, cache_size=TOKEN_CACHE_SIZE, log_size=0
+    ):
         self.vmail_dir = vmail_dir
+        # the mailbox layout of the config, flat by default
+        self.get_mailbox_dir = get_mailbox_dir or vmail_dir.joinpath
+        # addr -> (stamp of metadata.json, {token: timestamp}), least recent first;
+        # an entry is used while the file's stamp is unchanged,
+        # so writes of other processes are noticed with a stat
+        self._token_cache = OrderedDict()
+        self._cache_size = cache_size
+        self._cache_lock = threading.Lock()
+        # append changes to a log compacted beyond this many bytes, 0 rewrites
+        self.log_size = log_size
 
     def get_metadata_dict(self, addr):
-        return FileDict(self.vmail_dir / addr / "metadata.json")
+        # also without a log size, a log written with one must be read
+        # and is compacted into metadata.json by the next change
+        path = self.get_mailbox_dir(addr) / "metadata.json"
+        return LogFileDict(path, self.log_size)
+
+    def _cache_tokens(self, addr, stamp, tokens):
+        with self._cache_lock:
+            self._token_cache[addr] = (stamp, tokens)
+            self._token_cache.move_to_end(addr)
+            if len(self._token_cache) > self._cache_size:
+                self._token_cache.popitem(last=False)
 
     @contextmanager
     def _modify_tokens(self, addr):
-        with self.get_metadata_dict(addr).modify() as data:
+        mdict = self.get_metadata_dict(addr)
+        with mdict.modify() as data:
             tokens = data.setdefault(self.DEVICETOKEN_KEY, {})
-            now = int(time.time())
             if isinstance(tokens, list):
+                now = int(time.time())
                 data[self.DEVICETOKEN_KEY] = tokens = {t: now for t in tokens}
 
-            expired_tokens = [
-                token
-                for token, timestamp in tokens.items()
-                if not _is_valid_token_timestamp(tokens[token], now)
-            ]
-            for expired_token in expired_tokens:
-                del tokens[expired_token]
-
             yield tokens
+        self._cache_tokens(addr, mdict.stamp, dict(tokens))
 
     def add_token_to_addr(self, addr, token):
+        self.add_tokens_to_addr(addr, [token])
+
+    def add_tokens_to_addr(self, addr, new_tokens):
         with self._modify_tokens(addr) as tokens:
-            tokens[token] = int(time.time())
+            now = int(time.time())
+            for token in new_tokens:
+                tokens[token] = now
 
     def remove_token_from_addr(self, addr, token):
         with self._modify_tokens(addr) as tokens:
             if token in tokens:
                 del tokens[token]
 
+    def _get_tokens(self, addr):
+        mdict = self.get_metadata_dict(addr)
+        stamp = mdict.get_stamp()
+        with self._cache_lock:
+            entry = self._token_cache.get(addr)
+            if entry is not None and entry[0] == stamp:
+                self._token_cache.move_to_end(addr)
+                TOKEN_CACHE.inc(result="hit")
+                return entry[1]
+        TOKEN_CACHE.inc(result="miss")
+
+        data, stamp = mdict.read_with_stamp()
+        tokens = data.get(self.DEVICETOKEN_KEY, {})
+        if isinstance(tokens, list):
+            with self._modify_tokens(addr) as tokens:
+                return dict(tokens)
+        if not isinstance(tokens, dict):
+            tokens = {}
+        self._cache_tokens(addr, stamp, tokens)
+        return tokens
+
     def get_tokens_for_addr(self, addr):
-        mdict = self.get_metadata_dict(addr).read()
-        tokens = mdict.get(self.DEVICETOKEN_KEY, {})
+        """Return the valid device tokens of `addr`.
 
+        Expired tokens are skipped here and removed by `sweep_expired_tokens`.
+        """
         now = int(time.time())
-        if isinstance(tokens, dict):
-            token_list = [
-                token
-                for token, timestamp in tokens.items()
-                if _is_valid_token_timestamp(timestamp, now)
-            ]
-            if len(token_list) < len(tokens):
-                # Some tokens have expired, remove them.
-                with self._modify_tokens(addr) as _tokens:
-                    pass
-        elif isinstance(tokens, list):
+        return [
+            token
+            for token, timestamp in self._get_tokens(addr).items()
+            if _is_valid_token_timestamp(timestamp, now)
+        ]
+
+    def sweep_expired_tokens(self, rate=SWEEP_RATE):
+        """Remove expired tokens from the metadata of all mailboxes,
+        visiting at most `rate` mailboxes per second."""
+        now = int(time.time())
+        for addr, _ in iter_mailbox_dirs(self.vmail_dir):
+            time.sleep(1 / rate)
+            tokens = self.get_metadata_dict(addr).read().get(self.DEVICETOKEN_KEY)
+            if not isinstance(tokens, dict) or all(
+                _is_valid_token_timestamp(ts, now) for ts in tokens.values()
+            ):
+                continue
             with self._modify_tokens(addr) as tokens:
-                token_list = list(tokens.keys())
-        else:
-            token_list = []
-        return token_list
+                for token, timestamp in list(tokens.items()):
+                    if not _is_valid_token_timestamp(timestamp, now):
+                        del tokens[token]
+
+    def start_sweeper(self, interval=SWEEP_INTERVAL):
+        threading.Thread(
+            target=self.run_sweeper, args=(interval,), daemon=True, name="sweeper"
+        ).start()
+
+    def run_sweeper(self, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                self.sweep_expired_tokens()
+            except Exception:
+                logging.exception("removing expired device tokens failed")
 
 
 class MetadataDictProxy(DictProxy):
@@ -115,6 +282,7 @@ class MetadataDictProxy(DictProxy):
         self.iroh_relay = iroh_relay
         self.turn_hostname = turn_hostname
         self.turn_socket_path = turn_socket_path
+        self.turn_credentials = TurnCredentialProvider(turn_socket_path)
         self.appversions_path = files(__package__).joinpath("defaults/appversions.json")
 
     def handle_lookup(self, parts):
@@ -132,7 +300,7 @@ class MetadataDictProxy(DictProxy):
                             return f"O{self.iroh_relay}\n"
                         case "turn":
                             try:
-                                res = turn_credentials(self.turn_socket_path)
+                                res = self.turn_credentials.get()
                             except Exception:
                                 logging.exception("failed to get TURN credentials")
                                 return "N\n"
@@ -147,6 +315,26 @@ class MetadataDictProxy(DictProxy):
         logging.warning(f"lookup ignored: {parts!r}")
         return "N\n"
 
+    def handle_commit_sets(self, addr, sets):
+        # add all device tokens of the transaction with one metadata.json write
+        # and notify about all new messages of the transaction once
+        tokens = []
+        messagenew = False
+        other_sets = []
+        for parts in sets:
+            match parts[1].split("/"):
+                case ["priv", _, key] if key == self.metadata.DEVICETOKEN_KEY:
+                    tokens.append(parts[2] if len(parts) > 2 else "")
+                case ["priv", _, "messagenew"]:
+                    messagenew = True
+                case _:
+                    other_sets.append(parts)
+        if tokens:
+            self.metadata.add_tokens_to_addr(addr, tokens)
+        if messagenew:
+            self.notifier.new_message_for_addr(addr, self.metadata)
+        return super().handle_commit_sets(addr, other_sets)
+
     def handle_set(self, addr, parts):
         # For documentation on key structure see
         # https://github.com/dovecot/core/blob/main/src/lib-storage/mailbox-attribute.h
@@ -157,6 +345,8 @@ class MetadataDictProxy(DictProxy):
                 self.metadata.add_token_to_addr(addr, value)
                 return True
             case ["priv", _, "messagenew"]:
+                # the value is the number of new messages
+                # which push_notification.lua signals at once, or empty
                 self.notifier.new_message_for_addr(addr, self.metadata)
                 return True
 
@@ -178,9 +368,24 @@ def main():
 
     queue_dir = vmail_dir / "pending_notifications"
     queue_dir.mkdir(exist_ok=True)
-    metadata = Metadata(vmail_dir)
+    metadata = Metadata(
+        vmail_dir,
+        get_mailbox_dir=config.get_mailbox_dir,
+        log_size=config.metadata_log_size,
+    )
     notifier = Notifier(queue_dir)
-    notifier.start_notification_threads(metadata.remove_token_from_addr)
+
+    def init_worker(worker_num):
+        # each process persists notifications in its own queue directory
+        # so that a restarted process only requeues its own items
+        if worker_num:
+            notifier.queue_dir = get_worker_queue_dir(queue_dir, worker_num)
+            notifier.queue_dir.mkdir(exist_ok=True)
+        else:
+            adopt_worker_queue_dirs(queue_dir, config.dictproxy_processes)
+            # one process walks all mailboxes
+            metadata.start_sweeper()
+        notifier.start_notification_threads(metadata.remove_token_from_addr)
 
     dictproxy = MetadataDictProxy(
         notifier=notifier,
@@ -190,4 +395,4 @@ def main():
         turn_socket_path=socket_path,
     )
 
-    dictproxy.serve_forever_from_socket(socket)
+    dictproxy.serve_forever(socket, config, init_worker=init_worker)
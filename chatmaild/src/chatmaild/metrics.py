@@ -0,0 +1,278 @@
+"""
+Process-wide registry of counters, gauges and latency histograms
+of the chatmaild services.
+
+Metrics are written in the Prometheus exposition format
+to a textfile for the node_exporter textfile collector,
+the same way as `chatmail-fsreport --textfile` does.
+Latency percentiles (p50, p99) can be derived with ``histogram_quantile()``
+in Prometheus or with `Histogram.quantile()` locally.
+"""
+
+import logging
+import os
+import tempfile
+import threading
+import time
+from bisect import bisect_left
+
+# upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+
+def format_labels(labelnames, labelvalues):
+    if not labelnames:
+        return ""
+    pairs = ",".join(f'{n}="{v}"' for n, v in zip(labelnames, labelvalues))
+    return "{" + pairs + "}"
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def render(self, extra=""):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.extend(self.render_value(key, value, extra))
+        return lines
+
+    def render_value(self, key, value, extra):
+        labels = format_labels(self.labelnames, key)
+        yield f"{self.name}{join_labels(labels, extra)} {value}"
+
+
+def join_labels(labels, extra):
+    if not extra:
+        return labels
+    if not labels:
+        return "{" + extra + "}"
+    return labels[:-1] + "," + extra + "}"
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+
+class Gauge(Metric):
+    """Gauge which is either set explicitly or read from callbacks when rendered."""
+
+    type = "gauge"
+
+    def __init__(self, name, help, labelnames=()):
+        super().__init__(name, help, labelnames)
+        self._callbacks = {}
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def set_function(self, func, **labels):
+        self._callbacks[self._key(labels)] = func
+
+    def get(self, **labels):
+        key = self._key(labels)
+        if key in self._callbacks:
+            return self._callbacks[key]()
+        return self._values.get(key, 0)
+
+    def render(self, extra=""):
+        for key, func in list(self._callbacks.items()):
+            try:
+                value = func()
+            except Exception:
+                logging.exception(f"failed to read gauge {self.name}")
+                continue
+            with self._lock:
+                self._values[key] = value
+        return super().render(extra)
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            data = self._values.get(key)
+            if data is None:
+                # per-bucket counts (last one is +Inf), sum of all values
+                data = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            data[0][index] += 1
+            data[1] += value
+
+    def time(self, **labels):
+        return _Timer(self, labels)
+
+    def count(self, **labels):
+        data = self._values.get(self._key(labels))
+        return sum(data[0]) if data else 0
+
+    def quantile(self, q, **labels):
+        """Estimate the `q` quantile by linear interpolation within buckets."""
+        data = self._values.get(self._key(labels))
+        if not data:
+            return None
+        counts = data[0]
+        rank = q * sum(counts)
+        seen = 0
+        lower = 0.0
+        for upper, count in zip(self.buckets, counts):
+            if count and seen + count >= rank:
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+            lower = upper
+        return self.buckets[-1]
+
+    def render_value(self, key, value, extra):
+        counts, total = value
+        cumulative = 0
+        for upper, count in zip(self.buckets + ("+Inf",), counts):
+            cumulative += count
+            labels = format_labels(self.labelnames + ("le",), key + (upper,))
+            yield f"{self.name}_bucket{join_labels(labels, extra)} {cumulative}"
+        labels = join_labels(format_labels(self.labelnames, key), extra)
+        yield f"{self.name}_sum{labels} {total}"
+        yield f"{self.name}_count{labels} {cumulative}"
+
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, cls, name, help, labelnames, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, help, labelnames, **kwargs)
+            return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self._get_or_create(Counter, name, help, labelnames)
+
+    def gauge(self, name, help, labelnames=()):
+        return self._get_or_create(Gauge, name, help, labelnames)
+
+    def histogram(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._get_or_create(Histogram, name, help, labelnames, buckets=buckets)
+
+    def render(self, **extra_labels):
+        """Return all metrics in Prometheus exposition format.
+
+        `extra_labels` are added to every sample,
+        e.g. to tell apart services writing to the same textfile directory.
+        """
+        extra = ",".join(f'{k}="{v}"' for k, v in extra_labels.items())
+        lines = []
+        for metric in list(self._metrics.values()):
+            lines.extend(metric.render(extra))
+        return "\n".join(lines) + "\n"
+
+    def dump_textfile(self, filepath, **extra_labels):
+        """Atomically write all metrics to `filepath`."""
+        content = self.render(**extra_labels)
+        dirpath = os.path.dirname(os.path.abspath(filepath))
+        fd, tmppath = tempfile.mkstemp(dir=dirpath, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write(content)
+            os.chmod(tmppath, 0o644)
+            os.rename(tmppath, filepath)
+        except BaseException:
+            try:
+                os.unlink(tmppath)
+            except OSError:
+                pass
+            raise
+
+
+REGISTRY = Registry()
+
+
+class TextfileExporter(threading.Thread):
+    """Periodically write the registry to a node_exporter textfile."""
+
+    INTERVAL = 15
+
+    def __init__(self, filepath, registry=REGISTRY, **extra_labels):
+        super().__init__(daemon=True, name="metrics-exporter")
+        self.filepath = filepath
+        self.registry = registry
+        self.extra_labels = extra_labels
+
+    def run(self):
+        while True:
+            try:
+                self.registry.dump_textfile(self.filepath, **self.extra_labels)
+            except OSError:
+                logging.exception(f"failed to write metrics to {self.filepath}")
+            time.sleep(self.INTERVAL)
+
+
+def start_textfile_exporter(textfile_dir, service, worker_num=0):
+    """Start writing metrics of `service` to a file in `textfile_dir`."""
+    if worker_num:
+        filename = f"chatmail-{service}-{worker_num}.prom"
+    else:
+        filename = f"chatmail-{service}.prom"
+    exporter = TextfileExporter(
+        os.path.join(textfile_dir, filename), service=service, worker=worker_num
+    )
+    exporter.start()
+    return exporter
@@ -37,6 +37,15 @@ from uuid import uuid4
 
 import requests
 
+from .metrics import REGISTRY
+from .tracing import stage
+
+QUEUE_DEPTH = REGISTRY.gauge(
+    "chatmail_notifier_queue_depth",
+    "Notifications waiting in the retry queue of each retry number.",
+    ["retry_num"],
+)
+
 
 @dataclass
 class PersistentQueueItem:
@@ -54,8 +63,9 @@ class PersistentQueueItem:
         start_ts = int(start_ts)
         path = queue_dir.joinpath(queue_id)
         tmp_path = path.with_name(path.name + ".tmp")
-        tmp_path.write_text(f"{addr}\n{start_ts}\n{token}")
-        os.rename(tmp_path, path)
+        with stage("write"):
+            tmp_path.write_text(f"{addr}\n{start_ts}\n{token}")
+            os.rename(tmp_path, path)
         return cls(path, addr, start_ts, token)
 
     @classmethod
@@ -67,6 +77,24 @@ class PersistentQueueItem:
         return self.start_ts < other.start_ts
 
 
+def get_worker_queue_dir(queue_dir, worker_num):
+    """Return the queue directory of a pre-forked metadata worker process."""
+    if not worker_num:
+        return queue_dir
+    return queue_dir.with_name(f"{queue_dir.name}-{worker_num}")
+
+
+def adopt_worker_queue_dirs(queue_dir, num_workers):
+    """Move queue items of worker processes which no longer exist into `queue_dir`."""
+    for path in queue_dir.parent.glob(f"{queue_dir.name}-*"):
+        worker_num = path.name.rsplit("-", 1)[1]
+        if worker_num.isdigit() and int(worker_num) < num_workers:
+            continue
+        for item_path in path.iterdir():
+            os.rename(item_path, queue_dir.joinpath(item_path.name))
+        path.rmdir()
+
+
 class Notifier:
     URL = "https://notifications.delta.chat/notify"
     CONNECTION_TIMEOUT = 60.0  # seconds until http-request is given up
@@ -77,6 +105,8 @@ class Notifier:
         self.queue_dir = queue_dir
         max_tries = int(math.log(self.DROP_DEADLINE, self.BASE_DELAY)) + 1
         self.retry_queues = [PriorityQueue() for _ in range(max_tries)]
+        for retry_num, queue in enumerate(self.retry_queues):
+            QUEUE_DEPTH.set_function(queue.qsize, retry_num=retry_num)
 
     def compute_delay(self, retry_num):
         return 0 if retry_num == 0 else pow(self.BASE_DELAY, retry_num)
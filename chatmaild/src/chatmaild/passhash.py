@@ -0,0 +1,146 @@
+"""
+Password hashing for new accounts.
+
+SHA512-crypt is CPU-bound and holds the GIL,
+so during account-creation bursts it runs in a small pool of processes
+to keep lookups of existing users on other connections fast.
+The number of passwords waiting for the pool is limited,
+beyond that account creation fails right away.
+"""
+
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+try:
+    import crypt_r
+except ImportError:
+    import crypt as crypt_r
+
+from .metrics import REGISTRY
+
+PASSWORD_HASHES = REGISTRY.counter(
+    "chatmail_doveauth_password_hashes_total",
+    "Password hashing requests by result (ok, rejected, failed).",
+    ["result"],
+)
+PASSWORD_HASHES_PENDING = REGISTRY.gauge(
+    "chatmail_doveauth_password_hashes_pending",
+    "Passwords being hashed or waiting for a hashing process.",
+)
+
+
+# seconds between two checks of a hashing process whether its parent is alive
+PARENT_CHECK_INTERVAL = 1
+
+
+class HashingOverloaded(Exception):
+    """Too many passwords are waiting to be hashed."""
+
+
+def encrypt_password(password: str):
+    # https://doc.dovecot.org/2.3/configuration_manual/authentication/password_schemes/
+    passhash = crypt_r.crypt(password, crypt_r.METHOD_SHA512)
+    return "{SHA512-CRYPT}" + passhash
+
+
+def watch_parent(parent_pid, interval=PARENT_CHECK_INTERVAL):
+    """Exit the hashing process when the process owning the pool is gone,
+    e.g. a pre-fork worker which exited with os._exit()."""
+
+    def watch():
+        while os.getppid() == parent_pid:
+            time.sleep(interval)
+        os._exit(0)
+
+    threading.Thread(target=watch, daemon=True, name="watch-parent").start()
+
+
+class SharedPool:
+    """Process pool shared by all hashers of a process, not inherited on fork."""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.lock = threading.Lock()
+        self.executor = None
+
+    def get(self, processes):
+        with self.lock:
+            if self.executor is None:
+                # forking a multi-threaded dict proxy is unsafe,
+                # workers only import this light-weight module
+                context = multiprocessing.get_context("spawn")
+                self.executor = ProcessPoolExecutor(
+                    max_workers=processes,
+                    mp_context=context,
+                    initializer=watch_parent,
+                    initargs=(os.getpid(),),
+                )
+            return self.executor
+
+    def discard(self):
+        with self.lock:
+            self.executor = None
+
+    def shutdown(self):
+        """Stop the hashing processes, a later `get` starts new ones."""
+        with self.lock:
+            executor, self.executor = self.executor, None
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+
+SHARED_POOL = SharedPool()
+os.register_at_fork(after_in_child=SHARED_POOL.reset)
+
+
+class PasswordHasher:
+    """Hash passwords in a pool of `processes` processes
+    with at most `max_pending` passwords in flight.
+
+    With 0 processes passwords are hashed in the calling thread.
+    """
+
+    def __init__(self, processes, max_pending):
+        self.processes = processes
+        self.max_pending = max_pending
+        self.pending = 0
+        self._lock = threading.Lock()
+        PASSWORD_HASHES_PENDING.set_function(lambda: self.pending)
+
+    def encrypt(self, password):
+        """Return the hash of `password`.
+
+        Raises HashingOverloaded if `max_pending` passwords are in flight.
+        """
+        if not self.processes:
+            PASSWORD_HASHES.inc(result="ok")
+            return encrypt_password(password)
+
+        with self._lock:
+            if self.pending >= self.max_pending:
+                PASSWORD_HASHES.inc(result="rejected")
+                raise HashingOverloaded(f"{self.pending} passwords pending")
+            self.pending += 1
+        try:
+            future = SHARED_POOL.get(self.processes).submit(encrypt_password, password)
+            result = future.result()
+        except BrokenProcessPool:
+            logging.exception("password hashing process died, restarting pool")
+            PASSWORD_HASHES.inc(result="failed")
+            SHARED_POOL.discard()
+            raise
+        finally:
+            with self._lock:
+                self.pending -= 1
+        PASSWORD_HASHES.inc(result="ok")
+        return result
+
+    def shutdown(self):
+        SHARED_POOL.shutdown()
@@ -0,0 +1,125 @@
+"""
+Pre-fork process supervision for the dict proxies.
+
+The supervisor forks worker processes which all accept connections
+on the same inherited listening socket, letting the kernel distribute
+Dovecot connections across processes and thus across CPU cores.
+Workers which exit unexpectedly are restarted.
+"""
+
+import logging
+import os
+import signal
+import threading
+import time
+
+from .systemd import notify_ready
+
+
+class Supervisor:
+    # minimum seconds between two starts of the same worker
+    RESTART_DELAY = 1.0
+    # seconds between two checks for exited workers
+    POLL_INTERVAL = 0.1
+
+    def __init__(self, num_workers, run_worker, handoff=None, cleanup=None):
+        self.num_workers = num_workers
+        self.run_worker = run_worker
+        self.handoff = handoff
+        # called in a worker before it exits, also after `run_worker` failed
+        self.cleanup = cleanup
+        self.workers = {}
+        self.stopping = False
+        self.hangup_requested = False
+        self.handed_over = False
+        self._handoff_thread = None
+
+    def spawn(self, worker_num):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGHUP, signal.SIG_IGN)
+            exitcode = 0
+            try:
+                self.run_worker(worker_num)
+            except BaseException:
+                logging.exception(f"worker {worker_num} failed")
+                exitcode = 1
+            finally:
+                if self.cleanup is not None:
+                    try:
+                        self.cleanup()
+                    except BaseException:
+                        logging.exception(f"cleanup of worker {worker_num} failed")
+                        exitcode = 1
+                os._exit(exitcode)
+        self.workers[pid] = (worker_num, time.monotonic())
+        return pid
+
+    def stop(self, signum=None, frame=None):
+        self.stopping = True
+        for pid in self.workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def hangup(self, signum=None, frame=None):
+        # the handoff blocks, it is started by the main loop
+        self.hangup_requested = True
+
+    def start_handoff(self):
+        self.hangup_requested = False
+        if self.handoff is None or self.stopping:
+            return
+        if self._handoff_thread is not None and self._handoff_thread.is_alive():
+            return
+
+        def run():
+            # workers drain their connections on SIGTERM
+            # after a new supervisor process took over the listening socket
+            if self.handoff():
+                self.handed_over = True
+
+        self._handoff_thread = threading.Thread(target=run, daemon=True, name="handoff")
+        self._handoff_thread.start()
+
+    def run(self):
+        """Start all workers and restart crashed ones until stopped by a signal.
+
+        SIGTERM stops all workers, SIGHUP hands over to a new supervisor first.
+        """
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGHUP, self.hangup)
+        if self.handoff is not None:
+            notify_ready()
+        for worker_num in range(self.num_workers):
+            self.spawn(worker_num)
+
+        while self.workers:
+            if self.hangup_requested:
+                self.start_handoff()
+            if self.handed_over and not self.stopping:
+                self.stop()
+            # polling, so that a handoff or stop is noticed while workers run
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid == 0:
+                time.sleep(self.POLL_INTERVAL)
+                continue
+            if pid not in self.workers:
+                continue
+            worker_num, started = self.workers.pop(pid)
+            if self.stopping:
+                continue
+
+            exitcode = os.waitstatus_to_exitcode(status)
+            logging.error(f"worker {worker_num} (pid {pid}) exited with {exitcode}")
+            if time.monotonic() - started < self.RESTART_DELAY:
+                time.sleep(self.RESTART_DELAY)
+            if not self.stopping:
+                self.spawn(worker_num)
@@ -1,11 +1,30 @@
 """Detect whether the system is at its limits."""
 
 import logging
+import os
+import threading
+import time
+from collections import namedtuple
 
 import psutil
 
+from .metrics import REGISTRY
+
 MB = 1024 * 1024
 
+# seconds between two samples of the background resource sampler
+SAMPLE_INTERVAL = 2.0
+
+CREATION_ADMISSIONS = REGISTRY.counter(
+    "chatmail_doveauth_creation_admissions_total",
+    "Account creation attempts by admission result.",
+    ["result"],
+)
+
+ResourceSnapshot = namedtuple(
+    "ResourceSnapshot", ("load", "mem", "disk", "nocreate", "time")
+)
+
 
 def read_value(getter):
     try:
@@ -15,18 +34,143 @@ def read_value(getter):
         return None
 
 
-def has_sufficient_resources(config):
-    """Return False if load, memory or disk exceeds a configured limit."""
-    load = read_value(lambda: psutil.getloadavg()[0])
-    mem = read_value(lambda: psutil.virtual_memory().available // MB)
-    disk = read_value(lambda: psutil.disk_usage(str(config.mailboxes_dir)).free // MB)
+def take_snapshot(config, nocreate_path=None):
+    """Read load, available memory, free disk and whether account creation
+    is blocked by the existence of `nocreate_path`."""
+    return ResourceSnapshot(
+        load=read_value(lambda: psutil.getloadavg()[0]),
+        mem=read_value(lambda: psutil.virtual_memory().available // MB),
+        disk=read_value(
+            lambda: psutil.disk_usage(str(config.mailboxes_dir)).free // MB
+        ),
+        nocreate=bool(nocreate_path) and os.path.exists(nocreate_path),
+        time=time.monotonic(),
+    )
+
+
+def get_rejection_reason(config, snapshot):
+    """Return why `snapshot` exceeds a configured limit, or None."""
+    load, mem, disk = snapshot.load, snapshot.mem, snapshot.disk
     if load is not None and load > config.max_load_1m:
-        msg = f"load avg {load:.2f} > {config.max_load_1m:.2f}"
+        return f"load avg {load:.2f} > {config.max_load_1m:.2f}"
     elif mem is not None and mem < config.min_available_memory_mb:
-        msg = f"available memory {mem}MB < {config.min_available_memory_mb}MB"
+        return f"available memory {mem}MB < {config.min_available_memory_mb}MB"
     elif disk is not None and disk < config.min_free_disk_space_mb:
-        msg = f"free disk {disk}MB < {config.min_free_disk_space_mb}MB"
-    else:
+        return f"free disk {disk}MB < {config.min_free_disk_space_mb}MB"
+    return None
+
+
+def has_sufficient_resources(config):
+    """Return False if load, memory or disk exceeds a configured limit."""
+    msg = get_rejection_reason(config, take_snapshot(config))
+    if msg is None:
         return True
     logging.warning("registration rejected: %s", msg)
     return False
+
+
+class ResourceSampler:
+    """Keep a recent resource snapshot, refreshed by a background thread,
+    so that checking it costs no syscalls."""
+
+    def __init__(self, config, nocreate_path=None, interval=SAMPLE_INTERVAL):
+        self.config = config
+        self.nocreate_path = nocreate_path
+        self.interval = interval
+        self.snapshot = take_snapshot(config, nocreate_path)
+        self._stopped = threading.Event()
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True, name="resources").start()
+        return self
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            self.snapshot = take_snapshot(self.config, self.nocreate_path)
+
+    def stop(self):
+        self._stopped.set()
+
+    def get_snapshot(self):
+        snapshot = self.snapshot
+        # don't decide on old data if the sampler thread got stuck
+        if time.monotonic() - snapshot.time > 10 * self.interval:
+            snapshot = self.snapshot = take_snapshot(self.config, self.nocreate_path)
+        return snapshot
+
+
+class TokenBucket:
+    """Allow `rate` events per second on average and bursts of `burst` events."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, max_wait):
+        """Take a token and return the seconds to wait until it is available,
+        or None without taking a token if that would exceed `max_wait`."""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.burst, self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
+            wait = 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+            if wait > max_wait:
+                return None
+            self.tokens -= 1
+            return wait
+
+
+class CreationAdmission:
+    """Decide whether an account may be created now.
+
+    Creations are rejected while `nocreate_path` exists or the sampled
+    resources exceed a configured limit. Otherwise they are smoothed
+    to `config.max_creations_per_second` by delaying them for at most
+    `config.max_creation_delay` seconds before rejecting them.
+    Each of the `config.dictproxy_processes` serving processes
+    admits its share of the rate and burst.
+    """
+
+    def __init__(self, config, nocreate_path):
+        self.sampler = ResourceSampler(config, nocreate_path).start()
+        self.config = config
+        self.nocreate_path = nocreate_path
+        self.bucket = None
+        if config.max_creations_per_second:
+            processes = max(config.dictproxy_processes, 1)
+            self.bucket = TokenBucket(
+                config.max_creations_per_second / processes,
+                max(config.creation_burst // processes, 1),
+            )
+
+    def stop(self):
+        self.sampler.stop()
+
+    def admit(self, sleep=time.sleep):
+        snapshot = self.sampler.get_snapshot()
+        if snapshot.nocreate:
+            logging.warning(
+                f"blocked account creation because {self.nocreate_path!r} exists."
+            )
+            CREATION_ADMISSIONS.inc(result="blocked")
+            return False
+        msg = get_rejection_reason(self.config, snapshot)
+        if msg is not None:
+            logging.warning("registration rejected: %s", msg)
+            CREATION_ADMISSIONS.inc(result="resources")
+            return False
+        if self.bucket is not None:
+            wait = self.bucket.reserve(self.config.max_creation_delay)
+            if wait is None:
+                logging.warning("registration rejected: creation rate limit")
+                CREATION_ADMISSIONS.inc(result="ratelimited")
+                return False
+            if wait:
+                sleep(wait)
+        CREATION_ADMISSIONS.inc(result="admitted")
+        return True
@@ -0,0 +1,105 @@
+"""
+systemd socket activation, readiness notification
+and handing over a listening socket to a freshly started process.
+
+A dict proxy started by a systemd ``.socket`` unit receives its listening
+socket through ``LISTEN_FDS`` so that Dovecot connections queue up in the
+kernel while the service restarts instead of failing.
+
+On SIGHUP a serving process starts a new process of the same service
+on the inherited listening socket, waits until it is ready,
+and then stops accepting and finishes its own connections.
+The new process tells systemd that it is the new main process.
+"""
+
+import logging
+import os
+import select
+import socket
+import subprocess
+import sys
+
+# first file descriptor passed by systemd socket activation
+LISTEN_FDS_START = 3
+
+HANDOFF_FD_ENV = "CHATMAILD_LISTEN_FD"
+HANDOFF_READY_FD_ENV = "CHATMAILD_READY_FD"
+
+# seconds to wait for the new process of a handoff to become ready
+HANDOFF_TIMEOUT = 30
+
+
+def get_inherited_socket():
+    """Return the listening socket passed by systemd socket activation
+    or by a process handing over to us, or None."""
+    fd = None
+    if os.environ.get("LISTEN_PID") == str(os.getpid()):
+        if int(os.environ.get("LISTEN_FDS", "0")) >= 1:
+            fd = LISTEN_FDS_START
+    elif HANDOFF_FD_ENV in os.environ:
+        fd = int(os.environ[HANDOFF_FD_ENV])
+
+    # don't let child processes think they were passed the socket
+    for name in ("LISTEN_PID", "LISTEN_FDS", "LISTEN_FDNAMES", HANDOFF_FD_ENV):
+        os.environ.pop(name, None)
+
+    if fd is None:
+        return None
+    listen_sock = socket.socket(fileno=fd)
+    listen_sock.setblocking(False)
+    return listen_sock
+
+
+def notify(state):
+    """Send a state string like "READY=1" to the systemd service manager."""
+    address = os.environ.get("NOTIFY_SOCKET")
+    if not address:
+        return False
+    if address[0] == "@":
+        address = "\0" + address[1:]
+    with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+        sock.sendto(state.encode(), address)
+    return True
+
+
+def notify_ready():
+    """Signal readiness to systemd and to a process handing over to us."""
+    ready_fd = os.environ.pop(HANDOFF_READY_FD_ENV, None)
+    if ready_fd is not None:
+        os.write(int(ready_fd), b"1")
+        os.close(int(ready_fd))
+        notify(f"MAINPID={os.getpid()}")
+    notify("READY=1")
+
+
+def start_handoff(listen_sock, timeout=HANDOFF_TIMEOUT):
+    """Start a new process of this service on `listen_sock`.
+
+    Return True after the new process signalled readiness.
+    """
+    read_fd, write_fd = os.pipe()
+    env = dict(os.environ)
+    env[HANDOFF_FD_ENV] = str(listen_sock.fileno())
+    env[HANDOFF_READY_FD_ENV] = str(write_fd)
+    try:
+        proc = subprocess.Popen(
+            [sys.executable, *sys.orig_argv[1:]],
+            pass_fds=(listen_sock.fileno(), write_fd),
+            env=env,
+        )
+    finally:
+        os.close(write_fd)
+
+    try:
+        readable, _, _ = select.select([read_fd], [], [], timeout)
+        ready = bool(readable) and os.read(read_fd, 1) == b"1"
+    finally:
+        os.close(read_fd)
+
+    if ready:
+        logging.info(f"handed over listening socket to pid {proc.pid}")
+    else:
+        logging.error(f"new process {proc.pid} did not become ready, keep serving")
+        proc.kill()
+        proc.wait()
+    return ready
@@ -24,6 +24,7 @@ def make_config(tmp_path):
         overrides.setdefault("max_load_1m", "99999")
         overrides.setdefault("min_available_memory", "0")
         overrides.setdefault("min_free_disk_space", "0")
+        overrides.setdefault("max_creations_per_second", "0")
         write_initial_config(inipath, mail_domain, overrides=overrides)
         return read_config(inipath)
 
@@ -0,0 +1,78 @@
+import os
+import time
+
+import pytest
+
+import chatmaild.user
+from chatmaild.accountfilter import AccountFilter
+from chatmaild.doveauth import AuthDictProxy
+
+
+def test_filter_has_existing_addresses(tmp_path):
+    addrs = [f"user{i}@chat.example.org" for i in range(100)]
+    for addr in addrs:
+        tmp_path.joinpath(addr).mkdir()
+    account_filter = AccountFilter(tmp_path, min_capacity=100)
+    assert account_filter.capacity == 200
+    assert all(account_filter.might_exist(addr) for addr in addrs)
+    absent = [f"other{i}@chat.example.org" for i in range(1000)]
+    assert sum(account_filter.might_exist(addr) for addr in absent) < 50
+
+
+def test_filter_missing_mailboxes_dir(tmp_path):
+    account_filter = AccountFilter(tmp_path / "missing", min_capacity=10)
+    assert not account_filter.might_exist("user@chat.example.org")
+    account_filter.add("user@chat.example.org")
+    assert account_filter.might_exist("user@chat.example.org")
+
+
+def test_filter_shared_with_forked_process(tmp_path):
+    account_filter = AccountFilter(tmp_path, min_capacity=10)
+    pid = os.fork()
+    if pid == 0:
+        account_filter.add("child@chat.example.org")
+        os._exit(0)
+    os.waitpid(pid, 0)
+    assert account_filter.might_exist("child@chat.example.org")
+
+
+def test_filter_rescans_changed_directory(tmp_path):
+    account_filter = AccountFilter(tmp_path, min_capacity=10, rescan_interval=0)
+    tmp_path.joinpath("new@chat.example.org").mkdir()
+    # the first negative answer triggers a rescan in the background
+    assert not account_filter.might_exist("new@chat.example.org")
+    deadline = time.time() + 5
+    while not account_filter.might_exist("new@chat.example.org"):
+        assert time.time() < deadline
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def filter_config(make_config):
+    return make_config("chat.example.org", dict(userdb_filter_capacity="100"))
+
+
+def test_disabled_by_default(example_config):
+    assert AuthDictProxy(config=example_config).account_filter is None
+
+
+def test_unknown_address_without_filesystem_access(filter_config, monkeypatch):
+    dictproxy = AuthDictProxy(config=filter_config)
+
+    def fail(*args):
+        raise AssertionError("lookup of unknown address touched the filesystem")
+
+    monkeypatch.setattr(chatmaild.user.User, "get_userdb_dict", fail)
+    addr = "nobody123@chat.example.org"
+    msg = f"Lshared/userdb/{addr}\t{addr}"
+    assert dictproxy.handle_dovecot_request(msg, {}) == "N\n"
+
+
+def test_created_account_found_by_other_proxy(filter_config, gencreds):
+    dictproxy = AuthDictProxy(config=filter_config)
+    other = AuthDictProxy(config=filter_config)
+    # a proxy started before the account was created learns it on passdb lookup
+    addr, password = gencreds()
+    assert dictproxy.lookup_or_create(addr, password)
+    assert other.lookup_or_create(addr, password)
+    assert other.account_filter.might_exist(addr)
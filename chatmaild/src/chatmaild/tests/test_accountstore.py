@@ -0,0 +1,120 @@
+import threading
+import time
+
+import pytest
+
+from chatmaild.doveauth import AuthDictProxy
+from chatmaild.expire import daily_expire_main
+from chatmaild.fsreport import main as report_main
+
+
+@pytest.fixture
+def sqlite_config(make_config):
+    return make_config("chat.example.org", dict(account_store="sqlite"))
+
+
+def test_invalid_store(make_config):
+    with pytest.raises(ValueError):
+        make_config("chat.example.org", dict(account_store="ldap"))
+
+
+def test_password_and_last_login(sqlite_config):
+    user = sqlite_config.get_user("someuser@chat.example.org")
+    assert user.get_userdb_dict() == {}
+    assert user.get_stamp() is None
+
+    user.set_password("l1k2j31lk2j3l1k23j123")
+    assert not user.password_path.exists()
+    assert user.maildir.exists()
+    assert user.get_userdb_dict()["password"] == "l1k2j31lk2j3l1k23j123"
+    assert user.get_stamp() is not None
+
+    user.set_last_login_timestamp(86400 * 4 + 100)
+    assert user.get_last_login_timestamp() == 86400 * 4
+
+
+def test_import_from_password_file(make_config):
+    config = make_config("chat.example.org")
+    user = config.get_user("olduser@chat.example.org")
+    user.set_password("l1k2j31lk2j3l1k23j123")
+    user.set_last_login_timestamp(86400 * 3)
+
+    config = make_config("chat.example.org", dict(account_store="sqlite"))
+    store = config.get_account_store()
+    # not yet imported accounts are enumerated from the mailboxes directory
+    assert list(store.iter_addrs()) == ["olduser@chat.example.org"]
+    user = config.get_user("olduser@chat.example.org")
+    assert user.get_userdb_dict()["password"] == "l1k2j31lk2j3l1k23j123"
+    assert user.get_last_login_timestamp() == 86400 * 3
+    assert list(store.iter_addrs()) == ["olduser@chat.example.org"]
+    assert list(store.iter_inactive_addrs(86400 * 4)) == ["olduser@chat.example.org"]
+    assert list(store.iter_inactive_addrs(86400 * 3)) == []
+
+
+def test_iter_addrs_until_imported(make_config):
+    config = make_config("chat.example.org")
+    config.get_user("olduser@chat.example.org").set_password("l1k2j31lk2j3l1k23j123")
+    config = make_config("chat.example.org", dict(account_store="sqlite"))
+    store = config.get_account_store()
+    config.get_user("newuser@chat.example.org").create("firstpassword")
+    assert sorted(AuthDictProxy(config=config).iter_userdb()) == [
+        "newuser@chat.example.org",
+        "olduser@chat.example.org",
+    ]
+
+    daily_expire_main(args=[str(config._inipath)])
+    assert not store.is_imported()
+    daily_expire_main(args=["--remove", str(config._inipath)])
+    assert store.is_imported()
+    # the database is enumerated alone
+    config.get_user("flatuser@chat.example.org").maildir.mkdir(parents=True)
+    assert sorted(store.iter_addrs()) == [
+        "newuser@chat.example.org",
+        "olduser@chat.example.org",
+    ]
+
+
+def test_concurrent_creation(sqlite_config):
+    dictproxy = AuthDictProxy(config=sqlite_config)
+    addrs = [f"user{i:05}@chat.example.org" for i in range(20)]
+    threads = [
+        threading.Thread(target=dictproxy.lookup_passdb, args=(addr, "q9mr3faue"))
+        for addr in addrs
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(dictproxy.iter_userdb()) == addrs
+
+
+def test_expire_and_report(sqlite_config, capsys):
+    dictproxy = AuthDictProxy(config=sqlite_config)
+    old = time.time() - (sqlite_config.delete_inactive_users_after * 86400) - 86400
+    for name in ("oldold", "newnew"):
+        addr = f"{name}001@chat.example.org"
+        dictproxy.lookup_passdb(addr, "q9mr3faue")
+        if name == "oldold":
+            sqlite_config.get_user(addr).set_last_login_timestamp(old)
+
+    report_main(args=[str(sqlite_config._inipath)])
+    assert "Mailbox data total size" in capsys.readouterr().out
+
+    daily_expire_main(args=["--remove", str(sqlite_config._inipath)])
+    store = sqlite_config.get_account_store()
+    assert list(store.iter_addrs()) == ["newnew001@chat.example.org"]
+    assert not sqlite_config.get_user("oldold001@chat.example.org").maildir.exists()
+    assert sqlite_config.get_user("newnew001@chat.example.org").maildir.exists()
+
+
+def test_create_exclusive(make_config):
+    config = make_config("chat.example.org")
+    config.get_user("olduser@chat.example.org").set_password("oldpassword")
+    config = make_config("chat.example.org", dict(account_store="sqlite"))
+
+    # accounts with a password file are not created again
+    assert not config.get_user("olduser@chat.example.org").create("newpassword")
+    user = config.get_user("newuser@chat.example.org")
+    assert user.create("firstpassword")
+    assert not user.create("secondpassword")
+    assert user.get_userdb_dict()["password"] == "firstpassword"
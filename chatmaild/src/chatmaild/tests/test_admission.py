@@ -0,0 +1,98 @@
+import threading
+
+import pytest
+
+import chatmaild.syslimits
+from chatmaild.doveauth import AuthDictProxy
+from chatmaild.syslimits import CreationAdmission, ResourceSampler, TokenBucket
+
+
+@pytest.fixture
+def admission_config(make_config):
+    def make(**settings):
+        settings = {k: str(v) for k, v in settings.items()}
+        return make_config("chat.example.org", settings)
+
+    return make
+
+
+def test_sampler_check_costs_no_syscalls(admission_config, monkeypatch):
+    sampler = ResourceSampler(admission_config(), interval=60)
+    snapshot = sampler.snapshot
+
+    def fail(*args):
+        raise AssertionError("sampled value read again")
+
+    monkeypatch.setattr(chatmaild.syslimits, "take_snapshot", fail)
+    assert sampler.get_snapshot() is snapshot
+
+
+def test_sampler_resamples_stale_snapshot(admission_config):
+    sampler = ResourceSampler(admission_config(), interval=0.001)
+    snapshot = sampler.snapshot._replace(time=0)
+    sampler.snapshot = snapshot
+    assert sampler.get_snapshot() is not snapshot
+
+
+def test_sampler_stops(admission_config):
+    sampler = ResourceSampler(admission_config(), interval=0.001)
+    thread = threading.Thread(target=sampler.run)
+    thread.start()
+    sampler.stop()
+    thread.join(timeout=5)
+    assert not thread.is_alive()
+
+
+def test_auth_dictproxy_stops_sampler(admission_config):
+    dictproxy = AuthDictProxy(config=admission_config())
+    sampler = dictproxy.get_admission().sampler
+    dictproxy.stop_serving()
+    assert sampler._stopped.is_set()
+
+
+def test_token_bucket():
+    bucket = TokenBucket(rate=10, burst=2)
+    assert bucket.reserve(max_wait=0) == 0
+    assert bucket.reserve(max_wait=0) == 0
+    assert bucket.reserve(max_wait=0) is None
+    wait = bucket.reserve(max_wait=1)
+    assert 0 < wait <= 0.1
+    # the reserved token is taken, the next one is due later
+    assert bucket.reserve(max_wait=1) > wait
+
+
+def test_admission_smooths_then_rejects(admission_config):
+    config = admission_config(
+        max_creations_per_second=10, creation_burst=1, max_creation_delay=0.25
+    )
+    admission = CreationAdmission(config, nocreate_path=None)
+    waits = []
+    assert admission.admit(sleep=waits.append)
+    assert admission.admit(sleep=waits.append)
+    assert admission.admit(sleep=waits.append)
+    assert not admission.admit(sleep=waits.append)
+    assert len(waits) == 2
+    assert 0 < waits[0] < waits[1] <= 0.25
+
+
+def test_admission_rate_shared_by_processes(admission_config):
+    config = admission_config(
+        max_creations_per_second=10, creation_burst=5, dictproxy_processes=4
+    )
+    admission = CreationAdmission(config, nocreate_path=None)
+    admission.stop()
+    assert (admission.bucket.rate, admission.bucket.burst) == (2.5, 1)
+
+
+def test_admission_nocreate_file(admission_config, tmp_path, caplog):
+    path = tmp_path.joinpath("nocreate")
+    path.write_text("")
+    admission = CreationAdmission(admission_config(), nocreate_path=str(path))
+    assert not admission.admit()
+    assert "blocked account creation" in caplog.text
+
+
+def test_admission_resources(admission_config, caplog):
+    admission = CreationAdmission(admission_config(max_load_1m=-1), None)
+    assert not admission.admit()
+    assert "registration rejected: load avg" in caplog.text
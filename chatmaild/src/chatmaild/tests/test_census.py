@@ -0,0 +1,140 @@
+import os
+import time
+
+import pytest
+
+from chatmaild.census import FULL_WALK_INTERVAL
+from chatmaild.doveauth import AuthDictProxy
+from chatmaild.expire import Expiry, daily_expire_main, quota_expire_main
+from chatmaild.fsreport import main as report_main
+from chatmaild.user import get_daytimestamp
+
+MB = 1024 * 1024
+
+
+@pytest.fixture
+def census_config(make_config):
+    return make_config("chat.example.org", dict(mailbox_census="true"))
+
+
+def create_message(mboxdir, size, days_old):
+    mtime = int(time.time() - days_old * 86400)
+    path = mboxdir / "cur" / f"{mtime}.M1P1Q{size}.hostname,S={size},W={size}:2,S"
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(b"x" * size)
+    os.utime(path, (mtime, mtime))
+    return path
+
+
+def get_records(config):
+    return {record.addr: record for record in config.get_census().iter_records()}
+
+
+def test_disabled_by_default(example_config):
+    assert example_config.get_census() is None
+    assert example_config.get_user("user@chat.example.org").census is None
+
+
+def test_creation_and_last_login(census_config):
+    addr = "user00001@chat.example.org"
+    AuthDictProxy(config=census_config).lookup_passdb(addr, "q9mr3faue")
+    record = get_records(census_config)[addr]
+    assert record.last_login == get_daytimestamp(time.time())
+    assert record.messages == 0
+
+    census_config.get_user(addr).set_last_login_timestamp(86400 * 3 + 100)
+    assert get_records(census_config)[addr].last_login == 86400 * 3
+
+
+def test_expire_fills_census_and_visits_due_mailboxes(census_config):
+    census = census_config.get_census()
+    dictproxy = AuthDictProxy(config=census_config)
+    addrs = [f"user{i:05}@chat.example.org" for i in range(3)]
+    for addr in addrs:
+        dictproxy.lookup_passdb(addr, "q9mr3faue")
+    mboxdir = census_config.get_user(addrs[0]).maildir
+    oldest = create_message(mboxdir, 1000, days_old=2)
+    create_message(mboxdir, 2000, days_old=1)
+    # created before the census was enabled
+    census.remove(addrs[2])
+    assert not census.is_complete()
+
+    daily_expire_main(args=["--remove", str(census_config._inipath)])
+    assert census.is_complete()
+    records = get_records(census_config)
+    assert sorted(records) == addrs
+    assert records[addrs[0]].messages == 2
+    assert records[addrs[0]].bytes == 3000
+    assert records[addrs[0]].oldest == int(oldest.stat().st_mtime)
+    assert sorted(dictproxy.iter_userdb()) == addrs
+
+    now = time.time()
+    exp = Expiry(census_config, dry=False, now=now, verbose=False)
+    assert list(exp.iter_due_mailboxes()) == []
+
+    old = int(now - (int(census_config.delete_mails_after) + 1) * 86400)
+    census.set_messages(addrs[1], None, 1, 1000, old)
+    due = [mbox.basedir for mbox in exp.iter_due_mailboxes()]
+    assert due == [str(census_config.get_mailbox_dir(addrs[1]))]
+    for mbox in exp.iter_due_mailboxes():
+        exp.process_mailbox_stat(mbox)
+    assert get_records(census_config)[addrs[1]].oldest is None
+
+    # removed mailboxes are dropped from the census
+    census.set_messages("gone@chat.example.org", None, 1, 1000, old)
+    assert list(exp.iter_due_mailboxes()) == []
+    assert "gone@chat.example.org" not in get_records(census_config)
+
+
+def test_expire_walks_all_mailboxes_periodically(census_config, monkeypatch):
+    census = census_config.get_census()
+    addr = "user00001@chat.example.org"
+    AuthDictProxy(config=census_config).lookup_passdb(addr, "q9mr3faue")
+    daily_expire_main(args=["--remove", str(census_config._inipath)])
+    assert not census.needs_full_walk()
+
+    # the record of an account whose insert failed
+    census.remove(addr)
+    later = time.time() + FULL_WALK_INTERVAL - 60
+    monkeypatch.setattr(time, "time", lambda: later)
+    daily_expire_main(args=["--remove", str(census_config._inipath)])
+    assert addr not in get_records(census_config)
+
+    # walks of only the due mailboxes do not postpone the next full walk
+    later = later + 61
+    monkeypatch.setattr(time, "time", lambda: later)
+    assert census.needs_full_walk()
+    daily_expire_main(args=["--remove", str(census_config._inipath)])
+    assert addr in get_records(census_config)
+    assert not census.needs_full_walk()
+
+
+def test_report_from_census(census_config, capsys):
+    addr = "user00001@chat.example.org"
+    AuthDictProxy(config=census_config).lookup_passdb(addr, "q9mr3faue")
+    create_message(census_config.get_user(addr).maildir, 1500, days_old=1)
+
+    with pytest.raises(SystemExit):
+        report_main(args=[str(census_config._inipath), "--census"])
+    capsys.readouterr()
+
+    daily_expire_main(args=["--remove", str(census_config._inipath)])
+    report_main(args=[str(census_config._inipath), "--census"])
+    out = capsys.readouterr().out
+    assert "Messages total size    :  1.50K" in out
+    assert "all:      0.00K" in out
+
+
+def test_quota_expire_updates_census(census_config):
+    census = census_config.get_census()
+    addr = "user00001@chat.example.org"
+    AuthDictProxy(config=census_config).lookup_passdb(addr, "q9mr3faue")
+    mboxdir = census_config.get_user(addr).maildir
+    create_message(mboxdir, 2 * MB, days_old=5)
+    recent = create_message(mboxdir, MB // 2, days_old=0)
+
+    quota_expire_main(["1", str(mboxdir), f"--census={census.path}"])
+    record = get_records(census_config)[addr]
+    assert (record.messages, record.bytes) == (1, MB // 2)
+    assert record.oldest == int(recent.stat().st_mtime)
+    assert record.last_login == get_daytimestamp(time.time())
@@ -161,3 +161,12 @@ def test_max_mailbox_size_mb(make_config):
 )
 def test_is_valid_ipv4(input, result):
     assert result == is_valid_ipv4(input)
+
+
+def test_config_dictproxy_engine(make_config):
+    config = make_config("chat.example.org")
+    assert config.dictproxy_engine == "threads"
+    config = make_config("chat.example.org", {"dictproxy_engine": "asyncio"})
+    assert config.dictproxy_engine == "asyncio"
+    with pytest.raises(ValueError):
+        make_config("chat.example.org", {"dictproxy_engine": "gevent"})
@@ -0,0 +1,101 @@
+import os
+import signal
+import threading
+import time
+
+import pytest
+
+from chatmaild.control import (
+    ControlCommands,
+    get_control_socket_path,
+    install_stack_dump_handler,
+    main,
+    send_control_command,
+    start_control_server,
+)
+
+
+@pytest.fixture
+def control(tmp_path):
+    path = get_control_socket_path(str(tmp_path), "doveauth")
+    server = start_control_server(path, ControlCommands(str(tmp_path), "doveauth"))
+    yield lambda command: send_control_command(path, command, timeout=10)
+    server.shutdown()
+    server.server_close()
+
+
+def test_control_socket_path():
+    assert get_control_socket_path("/run/x", "doveauth") == "/run/x/doveauth.control"
+    path = get_control_socket_path("/run/x", "doveauth", 2)
+    assert path == "/run/x/doveauth-2.control"
+
+
+def test_stacks(control, tmp_path):
+    reply = control("stacks")
+    assert reply == f"O{tmp_path}/doveauth-stacks-{os.getpid()}.txt"
+    content = tmp_path.joinpath(reply[1:]).read_text()
+    assert "Thread MainThread" in content
+    assert "control-server" in content
+
+
+def test_profile_samples_other_threads(control, tmp_path):
+    stop = threading.Event()
+
+    def busy_function():
+        while not stop.is_set():
+            sum(range(1000))
+
+    t = threading.Thread(target=busy_function)
+    t.start()
+    try:
+        reply = control("profile 0.2")
+    finally:
+        stop.set()
+        t.join()
+    assert reply.startswith("O")
+    content = tmp_path.joinpath(reply[1:]).read_text()
+    assert "samples over 0.2 seconds" in content
+    assert "busy_function" in content
+
+
+def test_tracemalloc(control, tmp_path):
+    assert control("tracemalloc snapshot").startswith("Ftracemalloc is not started")
+    assert control("tracemalloc start") == "Ostarted"
+    try:
+        reply = control("tracemalloc snapshot")
+    finally:
+        assert control("tracemalloc stop") == "Ostopped"
+    content = tmp_path.joinpath(reply[1:]).read_text()
+    assert content.startswith("total traced:")
+
+
+def test_trace(control, tmp_path):
+    reply = control("trace")
+    assert reply == f"O{tmp_path}/doveauth-trace-{os.getpid()}.jsonl"
+
+
+def test_unknown_command(control):
+    assert control("nosuch").startswith("Funknown command")
+    assert control("_private").startswith("Funknown command")
+    assert control("").startswith("Funknown command")
+
+
+def test_main(control, tmp_path, capsys):
+    path = get_control_socket_path(str(tmp_path), "doveauth")
+    assert main([path, "stacks"]) == 0
+    assert capsys.readouterr().out.strip().endswith(".txt")
+    assert main([path, "nosuch"]) == 1
+
+
+def test_stack_dump_on_sigusr2(tmp_path):
+    old_handler = signal.getsignal(signal.SIGUSR2)
+    try:
+        install_stack_dump_handler(str(tmp_path), "lastlogin")
+        os.kill(os.getpid(), signal.SIGUSR2)
+        path = tmp_path.joinpath(f"lastlogin-stacks-{os.getpid()}.txt")
+        deadline = time.time() + 5
+        while not path.exists():
+            assert time.time() < deadline
+            time.sleep(0.01)
+    finally:
+        signal.signal(signal.SIGUSR2, old_handler)
@@ -0,0 +1,73 @@
+import json
+import subprocess
+import sys
+
+import pytest
+
+from chatmaild.dictbench import get_addr, main, parse_mix, run_benchmark
+
+
+def test_get_addr():
+    assert get_addr(0) == "b00000000@bench.example.org"
+    assert get_addr(36) == "b00000010@bench.example.org"
+    assert len({get_addr(num) for num in range(1000)}) == 1000
+
+
+def test_parse_mix():
+    assert parse_mix("login=80, create=20") == {"login": 80, "create": 20}
+
+
+@pytest.mark.parametrize(
+    ("service", "mix"),
+    [
+        ("auth", {"login": 1, "userdb": 1, "create": 1}),
+        ("metadata", {"devicetoken": 1, "messagenew": 1, "lookup": 1}),
+        ("lastlogin", {"lastlogin": 1}),
+    ],
+)
+def test_run_benchmark(service, mix):
+    results = run_benchmark(service, mix=mix, connections=2, seconds=0.3, accounts=3)
+    assert results["service"] == service
+    assert results["total"]["requests"] > 0
+    assert results["total"]["errors"] == 0
+    for name in mix:
+        scenario = results["scenarios"][name]
+        assert scenario["requests"] > 0
+        assert scenario["p50_ms"] <= scenario["p99_ms"] <= scenario["max_ms"]
+
+
+def test_main_output(tmp_path, capsys):
+    output = tmp_path.joinpath("results.json")
+    main(
+        [
+            "lastlogin",
+            "--seconds",
+            "0.2",
+            "--connections",
+            "1",
+            "--accounts",
+            "2",
+            "--output",
+            str(output),
+        ]
+    )
+    results = json.loads(capsys.readouterr().out)
+    assert results == json.loads(output.read_text())
+
+
+def test_piped_output_ends():
+    # left over server or hashing processes would keep the pipe open
+    args = ["auth", "--seconds", "0.2", "--connections", "1", "--accounts", "2"]
+    code = "import sys; from chatmaild.dictbench import main; main(sys.argv[1:])"
+    proc = subprocess.run(
+        [sys.executable, "-c", code, *args],
+        check=True,
+        stdout=subprocess.PIPE,
+        timeout=60,
+    )
+    assert json.loads(proc.stdout)["service"] == "auth"
+
+
+def test_unknown_scenario():
+    with pytest.raises(ValueError):
+        run_benchmark("auth", mix={"nosuch": 1})
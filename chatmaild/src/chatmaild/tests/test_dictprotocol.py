@@ -0,0 +1,49 @@
+import io
+
+from chatmaild.dictprotocol import (
+    LineBuffer,
+    iter_request_chunks,
+    iter_request_groups,
+    parse_request,
+)
+
+
+def test_line_buffer_split_across_chunks():
+    buffer = LineBuffer()
+    assert buffer.feed(b"Lshared/") == []
+    assert buffer.feed(b"userdb/x\tx\nB1\tx\nS1") == [b"Lshared/userdb/x\tx", b"B1\tx"]
+    assert buffer.feed(b"\tkey\n") == [b"S1\tkey"]
+    assert buffer.finish() == []
+    assert buffer.feed(b"C1") == []
+    assert buffer.finish() == [b"C1"]
+
+
+def test_iter_request_chunks():
+    rfile = io.BytesIO(b"H3\t2\t0\t\tauth\nLkey\nI0\t0\tshared/userdb/")
+    chunks = list(iter_request_chunks(rfile))
+    assert chunks == [[b"H3\t2\t0\t\tauth", b"Lkey"], [b"I0\t0\tshared/userdb/"]]
+
+
+def test_parse_request():
+    assert parse_request(b"") is None
+    assert parse_request(b"\r") is None
+    assert parse_request(b"Lpriv/guid/devicetoken\tuser@example.org\r") == (
+        "L",
+        ["priv/guid/devicetoken", "user@example.org"],
+    )
+    assert parse_request("Sß\tk\tv".encode()) == ("S", ["ß", "k", "v"])
+    assert parse_request("ßkey".encode()) == ("ß", ["key"])
+    assert parse_request(b"L\xffkey\tx") == ("L", ["\ufffdkey", "x"])
+    assert parse_request(b"\xffL") == ("\ufffd", ["L"])
+
+
+def test_iter_request_groups():
+    lines = [b"H", b"La\tx", b"Lb\tx", b"B1\tx", b"Lc\tx", b"", b"Ld\tx"]
+    assert list(iter_request_groups(lines)) == [
+        [("H", [""])],
+        [("L", ["a", "x"]), ("L", ["b", "x"])],
+        [("B", ["1", "x"])],
+        [("L", ["c", "x"])],
+        None,
+        [("L", ["d", "x"])],
+    ]
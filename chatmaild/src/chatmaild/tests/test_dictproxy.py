@@ -0,0 +1,158 @@
+import io
+import socket
+import threading
+import time
+
+import pytest
+
+from chatmaild.control import send_control_command
+from chatmaild.dictproxy import DictProxy
+from chatmaild.doveauth import AuthDictProxy
+
+
+def wait_for_socket(path, timeout=5):
+    deadline = time.time() + timeout
+    while not path.exists():
+        assert time.time() < deadline, f"socket did not appear: {path}"
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def serve(tmp_path, make_config):
+    def serve(dictproxy, engine="asyncio", max_workers=4):
+        config = make_config(
+            "chat.example.org",
+            dict(dictproxy_engine=engine, dictproxy_max_workers=str(max_workers)),
+        )
+        sock_path = tmp_path.joinpath("dict.socket")
+        t = threading.Thread(
+            target=dictproxy.serve_forever,
+            args=(str(sock_path), config),
+            daemon=True,
+        )
+        t.start()
+        wait_for_socket(sock_path)
+        return sock_path
+
+    return serve
+
+
+def connect(sock_path):
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.settimeout(5)
+    client.connect(str(sock_path))
+    return client, client.makefile("rb")
+
+
+@pytest.mark.parametrize("engine", ["threads", "asyncio"])
+def test_auth_lookup_via_socket(serve, example_config, engine):
+    sock_path = serve(AuthDictProxy(config=example_config), engine=engine)
+    client, rfile = connect(sock_path)
+    client.sendall(
+        b"H3\t2\t0\t\tauth\n"
+        b"Lshared/userdb/foobar@chat.example.org\tfoobar@chat.example.org\n"
+        b'Lshared/passdb/q9mr3faue"foobar123@chat.example.org\tfoobar123@chat.example.org\n'
+    )
+    assert rfile.readline() == b"N\n"
+    assert rfile.readline().startswith(b'O{"addr": "foobar123@chat.example.org"')
+    client.close()
+
+
+@pytest.mark.parametrize("engine", ["threads", "asyncio"])
+def test_invalid_utf8_request_skipped(serve, example_config, engine):
+    sock_path = serve(AuthDictProxy(config=example_config), engine=engine)
+    client, rfile = connect(sock_path)
+    client.sendall(
+        b"\xffshared/userdb/foobar@chat.example.org\n"
+        b"Lshared/userdb/\xff@chat.example.org\t\xff@chat.example.org\n"
+        b"Lshared/userdb/foobar@chat.example.org\tfoobar@chat.example.org\n"
+    )
+    # the unknown command gets no reply, the connection is still served
+    assert rfile.readline() == b"N\n"
+    assert rfile.readline() == b"N\n"
+    client.close()
+
+
+class SlowProxy(DictProxy):
+    def handle_lookup(self, parts):
+        time.sleep(0.05)
+        return f"O{parts[0]}\n"
+
+
+@pytest.mark.parametrize("engine", ["threads", "asyncio"])
+def test_pipelined_lookups_concurrent(serve, engine):
+    class SlowFirstProxy(DictProxy):
+        def handle_lookup(self, parts):
+            if parts[0] == "key0":
+                time.sleep(0.5)
+            return f"O{parts[0]}\n"
+
+    sock_path = serve(SlowFirstProxy(), engine=engine)
+    client, rfile = connect(sock_path)
+    start = time.time()
+    client.sendall(b"".join(f"Lkey{i}\n".encode() for i in range(4)))
+    # replies stay in request order
+    for i in range(4):
+        assert rfile.readline() == f"Okey{i}\n".encode()
+    assert time.time() - start < 1.0
+    client.close()
+
+
+@pytest.mark.parametrize("engine", ["threads", "asyncio"])
+def test_iterate_reply_streamed(serve, engine):
+    proceed = threading.Event()
+
+    class StreamingProxy(DictProxy):
+        def handle_iterate(self, parts):
+            yield "Ofirst\t\n"
+            proceed.wait(timeout=5)
+            yield "Osecond\t\n\n"
+
+    sock_path = serve(StreamingProxy(), engine=engine)
+    client, rfile = connect(sock_path)
+    client.sendall(b"I0\t0\tshared/\nLkey\n")
+    # the first chunk arrives before the iteration is complete
+    assert rfile.readline() == b"Ofirst\t\n"
+    proceed.set()
+    assert rfile.readline() == b"Osecond\t\n"
+    assert rfile.readline() == b"\n"
+    assert rfile.readline() == b"N\n"
+    client.close()
+
+
+def test_pipelined_lookups_loop_forever():
+    rfile = io.BytesIO(b"".join(f"Lkey{i}\n".encode() for i in range(8)))
+    wfile = io.BytesIO()
+    start = time.time()
+    SlowProxy().loop_forever(rfile, wfile)
+    assert time.time() - start < 0.3
+    assert wfile.getvalue() == b"".join(f"Okey{i}\n".encode() for i in range(8))
+
+
+def test_asyncio_many_idle_connections(serve):
+    dictproxy = SlowProxy()
+    sock_path = serve(dictproxy, max_workers=2)
+    idle = [connect(sock_path) for _ in range(200)]
+
+    # queued requests wait for one of the two workers
+    busy = [connect(sock_path) for _ in range(6)]
+    for i, (client, _) in enumerate(busy):
+        client.sendall(f"Lkey{i}\n".encode())
+    for i, (_, rfile) in enumerate(busy):
+        assert rfile.readline() == f"Okey{i}\n".encode()
+
+    assert dictproxy.num_connections == len(idle) + len(busy)
+    for client, _ in idle + busy:
+        client.close()
+
+
+def test_control_socket(serve, tmp_path):
+    sock_path = serve(DictProxy())
+    control_path = tmp_path.joinpath("dict.control")
+    wait_for_socket(control_path)
+    reply = send_control_command(str(control_path), "stacks", timeout=5)
+    assert reply.startswith(f"O{tmp_path}/dict-stacks-")
+    client, rfile = connect(sock_path)
+    client.sendall(b"Lkey\tx\n")
+    assert rfile.readline() == b"N\n"
+    client.close()
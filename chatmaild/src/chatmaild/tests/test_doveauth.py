@@ -1,15 +1,20 @@
 import io
 import json
 import queue
+import random
+import shutil
 import threading
 import traceback
 
 import pytest
 
+import chatmaild.accountstore
 import chatmaild.doveauth
+import chatmaild.syslimits
 from chatmaild.doveauth import (
     AuthDictProxy,
     is_allowed_to_create,
+    split_and_unescape,
 )
 from chatmaild.newemail import create_newemail_dict
 
@@ -120,6 +125,19 @@ def test_handle_dovecot_protocol_iterate(gencreds, example_config):
     assert not lines[2]
 
 
+def test_iterate_max_rows_and_chunks(dictproxy, monkeypatch):
+    monkeypatch.setattr(chatmaild.doveauth, "ITERATE_CHUNK_SIZE", 2)
+    for i in range(5):
+        dictproxy.lookup_passdb(f"asdf0000{i}@chat.example.org", "q9mr3faue")
+
+    chunks = list(dictproxy.handle_iterate(["0", "0", "shared/userdb/"]))
+    assert [chunk.count("\t\n") for chunk in chunks] == [2, 2, 1]
+    assert chunks[-1].endswith("\t\n\n")
+
+    chunks = list(dictproxy.handle_iterate(["0", "3", "shared/userdb/"]))
+    assert "".join(chunks).count("Oshared/userdb/") == 3
+
+
 def test_invalid_localpart_characters(make_config):
     """Test that is_allowed_to_create rejects localparts with invalid characters."""
     config = make_config("chat.example.org", {"username_min_length": "3"})
@@ -172,6 +190,8 @@ def test_concurrent_creation_same_account(dictproxy):
 
     # all threads must see the same password hash
     assert len(passwords_seen) == 1
+    user = dictproxy.config.get_user(addr)
+    assert not any(p.name.endswith(".lock") for p in user.maildir.iterdir())
 
 
 def test_50_concurrent_lookups_different_accounts(gencreds, dictproxy):
@@ -211,8 +231,119 @@ def test_insufficient_resources_block_creation_not_existing_logins(
     assert dictproxy.lookup_passdb(addr, password)
 
     monkeypatch.setattr(
-        chatmaild.doveauth, "has_sufficient_resources", lambda config: False
+        chatmaild.syslimits, "get_rejection_reason", lambda config, snapshot: "full"
     )
     newaddr, newpassword = gencreds()
     assert not dictproxy.lookup_passdb(newaddr, newpassword)
     assert dictproxy.lookup_passdb(addr, password)
+
+
+def reference_split_and_unescape(s):
+    # character-by-character implementation which split_and_unescape replaced
+    out = ""
+    i = 0
+    while i < len(s):
+        c = s[i]
+        if c == "\\":
+            i += 1
+            out += s[i]
+        elif c == '"':
+            yield out
+            out = ""
+        else:
+            out += c
+        i += 1
+    yield out
+
+
+def test_split_and_unescape_fuzz():
+    rng = random.Random(42)
+    alphabet = "ab\"\\/@'\t\nä"
+    for _ in range(20000):
+        s = "".join(rng.choices(alphabet, k=rng.randint(0, 24)))
+        try:
+            expected = list(reference_split_and_unescape(s))
+        except IndexError:
+            with pytest.raises(IndexError):
+                split_and_unescape(s)
+        else:
+            assert split_and_unescape(s) == expected, s
+
+
+def userdb_request(addr):
+    return f"Lshared/userdb/{addr}\t{addr}"
+
+
+def test_userdb_cache_hit_without_syscalls(dictproxy, gencreds, monkeypatch):
+    addr, password = gencreds()
+    dictproxy.lookup_passdb(addr, password)
+    first = dictproxy.handle_dovecot_request(userdb_request(addr), {})
+    assert first.startswith("O")
+
+    def fail(*args):
+        raise AssertionError("cached lookup touched the filesystem")
+
+    monkeypatch.setattr(chatmaild.accountstore.os, "stat", fail)
+    monkeypatch.setattr(chatmaild.doveauth.AuthDictProxy, "lookup_userdb", fail)
+    assert dictproxy.handle_dovecot_request(userdb_request(addr), {}) == first
+    # passdb replies are the same as userdb replies
+    msg = f'Lshared/passdb/{password}"{addr}\t{addr}'
+    assert dictproxy.handle_dovecot_request(msg, {}) == first
+
+
+def test_userdb_cache_revalidated_after_ttl(dictproxy, gencreds):
+    dictproxy.userdb_cache.ttl = 0
+    addr, password = gencreds()
+    dictproxy.lookup_passdb(addr, password)
+    assert dictproxy.handle_dovecot_request(userdb_request(addr), {}).startswith("O")
+
+    user = dictproxy.config.get_user(addr)
+    user.set_password("{SHA512-CRYPT}changed")
+    res = dictproxy.handle_dovecot_request(userdb_request(addr), {})
+    assert "changed" in res
+
+    shutil.rmtree(user.maildir)
+    assert dictproxy.handle_dovecot_request(userdb_request(addr), {}) == "N\n"
+
+
+def test_userdb_cache_lru(dictproxy, gencreds):
+    dictproxy.userdb_cache.maxsize = 2
+    addrs = []
+    for _ in range(3):
+        addr, password = gencreds()
+        dictproxy.handle_dovecot_request(
+            f'Lshared/passdb/{password}"{addr}\t{addr}', {}
+        )
+        addrs.append(addr)
+    assert list(dictproxy.userdb_cache._entries) == addrs[1:]
+
+
+def test_userdb_cache_not_revived_after_invalidate(dictproxy, gencreds):
+    dictproxy.userdb_cache.ttl = 0
+    addr, password = gencreds()
+    dictproxy.lookup_passdb(addr, password)
+    dictproxy.handle_dovecot_request(userdb_request(addr), {})
+    cache = dictproxy.userdb_cache
+    assert addr in cache._entries
+    user = dictproxy.config.get_user(addr)
+    get_stamp = user.get_stamp
+
+    def invalidate_while_stamped():
+        # e.g. chatmail-expire invalidates while the stamp is read
+        cache.invalidate(addr)
+        return get_stamp()
+
+    user.get_stamp = invalidate_while_stamped
+    assert cache.get(user) is None
+    assert addr not in cache._entries
+
+
+def test_userdb_cache_invalidate_command(dictproxy, gencreds, tmp_path):
+    addr, password = gencreds()
+    dictproxy.handle_dovecot_request(userdb_request(addr), {})
+    dictproxy.lookup_passdb(addr, password)
+    dictproxy.handle_dovecot_request(userdb_request(addr), {})
+
+    commands = dictproxy.get_control_commands(str(tmp_path), "doveauth")
+    assert commands.invalidate(addr, "other@chat.example.org") == 1
+    assert addr not in dictproxy.userdb_cache._entries
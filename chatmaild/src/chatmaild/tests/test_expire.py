@@ -132,6 +132,18 @@ def test_mbox_without_password(mbox1, example_config, capsys):
     assert not os.path.isdir(mbox_rescan.basedir)
 
 
+def test_remove_leftover_lock_files(mbox1, example_config):
+    basedir = Path(mbox1.basedir)
+    for name in ("password.lock", "metadata.json.lock"):
+        basedir.joinpath(name).touch()
+    exp = Expiry(
+        example_config, dry=False, now=datetime.now().timestamp(), verbose=False
+    )
+    exp.process_mailbox_stat(MailboxStat(basedir))
+    assert not list(basedir.glob("*.lock"))
+    assert basedir.joinpath("password").exists()
+
+
 def test_report_no_mailboxes(example_config):
     args = (str(example_config._inipath),)
     report_main(args)
@@ -280,3 +292,30 @@ def test_quota_expire_main(tmp_path, capsys):
     _, err = capsys.readouterr()
     assert "quota-expire: removed 1 message(s) from user@example.org" in err
     assert not (mbox / "maildirsize").exists()
+
+
+def test_expire_invalidates_doveauth_cache(mbox1, example_config, tmp_path):
+    from chatmaild.control import get_control_socket_path, start_control_server
+    from chatmaild.doveauth import AuthDictProxy
+
+    dictproxy = AuthDictProxy(config=example_config)
+    addr = os.path.basename(mbox1.basedir)
+    user = example_config.get_user(addr)
+    cached = "O{}\n"
+    dictproxy.userdb_cache.put(user, user.get_stamp(), cached)
+
+    runtime_dir = tmp_path.joinpath("run")
+    runtime_dir.mkdir()
+    path = get_control_socket_path(str(runtime_dir), "doveauth")
+    commands = dictproxy.get_control_commands(str(runtime_dir), "doveauth")
+    server = start_control_server(path, commands)
+    try:
+        exp = Expiry(
+            example_config, dry=False, now=datetime.now().timestamp(), verbose=False
+        )
+        exp.remove_mailbox(mbox1.basedir)
+        exp.invalidate_auth_caches(runtime_dir=str(runtime_dir))
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert addr not in dictproxy.userdb_cache._entries
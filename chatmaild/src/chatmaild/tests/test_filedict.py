@@ -1,6 +1,15 @@
+import os
 import threading
+from types import SimpleNamespace
 
-from chatmaild.filedict import FileDict, write_bytes_atomic
+from chatmaild.filedict import (
+    FileDict,
+    LogFileDict,
+    create_bytes_exclusive,
+    get_stamp,
+    stat_stamp,
+    write_bytes_atomic,
+)
 
 
 def test_basic(tmp_path):
@@ -14,6 +23,44 @@ def test_basic(tmp_path):
     assert new["456"] == 4.2
 
 
+def test_stamp(tmp_path):
+    fdict = FileDict(tmp_path.joinpath("metadata"))
+    assert fdict.read_with_stamp() == ({}, None)
+    with fdict.modify() as d:
+        d["x"] = 1
+    assert stat_stamp(fdict.path) == fdict.stamp
+    assert fdict.read_with_stamp() == ({"x": 1}, fdict.stamp)
+    old = fdict.stamp
+    with fdict.modify() as d:
+        d["x"] = 2
+    assert fdict.stamp != old
+
+
+def test_stamp_same_inode_and_mtime():
+    # a rewrite which got the old inode back within the same mtime tick
+    old = dict(st_ino=1, st_mtime_ns=5, st_ctime_ns=5, st_size=10)
+    stamp = get_stamp(SimpleNamespace(**old))
+    assert stamp != get_stamp(SimpleNamespace(**{**old, "st_size": 11}))
+    assert stamp != get_stamp(SimpleNamespace(**{**old, "st_ctime_ns": 6}))
+
+
+def test_concurrent_modify_without_lock_file(tmp_path):
+    fdict = FileDict(tmp_path.joinpath("mailbox", "metadata.json"))
+
+    def increment():
+        for i in range(20):
+            with fdict.modify() as d:
+                d["count"] = d.get("count", 0) + 1
+
+    threads = [threading.Thread(target=increment) for i in range(5)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert fdict.read()["count"] == 100
+    assert [p.name for p in fdict.path.parent.iterdir()] == ["metadata.json"]
+
+
 def test_bad_marshal_file(tmp_path, caplog):
     fdict1 = FileDict(tmp_path.joinpath("metadata"))
     fdict1.path.write_bytes(b"l12k3l12k3l")
@@ -37,3 +84,94 @@ def test_write_bytes_atomic_concurrent(tmp_path):
 
     assert p.read_text().strip() != "hello"
     assert len(list(p.parent.iterdir())) == 1
+
+
+def test_create_bytes_exclusive_concurrent(tmp_path):
+    p = tmp_path.joinpath("password")
+    results = []
+
+    def create(content):
+        results.append((create_bytes_exclusive(p, content), content))
+
+    threads = [
+        threading.Thread(target=create, args=(f"hello{i}".encode(),)) for i in range(30)
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    winners = [content for created, content in results if created]
+    assert len(winners) == 1
+    assert p.read_bytes() == winners[0]
+    assert [x.name for x in tmp_path.iterdir()] == ["password"]
+
+
+def test_log_appends_changes(tmp_path):
+    fdict = LogFileDict(tmp_path.joinpath("metadata.json"))
+    with fdict.modify() as d:
+        d["devicetoken"] = {"a": 1, "b": 2}
+    with fdict.modify() as d:
+        d["devicetoken"]["c"] = 3
+        del d["devicetoken"]["a"]
+    assert not fdict.path.exists()
+    assert fdict.log_path.read_text().splitlines()[1:] == [
+        '["s", ["devicetoken", "c"], 3]',
+        '["d", ["devicetoken", "a"]]',
+    ]
+    assert fdict.read() == {"devicetoken": {"b": 2, "c": 3}}
+    assert fdict.read_with_stamp()[1] == fdict.stamp == fdict.get_stamp()
+
+
+def test_log_compaction(tmp_path):
+    fdict = LogFileDict(tmp_path.joinpath("metadata.json"), max_log_size=100)
+    for i in range(10):
+        with fdict.modify() as d:
+            d.setdefault("devicetoken", {})[f"token{i}"] = i
+    assert fdict.path.exists()
+    assert len(fdict.log_path.read_bytes()) <= 100
+    expected = {f"token{i}": i for i in range(10)}
+    assert fdict.read()["devicetoken"] == expected
+    # the compacted file is readable without the log
+    fdict.log_path.unlink(missing_ok=True)
+    assert FileDict(fdict.path).read()["devicetoken"].items() <= expected.items()
+
+
+def test_log_torn_write(tmp_path, caplog):
+    fdict = LogFileDict(tmp_path.joinpath("metadata.json"))
+    with fdict.modify() as d:
+        d["x"] = 1
+    with fdict.log_path.open("ab") as f:
+        f.write(b'["s", ["x"], 2')
+    assert fdict.read() == {"x": 1}
+    assert "torn" in caplog.records[0].msg
+
+    with fdict.modify() as d:
+        d["y"] = 3
+    assert fdict.read() == {"x": 1, "y": 3}
+    assert fdict.log_path.read_text().count("\n") == 2
+
+
+def test_log_reads_existing_file(tmp_path):
+    FileDict(tmp_path.joinpath("metadata.json")).write_snapshot({"x": 1})
+    fdict = LogFileDict(tmp_path.joinpath("metadata.json"))
+    with fdict.modify() as d:
+        d["x"] = 2
+    assert fdict.read() == {"x": 2}
+    assert FileDict(fdict.path).read() == {"x": 1}
+
+
+def test_log_short_writes(tmp_path, monkeypatch):
+    import chatmaild.filedict
+
+    write = os.write
+    monkeypatch.setattr(
+        chatmaild.filedict.os, "write", lambda fd, data: write(fd, data[:5])
+    )
+    fdict = LogFileDict(tmp_path.joinpath("metadata.json"))
+    with fdict.modify() as d:
+        d["devicetoken"] = {"a": 1}
+    with fdict.modify() as d:
+        d["devicetoken"].update(b=2, c=3)
+    monkeypatch.undo()
+    assert fdict.read() == {"devicetoken": {"a": 1, "b": 2, "c": 3}}
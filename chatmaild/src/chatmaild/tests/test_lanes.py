@@ -0,0 +1,75 @@
+import threading
+import time
+
+import pytest
+
+from chatmaild.doveauth import AuthDictProxy
+from chatmaild.lanes import Lane, LaneFull
+
+
+def test_lane_limits_concurrency():
+    lane = Lane("test", concurrency=1, max_waiting=1)
+    entered = threading.Event()
+    release = threading.Event()
+
+    def occupy():
+        with lane.enter():
+            entered.set()
+            release.wait()
+
+    threads = [threading.Thread(target=occupy) for i in range(2)]
+    threads[0].start()
+    assert entered.wait(timeout=5)
+    threads[1].start()
+    while lane.waiting != 1:
+        time.sleep(0.001)
+    assert lane.active == 1
+
+    with pytest.raises(LaneFull):
+        with lane.enter():
+            pass
+
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert lane.active == lane.waiting == 0
+
+
+def test_unlimited_lane():
+    lane = Lane("test", concurrency=0)
+    with lane.enter(), lane.enter():
+        assert lane.active == 2
+
+
+def test_logins_do_not_wait_for_creations(make_config, gencreds):
+    config = make_config(
+        "chat.example.org",
+        dict(create_lane_concurrency="1", create_lane_queue="0"),
+    )
+    dictproxy = AuthDictProxy(config=config)
+    addr, password = gencreds()
+    dictproxy.lookup_passdb(addr, password)
+
+    started = threading.Event()
+    release = threading.Event()
+
+    def slow_lookup_passdb(addr, password):
+        started.set()
+        release.wait()
+
+    dictproxy.lookup_passdb = slow_lookup_passdb
+    newaddr, newpassword = gencreds()
+    thread = threading.Thread(
+        target=dictproxy.lookup_or_create, args=(newaddr, newpassword)
+    )
+    thread.start()
+    assert started.wait(timeout=5)
+    try:
+        # the create lane is busy and has no queue
+        otheraddr, otherpassword = gencreds()
+        assert dictproxy.lookup_or_create(otheraddr, otherpassword) is None
+        # existing users still log in
+        assert dictproxy.lookup_or_create(addr, password).startswith("O")
+    finally:
+        release.set()
+        thread.join()
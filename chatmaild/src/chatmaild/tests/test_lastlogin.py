@@ -19,7 +19,7 @@ def test_handle_dovecot_request_last_login(testaddr, example_config):
     msg = f"B{tx}\t{testaddr}"
     res = dictproxy.handle_dovecot_request(msg, dictproxy_transactions)
     assert not res
-    assert dictproxy_transactions == {tx: dict(addr=testaddr, res="O\n")}
+    assert dictproxy_transactions == {tx: dict(addr=testaddr, sets=[])}
 
     # set last-login info for user
     user = dictproxy.config.get_user(testaddr)
@@ -28,11 +28,50 @@ def test_handle_dovecot_request_last_login(testaddr, example_config):
     res = dictproxy.handle_dovecot_request(msg, dictproxy_transactions)
     assert not res
     assert len(dictproxy_transactions) == 1
-    read_timestamp = user.get_last_login_timestamp()
-    assert read_timestamp == timestamp // 86400 * 86400
 
     # finish transaction
     msg = f"C{tx}"
     res = dictproxy.handle_dovecot_request(msg, dictproxy_transactions)
     assert res == "O\n"
     assert len(dictproxy_transactions) == 0
+    dictproxy.flush()
+    read_timestamp = user.get_last_login_timestamp()
+    assert read_timestamp == timestamp // 86400 * 86400
+
+
+def test_repeated_login_same_day(testaddr, example_config, monkeypatch):
+    dictproxy = LastLoginDictProxy(config=example_config)
+    AuthDictProxy(config=example_config).lookup_passdb(testaddr, "1l2k3j1l2k3jl123")
+    user = example_config.get_user(testaddr)
+    timestamp = int(time.time()) // 86400 * 86400
+
+    dictproxy.mark_login(testaddr, timestamp + 100)
+    dictproxy.flush()
+    assert user.get_last_login_timestamp() == timestamp
+
+    def fail(*args, **kwargs):
+        raise AssertionError("unexpected syscall")
+
+    monkeypatch.setattr("chatmaild.accountstore.os.stat", fail)
+    monkeypatch.setattr("chatmaild.accountstore.os.utime", fail)
+    dictproxy.mark_login(testaddr, timestamp + 200)
+    dictproxy.mark_login(testaddr, timestamp - 86400)
+    assert not dictproxy.pending
+    dictproxy.flush()
+
+    monkeypatch.undo()
+    dictproxy.mark_login(testaddr, timestamp + 86400)
+    assert dictproxy.pending == {testaddr: timestamp + 86400}
+
+
+def test_flush_when_stopping(testaddr, example_config):
+    dictproxy = LastLoginDictProxy(config=example_config)
+    AuthDictProxy(config=example_config).lookup_passdb(testaddr, "1l2k3j1l2k3jl123")
+    user = example_config.get_user(testaddr)
+    timestamp = int(time.time()) - 86400 * 3
+
+    dictproxy.start_flusher()
+    dictproxy.mark_login(testaddr, timestamp)
+    dictproxy.stop_serving()
+    assert not dictproxy.pending
+    assert user.get_last_login_timestamp() == timestamp // 86400 * 86400
@@ -0,0 +1,170 @@
+import pytest
+
+import chatmaild.mailboxes
+from chatmaild.config import read_config
+from chatmaild.doveauth import AuthDictProxy
+from chatmaild.expire import daily_expire_main, iter_mailboxes
+from chatmaild.mailboxes import (
+    SHARDED_MARKER,
+    Sharder,
+    get_shard,
+    iter_mailbox_dirs,
+    main,
+)
+
+
+@pytest.fixture
+def sharded_config(make_config):
+    return make_config("chat.example.org", dict(mailboxes_layout="sharded"))
+
+
+def test_invalid_layout(make_config):
+    with pytest.raises(ValueError):
+        make_config("chat.example.org", dict(mailboxes_layout="nested"))
+
+
+def test_sharded_user(sharded_config, testaddr):
+    user = sharded_config.get_user(testaddr)
+    shard = get_shard(testaddr)
+    assert len(shard) == 2
+    assert user.maildir == sharded_config.mailboxes_dir / shard / testaddr
+    assert user.password_path == user.maildir / "password"
+
+
+def test_flat_fallback_until_sharded(sharded_config):
+    testaddr = "user.name@chat.example.org"
+    flatdir = sharded_config.mailboxes_dir / testaddr
+    flatdir.mkdir()
+    assert sharded_config.get_user(testaddr).maildir == flatdir
+
+    # after all mailboxes were moved running processes don't look for flat ones
+    sharded_config.mailboxes_dir.joinpath(SHARDED_MARKER).touch()
+    assert sharded_config.get_user(testaddr).maildir != flatdir
+
+
+def test_read_config_does_not_check_sharding(sharded_config, monkeypatch):
+    def fail(*args):
+        raise AssertionError("reading the config checked the mailboxes dir")
+
+    monkeypatch.setattr(chatmaild.mailboxes, "is_fully_sharded", fail)
+    read_config(sharded_config._inipath)
+
+
+def test_iter_mailbox_dirs(sharded_config, gencreds):
+    flat_addr, _ = gencreds()
+    sharded_addr, _ = gencreds()
+    mailboxes_dir = sharded_config.mailboxes_dir
+    mailboxes_dir.joinpath(flat_addr).mkdir()
+    mailboxes_dir.joinpath("pending_notifications").mkdir()
+    sharded_config.get_user(sharded_addr).maildir.mkdir(parents=True)
+
+    found = dict(iter_mailbox_dirs(mailboxes_dir))
+    assert set(found) == {flat_addr, sharded_addr}
+    assert found[sharded_addr] == str(sharded_config.get_user(sharded_addr).maildir)
+    assert len(list(iter_mailboxes(str(mailboxes_dir), maxnum=1))) == 1
+
+
+def test_doveauth_with_sharded_layout(sharded_config, gencreds):
+    dictproxy = AuthDictProxy(config=sharded_config)
+    addr, password = gencreds()
+    userdata = dictproxy.lookup_passdb(addr, password)
+    assert userdata["home"] == str(
+        sharded_config.mailboxes_dir / get_shard(addr) / addr
+    )
+    assert list(dictproxy.iter_userdb()) == [addr]
+
+
+def test_sharder_moves_and_merges(sharded_config, gencreds):
+    mailboxes_dir = sharded_config.mailboxes_dir
+    addrs = [gencreds()[0] for i in range(5)]
+    for addr in addrs:
+        flatdir = mailboxes_dir / addr
+        flatdir.joinpath("cur").mkdir(parents=True)
+        flatdir.joinpath("password").write_text("xxx")
+        flatdir.joinpath("cur", "msg1").write_text("hello")
+
+    # dovecot delivered to a stray shard location of the first address
+    stray = mailboxes_dir / get_shard(addrs[0]) / addrs[0]
+    stray.joinpath("new").mkdir(parents=True)
+    stray.joinpath("new", "msg2").write_text("hello")
+    # and to the flat location of an already moved second address
+    moved = mailboxes_dir / get_shard(addrs[1]) / addrs[1]
+    moved.parent.mkdir(exist_ok=True)
+    (mailboxes_dir / addrs[1]).rename(moved)
+    mailboxes_dir.joinpath(addrs[1], "new").mkdir(parents=True)
+    mailboxes_dir.joinpath(addrs[1], "new", "msg3").write_text("hello")
+
+    flushed = []
+    sharder = Sharder(mailboxes_dir)
+    sharder.run(chunk=2, flush=flushed.extend)
+    assert (sharder.moved, sharder.merged) == (3, 2)
+    assert sorted(set(flushed)) == sorted(addrs)
+    assert mailboxes_dir.joinpath(SHARDED_MARKER).exists()
+
+    for addr, path in iter_mailbox_dirs(mailboxes_dir):
+        assert path == str(mailboxes_dir / get_shard(addr) / addr)
+    shard0 = mailboxes_dir / get_shard(addrs[0]) / addrs[0]
+    assert shard0.joinpath("password").exists()
+    assert shard0.joinpath("cur", "msg1").exists()
+    assert shard0.joinpath("new", "msg2").exists()
+    assert moved.joinpath("new", "msg3").exists()
+    assert sorted(addr for addr, path in iter_mailbox_dirs(mailboxes_dir)) == sorted(
+        addrs
+    )
+
+
+def test_sharder_moves_mailboxes_recreated_after_marker(sharded_config):
+    mailboxes_dir = sharded_config.mailboxes_dir
+    addr = "user00001@chat.example.org"
+    mailboxes_dir.joinpath(addr, "cur").mkdir(parents=True)
+    flushed = []
+
+    def flush(addrs):
+        flushed.append(addrs)
+        # a process which did not see the marker yet recreates a flat mailbox
+        if len(flushed) == 2:
+            mailboxes_dir.joinpath(addr, "new").mkdir(parents=True)
+
+    sharder = Sharder(mailboxes_dir)
+    sharder.run(flush=flush)
+    assert (sharder.moved, sharder.merged) == (1, 1)
+    assert not mailboxes_dir.joinpath(addr).exists()
+    assert mailboxes_dir.joinpath(get_shard(addr), addr, "new").exists()
+
+
+def test_expire_moves_flat_mailboxes_when_sharded(sharded_config):
+    mailboxes_dir = sharded_config.mailboxes_dir
+    Sharder(mailboxes_dir).run()
+    addr = "user00001@chat.example.org"
+    mailboxes_dir.joinpath(addr, "new").mkdir(parents=True)
+
+    daily_expire_main(args=[str(sharded_config._inipath)])
+    assert mailboxes_dir.joinpath(addr).exists()
+    daily_expire_main(args=["--remove", str(sharded_config._inipath)])
+    assert not mailboxes_dir.joinpath(addr).exists()
+    assert mailboxes_dir.joinpath(get_shard(addr), addr, "new").exists()
+
+
+def test_sharder_asks_account_store(make_config):
+    config = make_config(
+        "chat.example.org", dict(mailboxes_layout="sharded", account_store="sqlite")
+    )
+    mailboxes_dir = config.mailboxes_dir
+    addr = "user00001@chat.example.org"
+    # the sqlite store writes no password file into the shard
+    assert config.get_user(addr).create("l1k2j31lk2j3l1k23j123")
+    shard = mailboxes_dir / get_shard(addr) / addr
+    assert shard.joinpath("enforceE2EEincoming").exists()
+    # Dovecot delivered to the flat location with a stale cached location
+    mailboxes_dir.joinpath(addr, "new").mkdir(parents=True)
+    mailboxes_dir.joinpath(addr, "new", "msg1").write_text("hello")
+
+    assert main([str(config._inipath)]) == 0
+    assert not mailboxes_dir.joinpath(addr).exists()
+    assert shard.joinpath("enforceE2EEincoming").exists()
+    assert shard.joinpath("new", "msg1").exists()
+
+
+def test_main_requires_sharded_layout(example_config, capsys):
+    assert main([str(example_config._inipath)]) == 1
+    assert "mailboxes_layout" in capsys.readouterr().err
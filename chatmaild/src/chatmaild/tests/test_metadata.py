@@ -5,6 +5,7 @@ import time
 import pytest
 import requests
 
+from chatmaild.filedict import FileDict
 from chatmaild.metadata import (
     Metadata,
     MetadataDictProxy,
@@ -14,6 +15,8 @@ from chatmaild.notifier import (
     Notifier,
     NotifyThread,
     PersistentQueueItem,
+    adopt_worker_queue_dirs,
+    get_worker_queue_dir,
 )
 
 
@@ -79,6 +82,32 @@ def test_metadata_persistence(tmp_path, testaddr, testaddr2):
     assert metadata1.get_tokens_for_addr(testaddr2) == ["456"]
 
 
+def test_metadata_log(tmp_path, testaddr):
+    metadata1 = Metadata(tmp_path, log_size=1000)
+    metadata2 = Metadata(tmp_path, log_size=1000)
+    metadata1.add_token_to_addr(testaddr, "01234")
+    assert metadata2.get_tokens_for_addr(testaddr) == ["01234"]
+    metadata1.add_token_to_addr(testaddr, "56789")
+    metadata1.remove_token_from_addr(testaddr, "01234")
+    assert metadata2.get_tokens_for_addr(testaddr) == ["56789"]
+    assert tmp_path.joinpath(testaddr, "metadata.json.log").exists()
+
+
+def test_metadata_log_toggled(tmp_path, testaddr):
+    Metadata(tmp_path, log_size=1000).add_tokens_to_addr(testaddr, ["tok1", "tok2"])
+    log_path = tmp_path.joinpath(testaddr, "metadata.json.log")
+    assert log_path.exists()
+
+    metadata = Metadata(tmp_path, log_size=0)
+    assert sorted(metadata.get_tokens_for_addr(testaddr)) == ["tok1", "tok2"]
+    metadata.remove_token_from_addr(testaddr, "tok1")
+    metadata.add_token_to_addr(testaddr, "tok3")
+    assert not log_path.exists()
+
+    metadata = Metadata(tmp_path, log_size=1000)
+    assert sorted(metadata.get_tokens_for_addr(testaddr)) == ["tok2", "tok3"]
+
+
 def test_remove_nonexisting(metadata, tmp_path, testaddr):
     metadata.add_token_to_addr(testaddr, "123")
     metadata.remove_token_from_addr(testaddr, "1l23k1l2k3")
@@ -90,6 +119,52 @@ def test_notifier_remove_without_set(metadata, testaddr):
     assert not metadata.get_tokens_for_addr(testaddr)
 
 
+def test_tokens_cached_without_reads(metadata, testaddr, monkeypatch):
+    metadata.add_token_to_addr(testaddr, "123")
+
+    def fail(*args):
+        raise AssertionError("unexpected read")
+
+    monkeypatch.setattr(FileDict, "read_with_stamp", fail)
+    for i in range(3):
+        assert metadata.get_tokens_for_addr(testaddr) == ["123"]
+
+
+def test_expired_tokens_swept(metadata, testaddr):
+    with metadata.get_metadata_dict(testaddr).modify() as data:
+        data[metadata.DEVICETOKEN_KEY] = {"old": 1000, "new": int(time.time())}
+    assert metadata.get_tokens_for_addr(testaddr) == ["new"]
+    # expired tokens are only skipped on the delivery path
+    mdict = metadata.get_metadata_dict(testaddr)
+    assert "old" in mdict.read()[metadata.DEVICETOKEN_KEY]
+
+    metadata.sweep_expired_tokens()
+    assert list(mdict.read()[metadata.DEVICETOKEN_KEY]) == ["new"]
+    assert metadata.get_tokens_for_addr(testaddr) == ["new"]
+
+
+def test_expired_tokens_swept_uncached(metadata, testaddr, testaddr2):
+    with metadata.get_metadata_dict(testaddr).modify() as data:
+        data[metadata.DEVICETOKEN_KEY] = {"old": 1000, "new": int(time.time())}
+    metadata.add_token_to_addr(testaddr2, "456")
+
+    # a fresh process has no cached tokens and walks all mailboxes
+    metadata = Metadata(metadata.vmail_dir)
+    metadata.sweep_expired_tokens()
+    mdict = metadata.get_metadata_dict(testaddr)
+    assert list(mdict.read()[metadata.DEVICETOKEN_KEY]) == ["new"]
+    assert metadata.get_tokens_for_addr(testaddr2) == ["456"]
+
+
+def test_token_cache_size(tmp_path, testaddr, testaddr2):
+    metadata = Metadata(tmp_path, cache_size=1)
+    metadata.add_token_to_addr(testaddr, "123")
+    metadata.add_token_to_addr(testaddr2, "456")
+    assert list(metadata._token_cache) == [testaddr2]
+    assert metadata.get_tokens_for_addr(testaddr) == ["123"]
+    assert list(metadata._token_cache) == [testaddr]
+
+
 def test_handle_dovecot_request_lookup_fails(dictproxy, testaddr):
     transactions = {}
     res = dictproxy.handle_dovecot_request(
@@ -108,13 +183,13 @@ def test_handle_dovecot_request_happy_path(dictproxy, testaddr, token):
     msg = f"B{tx}\t{testaddr}"
     res = dictproxy.handle_dovecot_request(msg, transactions)
     assert not res and not metadata.get_tokens_for_addr(testaddr)
-    assert transactions == {tx: dict(addr=testaddr, res="O\n")}
+    assert transactions == {tx: dict(addr=testaddr, sets=[])}
 
     msg = f"S{tx}\tpriv/guid00/devicetoken\t{token}"
     res = dictproxy.handle_dovecot_request(msg, transactions)
     assert not res
     assert len(transactions) == 1
-    assert metadata.get_tokens_for_addr(testaddr) == [token]
+    assert not metadata.get_tokens_for_addr(testaddr)
 
     msg = f"C{tx}"
     res = dictproxy.handle_dovecot_request(msg, transactions)
@@ -127,13 +202,50 @@ def test_handle_dovecot_request_happy_path(dictproxy, testaddr, token):
     assert dictproxy.handle_dovecot_request(f"B{tx2}\t{testaddr}", transactions) is None
     msg = f"S{tx2}\tpriv/guid00/messagenew"
     assert dictproxy.handle_dovecot_request(msg, transactions) is None
-    queue_item = notifier.retry_queues[0].get()[1]
-    assert queue_item.token == token
+    assert notifier.retry_queues[0].empty()
     assert dictproxy.handle_dovecot_request(f"C{tx2}", transactions) == "O\n"
     assert not transactions
+    queue_item = notifier.retry_queues[0].get()[1]
+    assert queue_item.token == token
     assert queue_item.path.exists()
 
 
+def test_handle_dovecot_request_batched_messagenew(dictproxy, testaddr, token):
+    notifier = dictproxy.notifier
+    dictproxy.metadata.add_token_to_addr(testaddr, token)
+    transactions = {}
+    dictproxy.handle_dovecot_request(f"B1\t{testaddr}", transactions)
+    dictproxy.handle_dovecot_request("S1\tpriv/guid00/messagenew\t50", transactions)
+    dictproxy.handle_dovecot_request("S1\tpriv/guid01/messagenew\t2", transactions)
+    assert dictproxy.handle_dovecot_request("C1", transactions) == "O\n"
+    assert notifier.retry_queues[0].qsize() == 1
+    assert notifier.retry_queues[0].get()[1].token == token
+
+
+def test_handle_dovecot_request_batched_tokens(dictproxy, testaddr):
+    transactions = {}
+    dictproxy.handle_dovecot_request(f"B1\t{testaddr}", transactions)
+    for token in ("t1", "t2", "t3"):
+        msg = f"S1\tpriv/guid00/devicetoken\t{token}"
+        dictproxy.handle_dovecot_request(msg, transactions)
+    assert dictproxy.handle_dovecot_request("C1", transactions) == "O\n"
+    assert sorted(dictproxy.metadata.get_tokens_for_addr(testaddr)) == [
+        "t1",
+        "t2",
+        "t3",
+    ]
+
+
+def test_handle_dovecot_request_rollback(dictproxy, testaddr, token):
+    transactions = {}
+    dictproxy.handle_dovecot_request(f"B1\t{testaddr}", transactions)
+    msg = f"S1\tpriv/guid00/devicetoken\t{token}"
+    dictproxy.handle_dovecot_request(msg, transactions)
+    assert dictproxy.handle_dovecot_request("R1", transactions) is None
+    assert not transactions
+    assert not dictproxy.metadata.get_tokens_for_addr(testaddr)
+
+
 def test_handle_dovecot_protocol_set_devicetoken(dictproxy):
     rfile = io.BytesIO(
         b"\n".join(
@@ -316,6 +428,22 @@ def test_persistent_queue_items(tmp_path, testaddr, token):
     assert not queue_item < item2 and not item2 < queue_item
 
 
+def test_adopt_worker_queue_dirs(notifier, testaddr, token):
+    queue_dir = notifier.queue_dir
+    assert get_worker_queue_dir(queue_dir, 0) == queue_dir
+    for worker_num in (1, 2, 3):
+        worker_dir = get_worker_queue_dir(queue_dir, worker_num)
+        worker_dir.mkdir()
+        PersistentQueueItem.create(worker_dir, testaddr, time.time(), token)
+
+    adopt_worker_queue_dirs(queue_dir, num_workers=2)
+    assert len(list(queue_dir.iterdir())) == 2
+    assert len(list(get_worker_queue_dir(queue_dir, 1).iterdir())) == 1
+    assert not get_worker_queue_dir(queue_dir, 2).exists()
+    notifier.requeue_persistent_queue_items()
+    assert notifier.retry_queues[0].qsize() == 2
+
+
 def test_turn_credentials_exception_returns_N(notifier, metadata, monkeypatch):
     """Test that turn_credentials() failure returns N\\n instead of crashing."""
     import chatmaild.metadata
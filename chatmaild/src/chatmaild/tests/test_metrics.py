@@ -0,0 +1,74 @@
+import pytest
+
+from chatmaild.doveauth import AuthDictProxy
+from chatmaild.metrics import REGISTRY, Registry
+from chatmaild.user import FS_OPS
+
+
+@pytest.fixture
+def registry():
+    return Registry()
+
+
+def test_counter_render(registry):
+    counter = registry.counter("test_total", "Test counter.", ["kind"])
+    assert registry.counter("test_total", "Test counter.", ["kind"]) is counter
+    counter.inc(kind="a")
+    counter.inc(3, kind="b")
+    counter.inc(kind="a")
+    assert counter.get(kind="a") == 2
+    lines = registry.render(service="doveauth").splitlines()
+    assert lines == [
+        "# HELP test_total Test counter.",
+        "# TYPE test_total counter",
+        'test_total{kind="a",service="doveauth"} 2',
+        'test_total{kind="b",service="doveauth"} 3',
+    ]
+
+
+def test_gauge_function(registry):
+    gauge = registry.gauge("test_depth", "Test gauge.")
+    values = [5]
+    gauge.set_function(lambda: values[0])
+    assert "test_depth 5" in registry.render()
+    values[0] = 7
+    assert gauge.get() == 7
+
+
+def test_histogram_quantiles(registry):
+    hist = registry.histogram("test_seconds", "Test.", ["command"], buckets=(1, 2, 4))
+    assert hist.quantile(0.5, command="L") is None
+    for value in [0.5] * 50 + [1.5] * 49 + [3]:
+        hist.observe(value, command="L")
+    assert hist.count(command="L") == 100
+    assert hist.quantile(0.5, command="L") == 1.0
+    assert 1 < hist.quantile(0.99, command="L") <= 2
+    text = registry.render()
+    assert 'test_seconds_bucket{command="L",le="1"} 50' in text
+    assert 'test_seconds_bucket{command="L",le="4"} 100' in text
+    assert 'test_seconds_bucket{command="L",le="+Inf"} 100' in text
+    assert 'test_seconds_count{command="L"} 100' in text
+
+
+def test_dump_textfile(registry, tmp_path):
+    registry.counter("test_total", "Test counter.").inc()
+    path = tmp_path / "chatmail-doveauth.prom"
+    registry.dump_textfile(path, service="doveauth")
+    assert 'test_total{service="doveauth"} 1' in path.read_text()
+    assert [p.name for p in tmp_path.iterdir()] == [path.name]
+
+
+def test_dictproxy_request_metrics(example_config):
+    dictproxy = AuthDictProxy(config=example_config)
+    requests = REGISTRY.counter("chatmail_dictproxy_requests_total", "", ())
+    latency = REGISTRY.histogram("chatmail_dictproxy_request_seconds", "", ())
+    lookups = requests.get(command="L", reply="N")
+    count = latency.count(command="L")
+    reads = FS_OPS.get(op="read_password")
+
+    msg = "Lshared/userdb/nobody123@chat.example.org\tnobody123@chat.example.org"
+    assert dictproxy.handle_dovecot_request(msg, {}) == "N\n"
+    assert requests.get(command="L", reply="N") == lookups + 1
+    assert latency.count(command="L") == count + 1
+    # without the account filter nonexistent addresses are looked up on disk
+    assert FS_OPS.get(op="read_password") == reads + 1
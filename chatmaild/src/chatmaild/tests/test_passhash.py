@@ -0,0 +1,108 @@
+import json
+import os
+import time
+from concurrent.futures.process import BrokenProcessPool
+
+import psutil
+import pytest
+
+from chatmaild.doveauth import AuthDictProxy
+from chatmaild.passhash import (
+    PASSWORD_HASHES,
+    SHARED_POOL,
+    HashingOverloaded,
+    PasswordHasher,
+    crypt_r,
+)
+
+
+def check_password(enc_password, password):
+    assert enc_password.startswith("{SHA512-CRYPT}$6$")
+    passhash = enc_password.removeprefix("{SHA512-CRYPT}")
+    assert crypt_r.crypt(password, passhash) == passhash
+
+
+@pytest.mark.parametrize("processes", [0, 1])
+def test_encrypt(processes):
+    hasher = PasswordHasher(processes, max_pending=4)
+    check_password(hasher.encrypt("q9mr3faue"), "q9mr3faue")
+    assert hasher.pending == 0
+
+
+def test_encrypt_overloaded():
+    hasher = PasswordHasher(1, max_pending=2)
+    hasher.pending = 2
+    rejected = PASSWORD_HASHES.get(result="rejected")
+    with pytest.raises(HashingOverloaded):
+        hasher.encrypt("q9mr3faue")
+    assert PASSWORD_HASHES.get(result="rejected") == rejected + 1
+    assert hasher.pending == 2
+
+
+def test_creation_fails_fast_when_overloaded(example_config, gencreds):
+    dictproxy = AuthDictProxy(config=example_config)
+    dictproxy.password_hasher.pending = dictproxy.password_hasher.max_pending
+    addr, password = gencreds()
+    assert not dictproxy.lookup_passdb(addr, password)
+    assert not dictproxy.lookup_userdb(addr)
+
+    dictproxy.password_hasher.pending = 0
+    assert dictproxy.lookup_passdb(addr, password)
+
+
+def test_creation_fails_when_hashing_process_died(example_config, gencreds):
+    dictproxy = AuthDictProxy(config=example_config)
+
+    def encrypt(password):
+        raise BrokenProcessPool("hashing process died")
+
+    dictproxy.password_hasher.encrypt = encrypt
+    addr, password = gencreds()
+    assert not dictproxy.lookup_passdb(addr, password)
+    assert not dictproxy.lookup_userdb(addr)
+
+
+def hash_in_forked_owner(stop):
+    """Hash a password in a forked process owning the pool,
+    which exits with os._exit(), and return the pids of its pool."""
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            hasher = PasswordHasher(1, max_pending=4)
+            hasher.encrypt("q9mr3faue")
+            pids = list(SHARED_POOL.executor._processes)
+            if stop is not None:
+                stop(hasher)
+            os.write(write_fd, json.dumps(pids).encode())
+        finally:
+            os._exit(0)
+    os.close(write_fd)
+    with os.fdopen(read_fd) as f:
+        pids = json.loads(f.read())
+    os.waitpid(pid, 0)
+    assert pids
+    return pids
+
+
+def is_running(pid):
+    try:
+        return psutil.Process(pid).status() != psutil.STATUS_ZOMBIE
+    except psutil.NoSuchProcess:
+        return False
+
+
+def test_shutdown_stops_hashing_processes(example_config):
+    def stop(hasher):
+        AuthDictProxy(config=example_config).stop_serving()
+
+    pids = hash_in_forked_owner(stop)
+    assert not any(is_running(pid) for pid in pids)
+
+
+def test_hashing_processes_exit_with_owner():
+    pids = hash_in_forked_owner(stop=None)
+    deadline = time.time() + 10
+    while any(is_running(pid) for pid in pids):
+        assert time.time() < deadline, "hashing processes outlived their owner"
+        time.sleep(0.1)
@@ -0,0 +1,155 @@
+import os
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import psutil
+import pytest
+
+from chatmaild.prefork import Supervisor
+
+
+def wait_for(func, timeout=10):
+    deadline = time.time() + timeout
+    while not (res := func()):
+        assert time.time() < deadline, f"timed out waiting for {func}"
+        time.sleep(0.05)
+    return res
+
+
+@pytest.fixture
+def doveauth_prefork(make_config, tmp_path):
+    config = make_config("chat.example.org", {"dictproxy_processes": "3"})
+    sock_path = tmp_path.joinpath("doveauth.socket")
+    code = "import sys; from chatmaild.doveauth import main; sys.exit(main())"
+    proc = subprocess.Popen(
+        [sys.executable, "-c", code, str(sock_path), str(config._inipath)]
+    )
+    wait_for(sock_path.exists)
+    yield proc, sock_path
+    proc.terminate()
+    proc.wait(timeout=10)
+
+
+def lookup_userdb(sock_path, addr):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.settimeout(5)
+        client.connect(str(sock_path))
+        client.sendall(f"Lshared/userdb/{addr}\t{addr}\n".encode())
+        return client.makefile("rb").readline()
+
+
+def test_workers_serve_and_restart(doveauth_prefork):
+    proc, sock_path = doveauth_prefork
+    supervisor = psutil.Process(proc.pid)
+    workers = wait_for(
+        lambda: len(supervisor.children()) == 3 and supervisor.children()
+    )
+
+    for _ in range(10):
+        assert lookup_userdb(sock_path, "nobody123@chat.example.org") == b"N\n"
+
+    os.kill(workers[0].pid, signal.SIGKILL)
+    wait_for(lambda: workers[0].pid not in [p.pid for p in supervisor.children()])
+    new_workers = wait_for(
+        lambda: len(supervisor.children()) == 3 and supervisor.children()
+    )
+    assert workers[0].pid not in [p.pid for p in new_workers]
+    assert lookup_userdb(sock_path, "nobody123@chat.example.org") == b"N\n"
+
+    proc.terminate()
+    assert proc.wait(timeout=10) == 0
+    for worker in new_workers:
+        assert not worker.is_running() or worker.status() == psutil.STATUS_ZOMBIE
+
+
+def test_supervisor_restarts_only_until_stopped(monkeypatch):
+    spawned = []
+
+    class FakeSupervisor(Supervisor):
+        def spawn(self, worker_num):
+            spawned.append(worker_num)
+            pid = 1000 + len(spawned)
+            self.workers[pid] = (worker_num, time.monotonic() - 10)
+            return pid
+
+    supervisor = FakeSupervisor(2, run_worker=None)
+    exits = [(1001, 256), "stop", (1002, 0)]
+
+    def fake_waitpid(pid, options):
+        if not exits:
+            raise ChildProcessError()
+        res = exits.pop(0)
+        if res == "stop":
+            supervisor.stop()
+            res = exits.pop(0)
+        return res
+
+    monkeypatch.setattr(os, "waitpid", fake_waitpid)
+    monkeypatch.setattr(os, "kill", lambda pid, sig: None)
+    monkeypatch.setattr(signal, "signal", lambda *args: None)
+    supervisor.run()
+    # worker 0 was restarted after it crashed, worker 1 not after stopping
+    assert spawned == [0, 1, 0]
+
+
+def test_worker_cleanup_runs_before_exit(tmp_path):
+    path = tmp_path.joinpath("cleaned")
+
+    def run_worker(worker_num):
+        raise RuntimeError("serving failed")
+
+    supervisor = Supervisor(1, run_worker, cleanup=path.touch)
+    pid = supervisor.spawn(0)
+    _, status = os.waitpid(pid, 0)
+    assert os.waitstatus_to_exitcode(status) == 1
+    assert path.exists()
+
+
+def test_handoff_does_not_block_restarts(monkeypatch):
+    spawned = []
+    handoff_started = threading.Event()
+    handoff_done = threading.Event()
+
+    class FakeSupervisor(Supervisor):
+        RESTART_DELAY = 0
+        POLL_INTERVAL = 0.01
+
+        def spawn(self, worker_num):
+            spawned.append(worker_num)
+            pid = 1000 + len(spawned)
+            self.workers[pid] = (worker_num, time.monotonic() - 10)
+            return pid
+
+    def handoff():
+        handoff_started.set()
+        handoff_done.wait(timeout=10)
+        return True
+
+    supervisor = FakeSupervisor(1, run_worker=None, handoff=handoff)
+
+    def fake_waitpid(pid, options):
+        if not handoff_started.is_set():
+            if not supervisor.hangup_requested:
+                supervisor.hangup()
+            return 0, 0
+        if len(spawned) == 1:
+            # the first worker crashes while the handoff is waiting
+            return 1001, 256
+        if len(spawned) == 2:
+            handoff_done.set()
+            if supervisor.stopping:
+                return 1002, 0
+        return 0, 0
+
+    monkeypatch.setattr(os, "waitpid", fake_waitpid)
+    monkeypatch.setattr(os, "kill", lambda pid, sig: None)
+    monkeypatch.setattr(signal, "signal", lambda *args: None)
+    monkeypatch.setattr("chatmaild.prefork.notify_ready", lambda: None)
+    supervisor.run()
+    # the crashed worker was restarted during the handoff, then all stopped
+    assert spawned == [0, 0]
+    assert supervisor.handed_over and supervisor.stopping
@@ -0,0 +1,136 @@
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+import psutil
+import pytest
+
+import chatmaild.systemd
+from chatmaild.systemd import get_inherited_socket, notify
+
+
+def wait_for(func, timeout=10):
+    deadline = time.time() + timeout
+    while not (res := func()):
+        assert time.time() < deadline, f"timed out waiting for {func}"
+        time.sleep(0.05)
+    return res
+
+
+@pytest.fixture
+def listen_sock(tmp_path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(str(tmp_path / "listen.socket"))
+    sock.listen()
+    yield sock
+    sock.close()
+
+
+def test_get_inherited_socket_from_systemd(listen_sock, monkeypatch):
+    monkeypatch.setattr(chatmaild.systemd, "LISTEN_FDS_START", listen_sock.fileno())
+    monkeypatch.setenv("LISTEN_PID", str(os.getpid()))
+    monkeypatch.setenv("LISTEN_FDS", "1")
+    sock = get_inherited_socket()
+    assert sock.fileno() == listen_sock.fileno()
+    assert sock.getsockname() == listen_sock.getsockname()
+    assert "LISTEN_FDS" not in os.environ
+    sock.detach()
+
+
+def test_get_inherited_socket_ignores_other_pid(listen_sock, monkeypatch):
+    monkeypatch.setattr(chatmaild.systemd, "LISTEN_FDS_START", listen_sock.fileno())
+    monkeypatch.setenv("LISTEN_PID", str(os.getpid() + 1))
+    monkeypatch.setenv("LISTEN_FDS", "1")
+    assert get_inherited_socket() is None
+    assert "LISTEN_PID" not in os.environ
+
+
+def test_notify(tmp_path, monkeypatch):
+    assert not notify("READY=1")
+    path = str(tmp_path / "notify.socket")
+    with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as server:
+        server.bind(path)
+        monkeypatch.setenv("NOTIFY_SOCKET", path)
+        assert notify("READY=1")
+        assert server.recv(100) == b"READY=1"
+
+
+@pytest.fixture
+def start_doveauth(make_config, tmp_path):
+    procs = []
+
+    def start(engine, env=None):
+        config = make_config("chat.example.org", {"dictproxy_engine": engine})
+        sock_path = tmp_path.joinpath("doveauth.socket")
+        code = "import sys; from chatmaild.doveauth import main; sys.exit(main())"
+        proc = subprocess.Popen(
+            [sys.executable, "-c", code, str(sock_path), str(config._inipath)],
+            env=dict(os.environ, **(env or {})),
+        )
+        procs.append(proc)
+        wait_for(sock_path.exists)
+        return proc, sock_path
+
+    yield start
+    for proc in procs:
+        if proc.poll() is None:
+            for child in psutil.Process(proc.pid).children(recursive=True):
+                child.kill()
+            proc.kill()
+            proc.wait()
+
+
+def connect(sock_path):
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.settimeout(5)
+    client.connect(str(sock_path))
+    return client, client.makefile("rb")
+
+
+def lookup(client, rfile):
+    client.sendall(b"Lshared/userdb/nobody123@chat.example.org\tx\n")
+    return rfile.readline()
+
+
+@pytest.mark.parametrize("engine", ["threads", "asyncio"])
+def test_sigterm_closes_idle_connections(start_doveauth, engine):
+    proc, sock_path = start_doveauth(engine)
+    client, rfile = connect(sock_path)
+    assert lookup(client, rfile) == b"N\n"
+    proc.send_signal(signal.SIGTERM)
+    assert rfile.readline() == b""
+    assert proc.wait(timeout=10) == 0
+    client.close()
+
+
+@pytest.mark.parametrize("engine", ["threads", "asyncio"])
+def test_sighup_hands_over_listening_socket(start_doveauth, engine, tmp_path):
+    notify_path = str(tmp_path / "notify.socket")
+    notify_sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    notify_sock.bind(notify_path)
+    notify_sock.settimeout(10)
+
+    proc, sock_path = start_doveauth(engine, env=dict(NOTIFY_SOCKET=notify_path))
+    assert notify_sock.recv(100) == b"READY=1"
+    client, rfile = connect(sock_path)
+    assert lookup(client, rfile) == b"N\n"
+
+    proc.send_signal(signal.SIGHUP)
+    new_pid = int(notify_sock.recv(100).decode().removeprefix("MAINPID="))
+    assert notify_sock.recv(100) == b"READY=1"
+    assert new_pid != proc.pid
+
+    # the old process finishes its connections and exits
+    assert rfile.readline() == b""
+    assert proc.wait(timeout=10) == 0
+    assert psutil.pid_exists(new_pid)
+    for _ in range(5):
+        client2, rfile2 = connect(sock_path)
+        with client2:
+            assert lookup(client2, rfile2) == b"N\n"
+    os.kill(new_pid, signal.SIGTERM)
+    client.close()
+    notify_sock.close()
@@ -0,0 +1,107 @@
+import json
+import os
+import signal
+import time
+
+import pytest
+
+from chatmaild import tracing
+from chatmaild.doveauth import AuthDictProxy
+from chatmaild.tracing import TRACER, Tracer, get_key_kind, install_dump_handler
+
+
+@pytest.fixture
+def tracer(monkeypatch):
+    monkeypatch.setattr(TRACER, "sample_rate", 1.0)
+    TRACER.spans.clear()
+    yield TRACER
+    TRACER.spans.clear()
+
+
+def test_get_key_kind():
+    assert get_key_kind('shared/passdb/secret"user@example.org') == "shared/passdb"
+    assert get_key_kind("shared/userdb/user@example.org") == "shared/userdb"
+    assert get_key_kind("shared/last-login/user@example.org") == "shared/last-login"
+    assert get_key_kind("priv/guid00/devicetoken") == "priv/devicetoken"
+    key = "shared/0123/vendor/vendor.dovecot/pvt/server/vendor/deltachat/turn"
+    assert get_key_kind(key) == "shared/turn"
+
+
+def test_account_creation_stages(tracer, example_config):
+    dictproxy = AuthDictProxy(config=example_config)
+    addr = "foobar123@chat.example.org"
+    res = dictproxy.handle_dovecot_request(
+        f'Lshared/passdb/q9mr3faue"{addr}\t{addr}', {}
+    )
+    assert res.startswith("O")
+
+    (span,) = tracer.spans
+    data = span.to_dict()
+    assert data["command"] == "L"
+    assert data["key"] == "shared/passdb"
+    assert data["reply"] == "O"
+    assert data["addr"] == tracer.hash_addr(addr)
+    assert set(data["stages"]) == {"parse", "read", "crypt", "write"}
+    assert sum(data["stages"].values()) <= data["ms"]
+    assert addr not in json.dumps(data)
+    assert "q9mr3faue" not in json.dumps(data)
+
+
+def test_transaction_addr(tracer, example_config):
+    from chatmaild.lastlogin import LastLoginDictProxy
+
+    dictproxy = LastLoginDictProxy(config=example_config)
+    addr = "foobar123@chat.example.org"
+    transactions = {}
+    dictproxy.handle_dovecot_request(f"B1\t{addr}", transactions)
+    dictproxy.handle_dovecot_request(f"S1\tshared/last-login/{addr}\t0", transactions)
+    dictproxy.handle_dovecot_request("C1", transactions)
+    spans = [span.to_dict() for span in tracer.spans]
+    assert [s["command"] for s in spans] == ["B", "S", "C"]
+    assert {s["addr"] for s in spans} == {tracer.hash_addr(addr)}
+    assert spans[1]["key"] == "shared/last-login"
+
+
+def test_not_sampled():
+    tracer = Tracer(sample_rate=0.0)
+    assert tracer.start_span("L", ["shared/userdb/x", "x"], {}) is None
+    assert tracing.stage("read") is tracing.stage("write")
+
+
+def test_ring_buffer_size():
+    tracer = Tracer(sample_rate=1.0, size=3)
+    for i in range(5):
+        span = tracer.start_span("L", [f"priv/guid/key{i}", "x"], {})
+        tracer.finish_span(span, 0.001, "N")
+    assert [span.key for span in tracer.spans] == [
+        "priv/key2",
+        "priv/key3",
+        "priv/key4",
+    ]
+
+
+def test_hash_addr_keyed():
+    assert Tracer().hash_addr("a@example.org") != Tracer().hash_addr("a@example.org")
+    assert Tracer().hash_addr("") is None
+
+
+def test_dump_on_sigusr1(tracer, tmp_path):
+    span = tracer.start_span("L", ["shared/userdb/x@example.org", "x@example.org"], {})
+    tracer.finish_span(span, 0.002, "N")
+
+    old_handler = signal.getsignal(signal.SIGUSR1)
+    try:
+        install_dump_handler(str(tmp_path), "doveauth")
+        os.kill(os.getpid(), signal.SIGUSR1)
+        path = tmp_path.joinpath(f"doveauth-trace-{os.getpid()}.jsonl")
+        deadline = time.time() + 5
+        while not path.exists():
+            assert time.time() < deadline
+            time.sleep(0.01)
+    finally:
+        signal.signal(signal.SIGUSR1, old_handler)
+
+    (line,) = path.read_text().splitlines()
+    data = json.loads(line)
+    assert data["key"] == "shared/userdb"
+    assert data["ms"] == 2.0
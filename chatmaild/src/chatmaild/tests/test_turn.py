@@ -3,7 +3,12 @@ import threading
 
 import pytest
 
-from chatmaild.metadata import turn_credentials
+import chatmaild.metadata
+from chatmaild.metadata import (
+    TurnCredentialProvider,
+    get_turn_expiry,
+    turn_credentials,
+)
 
 
 @pytest.fixture
@@ -44,3 +49,101 @@ def test_turn_credentials_socket_success(turn_socket):
 
     result = turn_credentials(sock_path)
     assert result == "testuser:testpass"
+
+
+@pytest.fixture
+def fetches(monkeypatch):
+    fetches = []
+
+    def fake_turn_credentials(path):
+        fetches.append(path)
+        return f"{2000 + len(fetches) * 100}:pass{len(fetches)}"
+
+    monkeypatch.setattr(chatmaild.metadata, "turn_credentials", fake_turn_credentials)
+    return fetches
+
+
+def test_get_turn_expiry():
+    assert get_turn_expiry("1735689600:c2VjcmV0") == 1735689600
+    assert get_turn_expiry("1735689600:user:c2VjcmV0") == 1735689600
+    assert get_turn_expiry("user:pass") is None
+
+
+def test_provider_serves_bursts_from_one_fetch(fetches, monkeypatch):
+    started = threading.Event()
+    release = threading.Event()
+    fetch = chatmaild.metadata.turn_credentials
+
+    def slow_turn_credentials(path):
+        started.set()
+        release.wait()
+        return fetch(path)
+
+    monkeypatch.setattr(chatmaild.metadata, "turn_credentials", slow_turn_credentials)
+    provider = TurnCredentialProvider("turn.socket", clock=lambda: 2000)
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(provider.get()))
+        for i in range(10)
+    ]
+    for thread in threads:
+        thread.start()
+    started.wait()
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert results == ["2100:pass1"] * 10
+    assert len(fetches) == 1
+
+
+def test_provider_refreshes_before_expiry(fetches):
+    now = [2000]
+    provider = TurnCredentialProvider("turn.socket", clock=lambda: now[0])
+    assert provider.get() == "2100:pass1"
+    now[0] = 2040
+    assert provider.get() == "2100:pass1"
+    assert len(fetches) == 1
+
+    # past half of the lifetime it is refetched in the background
+    now[0] = 2060
+    assert provider.get() == "2100:pass1"
+    for thread in threading.enumerate():
+        if thread.name == "turn-refresh":
+            thread.join()
+    assert len(fetches) == 2
+    assert provider.get() == "2200:pass2"
+
+    # past 80% of the lifetime callers wait for new credentials
+    now[0] = 2300
+    assert provider.get() == "2300:pass3"
+
+
+def test_provider_without_expiry(monkeypatch):
+    monkeypatch.setattr(chatmaild.metadata, "turn_credentials", lambda path: "u:p")
+    now = [1000]
+    provider = TurnCredentialProvider("turn.socket", ttl=10, clock=lambda: now[0])
+    assert provider.get() == "u:p"
+    assert provider.usable_until == 1008
+
+
+def test_provider_failure_backoff(monkeypatch):
+    calls = []
+
+    def failing_turn_credentials(path):
+        calls.append(path)
+        raise ConnectionRefusedError()
+
+    monkeypatch.setattr(
+        chatmaild.metadata, "turn_credentials", failing_turn_credentials
+    )
+    now = [1000]
+    provider = TurnCredentialProvider("turn.socket", clock=lambda: now[0])
+    with pytest.raises(ConnectionRefusedError):
+        provider.get()
+    with pytest.raises(ConnectionError):
+        provider.get()
+    assert len(calls) == 1
+    now[0] += 2
+    with pytest.raises(ConnectionRefusedError):
+        provider.get()
+    assert len(calls) == 2
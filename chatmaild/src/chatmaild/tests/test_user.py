@@ -54,3 +54,11 @@ def test_set_get_cleartext_flag(testaddr, example_config, tmp_path):
     assert not user.is_incoming_cleartext_ok()
     user.allow_incoming_cleartext()
     assert user.is_incoming_cleartext_ok()
+
+
+def test_create(testaddr, example_config):
+    user = example_config.get_user(testaddr)
+    assert user.create("firstpassword")
+    assert not user.create("secondpassword")
+    assert user.get_userdb_dict()["password"] == "firstpassword"
+    assert not user.is_incoming_cleartext_ok()
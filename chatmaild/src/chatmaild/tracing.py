@@ -0,0 +1,176 @@
+"""
+Sampled tracing of dict proxy requests.
+
+A configurable fraction of requests is traced with the time spent
+in stages like "parse", "read", "lock", "crypt" and "write".
+The most recent spans are kept in a fixed-size ring buffer
+which is written out as JSON lines on SIGUSR1, e.g.
+
+    systemctl kill -s USR1 doveauth
+
+writes /run/doveauth/doveauth-trace-<pid>.jsonl
+
+Addresses are never recorded, only a keyed hash which is stable
+within one process so that spans of the same address can be correlated.
+Keys are reduced to their kind so that passwords don't end up in dumps.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import random
+import signal
+import threading
+import time
+from collections import deque
+
+# number of most recent spans kept by each process
+TRACE_BUFFER_SIZE = 2000
+
+_local = threading.local()
+
+
+class Span:
+    __slots__ = ("start", "command", "key", "addr", "stages", "seconds", "reply")
+
+    def __init__(self, command, key, addr):
+        self.start = time.time()
+        self.command = command
+        self.key = key
+        self.addr = addr
+        self.stages = {}
+        self.seconds = None
+        self.reply = None
+
+    def add_stage(self, name, seconds):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def to_dict(self):
+        return dict(
+            ts=round(self.start, 6),
+            command=self.command,
+            key=self.key,
+            addr=self.addr,
+            reply=self.reply,
+            ms=round(self.seconds * 1000, 3),
+            stages={k: round(v * 1000, 3) for k, v in self.stages.items()},
+        )
+
+
+class _Stage:
+    def __init__(self, span, name):
+        self.span = span
+        self.name = name
+
+    def __enter__(self):
+        self.begin = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.span.add_stage(self.name, time.perf_counter() - self.begin)
+
+
+class _NoStage:
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc):
+        pass
+
+
+_NO_STAGE = _NoStage()
+
+
+def stage(name):
+    """Return a context manager timing a stage of the traced request
+    handled by the current thread; does nothing if it is not sampled."""
+    span = getattr(_local, "span", None)
+    if span is None:
+        return _NO_STAGE
+    return _Stage(span, name)
+
+
+def get_key_kind(key):
+    """Return the kind of a dict key without addresses or passwords,
+    e.g. "shared/passdb" or "priv/devicetoken"."""
+    parts = key.split("/")
+    if parts[0] == "shared" and len(parts) > 2:
+        if parts[1] in ("passdb", "userdb", "last-login"):
+            return "/".join(parts[:2])
+    if len(parts) > 2:
+        return f"{parts[0]}/{parts[-1]}"
+    return parts[0]
+
+
+class Tracer:
+    def __init__(self, sample_rate=0.0, size=TRACE_BUFFER_SIZE):
+        self.sample_rate = sample_rate
+        self.spans = deque(maxlen=size)
+        self._salt = os.urandom(16)
+
+    def hash_addr(self, addr):
+        if not addr:
+            return None
+        digest = hashlib.blake2b(addr.encode(), key=self._salt, digest_size=8)
+        return digest.hexdigest()
+
+    def start_span(self, command, parts, transactions):
+        """Return a new span for a sampled request, or None."""
+        if not self.sample_rate or random.random() >= self.sample_rate:
+            return None
+        key = addr = None
+        if command in "LI" and parts:
+            key = get_key_kind(parts[-1] if command == "I" else parts[0])
+            addr = parts[1] if command == "L" and len(parts) > 1 else None
+        elif command == "B" and len(parts) > 1:
+            addr = parts[1]
+        elif command in "SCR" and parts:
+            addr = transactions.get(parts[0], {}).get("addr")
+            if command == "S" and len(parts) > 1:
+                key = get_key_kind(parts[1])
+        span = Span(command, key, self.hash_addr(addr))
+        _local.span = span
+        return span
+
+    def finish_span(self, span, seconds, reply):
+        _local.span = None
+        span.seconds = seconds
+        span.reply = reply
+        self.spans.append(span)
+
+    def dump(self, path):
+        """Write the buffered spans, oldest first, as JSON lines to `path`."""
+        spans = list(self.spans)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            for span in spans:
+                f.write(json.dumps(span.to_dict()) + "\n")
+        os.rename(tmp_path, path)
+        return len(spans)
+
+
+TRACER = Tracer()
+
+
+def install_dump_handler(dump_dir, service):
+    """Dump the spans of this process to `dump_dir` on SIGUSR1.
+
+    Only possible from the main thread, elsewhere this does nothing.
+    Forked worker processes inherit the handler.
+    """
+    if threading.current_thread() is not threading.main_thread():
+        return
+
+    def dump():
+        path = os.path.join(dump_dir, f"{service}-trace-{os.getpid()}.jsonl")
+        try:
+            num = TRACER.dump(path)
+        except OSError:
+            logging.exception(f"failed to write trace dump {path}")
+        else:
+            logging.info(f"wrote {num} trace spans to {path}")
+
+    def on_signal(signum, frame):
+        threading.Thread(target=dump).start()
+
+    signal.signal(signal.SIGUSR1, on_signal)
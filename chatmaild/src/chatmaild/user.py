@@ -1,7 +1,14 @@
 import logging
-import os
+import time
 
-from chatmaild.filedict import write_bytes_atomic
+from chatmaild.metrics import REGISTRY
+from chatmaild.tracing import stage
+
+FS_OPS = REGISTRY.counter(
+    "chatmail_user_fs_ops_total",
+    "Filesystem operations on user state files.",
+    ["op"],
+)
 
 
 def get_daytimestamp(timestamp) -> int:
@@ -9,13 +16,17 @@ def get_daytimestamp(timestamp) -> int:
 
 
 class User:
-    def __init__(self, maildir, addr, password_path, uid, gid):
+    def __init__(self, maildir, addr, password_path, uid, gid, store, census=None):
         self.maildir = maildir
         self.addr = addr
         self.password_path = password_path
         self.enforce_E2EE_path = maildir.joinpath("enforceE2EEincoming")
         self.uid = uid
         self.gid = gid
+        # keeps password and last login, see chatmaild.accountstore
+        self.store = store
+        # optional record of all mailboxes, see chatmaild.census
+        self.census = census
 
     @property
     def can_track(self):
@@ -24,9 +35,8 @@ class User:
     def get_userdb_dict(self):
         """Return a non-empty dovecot 'userdb' style dict
         if the user has an existing non-empty password"""
-        try:
-            pw = self.password_path.read_text()
-        except FileNotFoundError:
+        pw = self.store.get_password(self)
+        if pw is None:
             return {}
 
         if not pw:
@@ -36,7 +46,13 @@ class User:
         home = str(self.maildir)
         return dict(addr=self.addr, home=home, uid=self.uid, gid=self.gid, password=pw)
 
+    def get_stamp(self):
+        """Return a value which changes when the account changes,
+        None if it does not exist."""
+        return self.store.get_stamp(self)
+
     def is_incoming_cleartext_ok(self):
+        FS_OPS.inc(op="stat")
         return not self.enforce_E2EE_path.exists()
 
     def allow_incoming_cleartext(self):
@@ -49,34 +65,40 @@ class User:
         This method can be called concurrently
         but there is no guarantee which of the password-set calls will win.
         """
-        self.maildir.mkdir(exist_ok=True, parents=True)
-        password = enc_password.encode("ascii")
-
-        try:
-            write_bytes_atomic(self.password_path, password)
-        except PermissionError:
-            logging.error(f"could not write password for: {self.addr}")
-            raise
-        self.enforce_E2EE_path.touch()
+        with stage("write"):
+            FS_OPS.inc(op="mkdir")
+            self.maildir.mkdir(exist_ok=True, parents=True)
+            self.store.set_password(self, enc_password)
+            FS_OPS.inc(op="touch")
+            self.enforce_E2EE_path.touch()
+
+    def create(self, enc_password):
+        """Create the account with the specified password
+        and return True, or False if it already exists.
+
+        Of concurrent creators of the same account exactly one succeeds.
+        """
+        with stage("write"):
+            FS_OPS.inc(op="mkdir")
+            self.maildir.mkdir(exist_ok=True, parents=True)
+            if not self.store.create(self, enc_password):
+                return False
+            FS_OPS.inc(op="touch")
+            self.enforce_E2EE_path.touch()
+        if self.census is not None:
+            self.census.add_account(self.addr, get_daytimestamp(time.time()))
+        return True
 
     def set_last_login_timestamp(self, timestamp):
         """Track login time with daily granularity
         to minimize touching files and to minimize metadata leakage."""
         if not self.can_track:
             return
-        try:
-            mtime = int(os.stat(self.password_path).st_mtime)
-        except FileNotFoundError:
-            logging.error(f"Can not get last login timestamp for {self.addr}")
-            return
-
-        timestamp = get_daytimestamp(timestamp)
-        if mtime != timestamp:
-            os.utime(self.password_path, (timestamp, timestamp))
+        day = get_daytimestamp(timestamp)
+        self.store.set_last_login(self, day)
+        if self.census is not None:
+            self.census.set_last_login(self.addr, day)
 
     def get_last_login_timestamp(self):
         if self.can_track:
-            try:
-                return int(self.password_path.stat().st_mtime)
-            except FileNotFoundError:
-                pass
+            return self.store.get_last_login(self)
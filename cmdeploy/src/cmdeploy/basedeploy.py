@@ -87,7 +87,20 @@ def activate_remote_units(deployer, units) -> None:
         else:
             enabled = True
 
-        deployer.ensure_service(basename, running=enabled, enabled=enabled)
+        if basename.endswith(".socket"):
+            # restarting a socket unit closes its listening socket
+            # and stops the service requiring it, which fails Dovecot's requests
+            deployer.ensure_service(
+                basename, running=enabled, enabled=enabled, restart=False
+            )
+        elif f"{fn}.socket" in units:
+            # socket activated dict proxies hand their socket over
+            # to a new process on reload, see chatmaild.systemd
+            deployer.ensure_service(
+                basename, running=enabled, enabled=enabled, reload=True
+            )
+        else:
+            deployer.ensure_service(basename, running=enabled, enabled=enabled)
 
 
 class Deployment:
@@ -144,17 +157,24 @@ class Deployer:
     def activate(self):
         pass
 
-    def ensure_service(self, service, running=True, enabled=True):
+    def ensure_service(
+        self, service, running=True, enabled=True, restart=True, reload=False
+    ):
+        """Start or stop `service` and apply changes to a running one
+        by restarting it, by reloading it with `reload`
+        or not at all without `restart`."""
         if running:
             verb = "Start and enable"
         else:
             verb = "Stop"
+        apply_changes = self.need_restart and running and restart
         systemd.service(
             name=f"{verb} {service}",
             service=service,
             running=running,
             enabled=enabled,
-            restarted=self.need_restart if running else False,
+            restarted=apply_changes and not reload,
+            reloaded=apply_changes and reload,
             daemon_reload=self.daemon_reload,
         )
         self.daemon_reload = False
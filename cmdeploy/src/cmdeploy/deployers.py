@@ -370,9 +370,14 @@ class ChatmailVenvDeployer(Deployer):
     def __init__(self, config):
         self.config = config
         self.units = (
-            # doveauth must restart when chatmaild/ini file changes
+            # dict proxies are reloaded when chatmaild/ini file changes,
+            # handing their sockets held by systemd over to a new process
+            # so Dovecot connections never fail, the sockets are never restarted
+            "doveauth.socket",
             "doveauth",
+            "chatmail-metadata.socket",
             "chatmail-metadata",
+            "lastlogin.socket",
             "lastlogin",
             "chatmail-expire",
             "chatmail-expire.timer",
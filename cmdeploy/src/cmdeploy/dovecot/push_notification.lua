@@ -1,19 +1,33 @@
 function dovecot_lua_notify_begin_txn(user)
-  return user
+  -- Mailboxes of the transaction are synced once at its end
+  -- and incoming messages are signalled once.
+  return { user = user, mailboxes = {}, seen = {}, incoming = nil, count = 0 }
 end
 
-function dovecot_lua_notify_event_message_new(user, event)
-  local mbox = user:mailbox(event.mailbox)
-  mbox:sync()
+function dovecot_lua_notify_event_message_new(ctx, event)
+  if not ctx.seen[event.mailbox] then
+    ctx.seen[event.mailbox] = true
+    table.insert(ctx.mailboxes, event.mailbox)
+  end
 
-  if user.username ~= event.from_address then
+  if ctx.user.username ~= event.from_address then
     -- Incoming message
-    -- Notify METADATA server about new message.
-    mbox:metadata_set("/private/messagenew", "")
+    ctx.incoming = ctx.incoming or event.mailbox
+    ctx.count = ctx.count + 1
   end
-
-  mbox:free()
 end
 
 function dovecot_lua_notify_end_txn(ctx, success)
+  -- Like the per-message handling before, also failed transactions
+  -- sync their mailboxes and signal their incoming messages.
+  for _, name in ipairs(ctx.mailboxes) do
+    local mbox = ctx.user:mailbox(name)
+    mbox:sync()
+    if name == ctx.incoming then
+      -- Notify METADATA server once about all new messages,
+      -- the value is their number.
+      mbox:metadata_set("/private/messagenew", tostring(ctx.count))
+    end
+    mbox:free()
+  end
 end
@@ -1,12 +1,19 @@
 [Unit]
 Description=Chatmail dict proxy for IMAP METADATA
+Requires=chatmail-metadata.socket
+After=chatmail-metadata.socket
 
 [Service]
+Type=notify
+NotifyAccess=all
 ExecStart={execpath} /run/chatmail-metadata/metadata.socket {config_path}
+ExecReload=/bin/kill -HUP $MAINPID
 Restart=always
-RestartSec=5
+RestartSec=1
+TimeoutStopSec=30
 User=vmail
 RuntimeDirectory=chatmail-metadata
+RuntimeDirectoryPreserve=yes
 UMask=0077
 
 [Install]
@@ -1,12 +1,19 @@
 [Unit]
 Description=Chatmail dict authentication proxy for dovecot
+Requires=doveauth.socket
+After=doveauth.socket
 
 [Service]
+Type=notify
+NotifyAccess=all
 ExecStart={execpath} /run/doveauth/doveauth.socket {config_path}
+ExecReload=/bin/kill -HUP $MAINPID
 Restart=always
-RestartSec=30
+RestartSec=1
+TimeoutStopSec=30
 User=vmail
 RuntimeDirectory=doveauth
+RuntimeDirectoryPreserve=yes
 UMask=0077
 
 [Install]
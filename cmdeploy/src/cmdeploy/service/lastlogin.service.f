@@ -1,12 +1,19 @@
 [Unit]
 Description=Dict proxy for last-login tracking
+Requires=lastlogin.socket
+After=lastlogin.socket
 
 [Service]
+Type=notify
+NotifyAccess=all
 ExecStart={execpath} /run/chatmail-lastlogin/lastlogin.socket {config_path}
+ExecReload=/bin/kill -HUP $MAINPID
 Restart=always
-RestartSec=30
+RestartSec=1
+TimeoutStopSec=30
 User=vmail
 RuntimeDirectory=chatmail-lastlogin
+RuntimeDirectoryPreserve=yes
 
 [Install]
 WantedBy=multi-user.target
@@ -86,6 +86,7 @@ def test_ensure_service():
             running=True,
             enabled=True,
             restarted=True,
+            reloaded=False,
             daemon_reload=True,
         )
         # daemon_reload is cleared to avoid multiple systemctl daemon-reload calls
@@ -116,3 +117,33 @@ def test_ensure_service():
         second_call = mock_svc.call_args_list[1]
         assert second_call.kwargs["restarted"] is True
         assert second_call.kwargs["daemon_reload"] is False
+
+
+def test_dictproxy_sockets_not_restarted():
+    from cmdeploy.basedeploy import activate_remote_units
+
+    units = ("doveauth.socket", "doveauth", "chatmail-expire", "chatmail-expire.timer")
+    with patch("cmdeploy.basedeploy.systemd.service") as mock_svc:
+        deployer = Deployer()
+        deployer.need_restart = True
+        activate_remote_units(deployer, units)
+    calls = {call.kwargs["service"]: call.kwargs for call in mock_svc.call_args_list}
+    assert calls["doveauth.socket"]["running"] is True
+    assert calls["doveauth.socket"]["enabled"] is True
+    assert calls["doveauth.socket"]["restarted"] is False
+    assert calls["doveauth.socket"]["reloaded"] is False
+    assert calls["doveauth.service"]["restarted"] is False
+    assert calls["doveauth.service"]["reloaded"] is True
+    assert calls["chatmail-expire.timer"]["restarted"] is True
+
+
+def test_dictproxy_socket_units_match_services():
+    from cmdeploy.basedeploy import get_resource
+
+    for name in ("doveauth", "chatmail-metadata", "lastlogin"):
+        service = get_resource(f"service/{name}.service.f").read_text()
+        socket = get_resource(f"service/{name}.socket.f").read_text()
+        listen_path = socket.split("ListenStream=")[1].split()[0]
+        assert f"ExecStart={{execpath}} {listen_path} " in service
+        assert f"Requires={name}.socket" in service
+        assert "RuntimeDirectoryPreserve=yes" in service